@@ -0,0 +1,337 @@
+"""
+benchmark.py
+
+Reproducible benchmark for server.py. Drives the Flask app in-process through
+its test client (no network, no SMTP) from a pool of worker threads, against
+a throwaway database and static/ directory in a temp dir.
+
+Scenarios:
+ - idle_poll: a fleet that only heartbeats and polls an empty queue
+ - enqueue_storm: admins enqueue/broadcast commands while agents drain them
+ - upload_burst: many agents upload a screenshot at once, then read it back
+ - dashboard: dashboard renders with --users users in the database
+ - login_rush: concurrent logins (password hashing included)
+
+For every scenario it reports throughput, p50/p95/p99 latency per endpoint
+and the time spent inside SQLite per statement type, and writes everything to a JSON file so
+runs can be diffed.
+
+Usage:
+  python benchmark.py                          # all scenarios -> benchmark.json
+  python benchmark.py --scenario idle_poll --clients 2000 --rounds 5
+  python benchmark.py --out after.json --compare before.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PASSWORD = 'BenchPass123!'
+
+
+# ----- SQLite timing -----
+# server.py times every statement into its sql_latency histogram (see
+# MetricsConnection); a scenario's SQLite time is the change in its sums.
+
+def sql_totals(server):
+    """{statement verb: (count, seconds)} recorded by the server so far."""
+    with server._metrics_lock:
+        return {labels[0]: (sum(row[:-1]), row[-1]) for labels, row in server.sql_latency.series.items()}
+
+
+# ----- Harness -----
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+class Bench:
+    """Runs requests against the app from `concurrency` threads, each with its
+    own test client, and records latency per endpoint label plus the SQLite
+    time spent while the scenario ran."""
+
+    def __init__(self, server, concurrency):
+        self.server = server
+        self.concurrency = concurrency
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.samples = {}     # label -> [seconds]
+        self.errors = {}
+        self.sql_before = sql_totals(self.server)
+
+    def client(self, role=None):
+        clients = getattr(self._local, 'clients', None)
+        if clients is None:
+            clients = self._local.clients = {}
+        if role not in clients:
+            clients[role] = self.server.app.test_client()
+            if role:
+                with clients[role].session_transaction() as s:
+                    s['user_email'] = f'bench-{role.lower()}@example.com'
+                    s['role'] = role
+        return clients[role]
+
+    def call(self, label, method, path, role=None, ok=(200,), **kw):
+        cl = self.client(role)
+        start = time.perf_counter()
+        resp = cl.open(path, method=method, **kw)
+        resp.get_data()
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.samples.setdefault(label, []).append(elapsed)
+            if resp.status_code not in ok:
+                self.errors[label] = self.errors.get(label, 0) + 1
+        return resp
+
+    def run(self, jobs):
+        """Run callables concurrently; returns wall-clock seconds."""
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for f in [pool.submit(job) for job in jobs]:
+                f.result()
+        return time.perf_counter() - start
+
+    def report(self, wall):
+        endpoints = {}
+        total = 0
+        for label, lat in sorted(self.samples.items()):
+            total += len(lat)
+            endpoints[label] = {
+                "requests": len(lat),
+                "errors": self.errors.get(label, 0),
+                "p50_ms": round(percentile(lat, 50) * 1000, 3),
+                "p95_ms": round(percentile(lat, 95) * 1000, 3),
+                "p99_ms": round(percentile(lat, 99) * 1000, 3),
+                "mean_ms": round(sum(lat) / len(lat) * 1000, 3),
+                "max_ms": round(max(lat) * 1000, 3),
+            }
+        sqlite = {}
+        for verb, (count, seconds) in sorted(sql_totals(self.server).items()):
+            count0, seconds0 = self.sql_before.get(verb, (0, 0.0))
+            if count > count0:
+                sqlite[verb] = {"statements": count - count0, "ms": round((seconds - seconds0) * 1000, 3)}
+        return {"requests": total, "errors": sum(self.errors.values()),
+                "wall_s": round(wall, 3), "throughput_rps": round(total / wall, 1) if wall else 0.0,
+                "sqlite_s": round(sum(v["ms"] for v in sqlite.values()) / 1000, 3), "sqlite": sqlite,
+                "endpoints": endpoints}
+
+
+# ----- Scenarios -----
+# Each takes (bench, opts) and returns the wall-clock seconds it measured.
+
+def clients_for(opts, n=None):
+    return [f"bench-pc{i}" for i in range(1, (n or opts.clients) + 1)]
+
+def scenario_idle_poll(bench, opts):
+    pcs = clients_for(opts)
+    def agent(pc):
+        def job():
+            for _ in range(opts.rounds):
+                bench.call('POST /heartbeatz/<client_id>', 'POST', f'/heartbeatz/{pc}')
+                bench.call('GET /poll-commands/<client_id>', 'GET', f'/poll-commands/{pc}')
+        return job
+    return bench.run([agent(pc) for pc in pcs])
+
+def scenario_enqueue_storm(bench, opts):
+    pcs = clients_for(opts)
+    def admin(chunk):
+        def job():
+            for pc in chunk:
+                bench.call('POST /enqueue-command', 'POST', '/enqueue-command', role='Admin',
+                           ok=(200, 409), json={'client_id': pc, 'command': 'screenshot'})
+            bench.call('POST /broadcast-command', 'POST', '/broadcast-command', role='Admin',
+                       json={'command': 'restart', 'client_ids': chunk})
+        return job
+    def agent(pc):
+        def job():
+            r = bench.call('GET /poll-commands/<client_id>', 'GET', f'/poll-commands/{pc}')
+            for cmd in (r.get_json() or {}).get('commands', []):
+                bench.call('POST /poll-commands/<client_id>', 'POST', f'/poll-commands/{pc}',
+                           json={'id': cmd['id'], 'status': 'done', 'result': 'ok'})
+        return job
+    chunks = [pcs[i:i + 50] for i in range(0, len(pcs), 50)]
+    wall = bench.run([admin(chunk) for chunk in chunks])
+    return wall + bench.run([agent(pc) for pc in pcs])
+
+def screenshot_images(opts):
+    from PIL import Image, ImageDraw
+    w, h = (int(v) for v in opts.shot_size.lower().split('x'))
+    rnd = random.Random(opts.seed)
+    images = []
+    for n in range(opts.shot_variants):
+        img = Image.new('RGB', (w, h), (70, 130, 180))
+        d = ImageDraw.Draw(img)
+        for _ in range(80):
+            x, y = rnd.randrange(w), rnd.randrange(h)
+            d.rectangle([x, y, x + rnd.randrange(10, w // 4), y + rnd.randrange(10, h // 6)],
+                        fill=tuple(rnd.randrange(256) for _ in range(3)))
+        buf = io.BytesIO()
+        img.save(buf, format='PNG')
+        images.append(buf.getvalue())
+    return images
+
+def scenario_upload_burst(bench, opts):
+    pcs = clients_for(opts, opts.uploads)
+    images = screenshot_images(opts)
+    def agent(i, pc):
+        def job():
+            bench.call('POST /upload/<client_id>', 'POST', f'/upload/{pc}',
+                       data=images[i % len(images)], content_type='image/png')
+            r = bench.call('GET /screenshot/<client_id>', 'GET', f'/screenshot/{pc}')
+            url = (r.get_json() or {}).get('thumb_url')
+            if url:
+                bench.call('GET /thumbs/<name>', 'GET', url, ok=(200, 302))
+        return job
+    return bench.run([agent(i, pc) for i, pc in enumerate(pcs)])
+
+def scenario_dashboard(bench, opts):
+    def job():
+        bench.call('GET /dashboard', 'GET', '/dashboard', role='Admin')
+    return bench.run([job] * opts.renders)
+
+def scenario_login_rush(bench, opts):
+    emails = [f"bench-user{i}@example.com" for i in range(1, opts.users + 1) if i % 10][:opts.logins]
+    def login(email):
+        def job():
+            bench.call('POST /login', 'POST', '/login', ok=(302,),
+                       data={'email': email, 'password': PASSWORD})
+        return job
+    return bench.run([login(e) for e in emails])
+
+SCENARIOS = {
+    'idle_poll': scenario_idle_poll,
+    'enqueue_storm': scenario_enqueue_storm,
+    'upload_burst': scenario_upload_burst,
+    'dashboard': scenario_dashboard,
+    'login_rush': scenario_login_rush,
+}
+
+
+# ----- Setup -----
+
+def load_server(workdir):
+    # server.py uses paths relative to the working directory. Import it the
+    # way serve.py does, without its background threads (outbox, event pump,
+    # retention), so they don't run during timed sections.
+    os.chdir(workdir)
+    os.environ['LAB_DEFER_STARTUP'] = '1'
+    sys.path.insert(0, HERE)
+    import server
+    server.init_db()
+    return server
+
+def seed(server, opts):
+    from werkzeug.security import generate_password_hash
+    pw = generate_password_hash(PASSWORD)  # one real hash shared by every user
+    rows = [('Admin', 'bench-admin@example.com', pw, 'Admin', 1)]
+    rows += [(f"bench-pc{i}", f"bench-user{i}@example.com", pw, 'Teacher', 1 if i % 10 else 0)
+             for i in range(1, opts.users + 1)]
+    with server.get_db() as conn:
+        conn.executemany("INSERT OR IGNORE INTO users (username,email,password,role,approved) VALUES (?,?,?,?,?)", rows)
+
+def reset_state(server):
+    with server.get_db() as conn:
+        conn.execute("DELETE FROM commands")
+    server.heartbeats.clear()
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    regressions = []
+    for name, scen in results['scenarios'].items():
+        old = baseline.get('scenarios', {}).get(name)
+        if not old:
+            continue
+        for label, ep in scen['endpoints'].items():
+            prev = old['endpoints'].get(label)
+            if prev and prev['p95_ms'] > 0 and ep['p95_ms'] > prev['p95_ms'] * (1 + threshold):
+                regressions.append(f"{name} {label}: p95 {prev['p95_ms']}ms -> {ep['p95_ms']}ms")
+    return regressions
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                   help='Scenario to run (repeatable); default all')
+    p.add_argument('--concurrency', type=int, default=8, help='Worker threads issuing requests')
+    p.add_argument('--clients', type=int, default=500, help='Simulated PCs for idle_poll/enqueue_storm')
+    p.add_argument('--rounds', type=int, default=3, help='Heartbeat+poll rounds per PC in idle_poll')
+    p.add_argument('--uploads', type=int, default=200, help='Agents uploading in upload_burst')
+    p.add_argument('--shot-size', default='1280x720', help='Screenshot size WxH for upload_burst')
+    p.add_argument('--shot-variants', type=int, default=8, help='Distinct images in upload_burst')
+    p.add_argument('--users', type=int, default=500, help='Users in the database (dashboard size)')
+    p.add_argument('--renders', type=int, default=50, help='Dashboard renders')
+    p.add_argument('--logins', type=int, default=40, help='Logins in login_rush')
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--out', default='benchmark.json', help='Where to write the JSON results')
+    p.add_argument('--compare', help='Earlier results JSON; exit 1 when a p95 regresses past --threshold')
+    p.add_argument('--threshold', type=float, default=0.2, help='Allowed p95 slowdown (0.2 = 20%%)')
+    args = p.parse_args()
+
+    random.seed(args.seed)
+    out = os.path.abspath(args.out)
+    baseline = os.path.abspath(args.compare) if args.compare else None
+    workdir = tempfile.mkdtemp(prefix='lab-bench-')
+    server = load_server(workdir)
+    seed(server, args)
+    bench = Bench(server, args.concurrency)
+
+    results = {
+        "meta": {"started": time.strftime('%Y-%m-%dT%H:%M:%S'), "git": git_revision(),
+                 "python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+                 "platform": platform.platform(), "options": {k: v for k, v in vars(args).items()
+                                                              if k not in ('out', 'compare')}},
+        "scenarios": {},
+    }
+    for name in args.scenario or list(SCENARIOS):
+        reset_state(server)
+        bench.reset()
+        wall = SCENARIOS[name](bench, args)
+        results["scenarios"][name] = rep = bench.report(wall)
+        print(f"{name}: {rep['requests']} requests in {rep['wall_s']}s ({rep['throughput_rps']} req/s), "
+              f"{rep['errors']} errors, sqlite {rep['sqlite_s']}s")
+        for label, ep in rep['endpoints'].items():
+            print(f"  {label:34} p50={ep['p50_ms']:8.2f}ms p95={ep['p95_ms']:8.2f}ms "
+                  f"p99={ep['p99_ms']:8.2f}ms")
+        for verb, sql in rep['sqlite'].items():
+            print(f"  sqlite {verb:27} {sql['statements']:8} statements {sql['ms']:10.2f}ms")
+
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('Wrote', out)
+    if baseline:
+        regressions = compare(results, baseline, args.threshold)
+        for line in regressions:
+            print('REGRESSION', line)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,7 @@
 """
 Simple client agent to poll server for commands and act on them.
+Each cycle is one POST /sync/<client_id>: it is the heartbeat, delivers the
+results of the commands run since the last sync and returns new ones.
 Safe by default: restart/shutdown are simulated unless --exec flag given or SAFE=0.
 
 Usage:
@@ -10,8 +12,11 @@ Usage:
 Environment variables:
   SERVER (default http://127.0.0.1:5000)
   CLIENT_ID (default client1)
-  POLL_INTERVAL (seconds, default 10)
+  POLL_INTERVAL (seconds between syncs when the server doesn't say, default 10)
+  LONG_POLL_WAIT (seconds the server may hold a poll open, default 25; 0 disables)
   SAFE (1 default: do not execute destructive commands; set 0 to allow)
+  PHASH_THRESHOLD (bits; a capture this close to the last upload is acked as unchanged, default 0)
+  SCREENSHOT_REFRESH (seconds; always upload a full image at least this often, default 120)
 """
 import os
 import time
@@ -20,21 +25,25 @@ import io
 import json
 import argparse
 try:
-    from PIL import ImageGrab
+    from PIL import Image, ImageGrab
     PIL_AVAILABLE = True
 except Exception:
-    ImageGrab = None
+    Image = ImageGrab = None
     PIL_AVAILABLE = False
 
 SERVER = os.environ.get('SERVER', 'http://127.0.0.1:5000')
 CLIENT_ID = os.environ.get('CLIENT_ID', 'client1')
 POLL = int(os.environ.get('POLL_INTERVAL', '10'))
+LONG_POLL_WAIT = int(os.environ.get('LONG_POLL_WAIT', '25'))
 SAFE = os.environ.get('SAFE', '1') != '0'
+PHASH_THRESHOLD = int(os.environ.get('PHASH_THRESHOLD', '0'))
+SCREENSHOT_REFRESH = int(os.environ.get('SCREENSHOT_REFRESH', '120'))
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--server', help='Server URL')
 parser.add_argument('--client', help='Client ID')
 parser.add_argument('--poll', type=int, help='Poll interval seconds')
+parser.add_argument('--long-poll', type=int, help='Long-poll wait seconds (0 disables)')
 parser.add_argument('--exec', action='store_true', help='Allow destructive commands (restart/shutdown)')
 args = parser.parse_args()
 if args.server:
@@ -43,72 +52,120 @@ if args.client:
     CLIENT_ID = args.client
 if args.poll:
     POLL = args.poll
+if args.long_poll is not None:
+    LONG_POLL_WAIT = args.long_poll
 if args.exec:
     SAFE = False
 
-print(f"Client agent starting. SERVER={SERVER}, CLIENT_ID={CLIENT_ID}, POLL={POLL}, SAFE={SAFE}")
+print(f"Client agent starting. SERVER={SERVER}, CLIENT_ID={CLIENT_ID}, POLL={POLL}, LONG_POLL_WAIT={LONG_POLL_WAIT}, SAFE={SAFE}")
 
 session = requests.Session()
+last_upload = {'phash': None, 'time': 0.0}
+telemetry_sent = {'done': False}   # sent once, with the first sync that gets through
 
-def poll_once():
+def image_phash(im):
+    # 256-bit difference hash of a 17x16 grayscale thumbnail (same as real_client.py)
+    small = im.resize((17, 16), Image.BOX, reducing_gap=3.0).convert('L')
+    px = list(small.getdata())
+    bits = 0
+    for y in range(16):
+        row = px[y * 17:(y + 1) * 17]
+        for x in range(16):
+            bits = (bits << 1) | (row[x] > row[x + 1])
+    return f'{bits:064x}'
+
+def screen_unchanged(phash):
+    # Ask the server to keep the stored screenshot if ours is near-identical
+    if not last_upload['phash'] or time.time() - last_upload['time'] >= SCREENSHOT_REFRESH:
+        return False
+    if bin(int(phash, 16) ^ int(last_upload['phash'], 16)).count('1') > PHASH_THRESHOLD:
+        return False
     try:
-        r = session.get(f"{SERVER}/poll-commands/{CLIENT_ID}", timeout=10)
-        r.raise_for_status()
-        data = r.json()
-        cmds = data.get('commands', [])
-        for cmd in cmds:
-            cid = cmd.get('id')
-            command = cmd.get('command')
-            args = cmd.get('args')
-            print('Got command', cid, command, args)
-            result = ''
-            status = 'done'
-            if command == 'screenshot':
-                try:
-                    if not PIL_AVAILABLE:
-                        raise RuntimeError('Pillow (PIL) not available')
-                    img = ImageGrab.grab()
-                    buf = io.BytesIO()
-                    img.save(buf, format='PNG')
-                    buf.seek(0)
-                    files = {'screenshot': ('screenshot.png', buf, 'image/png')}
-                    up = session.post(f"{SERVER}/upload/{CLIENT_ID}", files=files, timeout=20)
-                    if up.ok:
-                        result = 'screenshot uploaded'
-                    else:
-                        result = f'upload failed: {up.status_code}'
-                except Exception as e:
-                    result = f'screenshot error: {e} (install Pillow: pip install Pillow)'
-            elif command in ('restart', 'shutdown'):
-                if SAFE:
-                    result = f'simulated {command}'
-                else:
-                    try:
-                        if os.name == 'nt':
-                            if command == 'restart':
-                                os.system('shutdown /r /t 0')
-                            else:
-                                os.system('shutdown /s /t 0')
-                        else:
-                            if command == 'restart':
-                                os.system('sudo reboot')
-                            else:
-                                os.system('sudo shutdown -h now')
-                        result = f'executed {command}'
-                    except Exception as e:
-                        result = f'execute error: {e}'
-            else:
-                result = f'unknown command: {command}'
+        return session.post(f"{SERVER}/screenshot-unchanged/{CLIENT_ID}", json={'phash': phash}, timeout=10).ok
+    except Exception:
+        return False
 
-            # Post back result
+def run_command(cmd):
+    """Run one command and return its result entry for the next sync."""
+    cid = cmd.get('id')
+    command = cmd.get('command')
+    args = cmd.get('args')
+    print('Got command', cid, command, args)
+    result = ''
+    status = 'done'
+    if command == 'screenshot':
+        try:
+            if not PIL_AVAILABLE:
+                raise RuntimeError('Pillow (PIL) not available')
+            img = ImageGrab.grab()
+            phash = image_phash(img)
+            if screen_unchanged(phash):
+                result = 'screenshot unchanged'
+            else:
+                buf = io.BytesIO()
+                img.save(buf, format='PNG')
+                buf.seek(0)
+                files = {'screenshot': ('screenshot.png', buf, 'image/png')}
+                up = session.post(f"{SERVER}/upload/{CLIENT_ID}", files=files, data={'phash': phash}, timeout=20)
+                if up.ok:
+                    result = 'screenshot uploaded'
+                    last_upload.update(phash=phash, time=time.time())
+                else:
+                    result = f'upload failed: {up.status_code}'
+        except Exception as e:
+            result = f'screenshot error: {e} (install Pillow: pip install Pillow)'
+    elif command in ('restart', 'shutdown'):
+        if SAFE:
+            result = f'simulated {command}'
+        else:
             try:
-                session.post(f"{SERVER}/poll-commands/{CLIENT_ID}", json={'id':cid,'status':status,'result':result}, timeout=10)
+                if os.name == 'nt':
+                    if command == 'restart':
+                        os.system('shutdown /r /t 0')
+                    else:
+                        os.system('shutdown /s /t 0')
+                else:
+                    if command == 'restart':
+                        os.system('sudo reboot')
+                    else:
+                        os.system('sudo shutdown -h now')
+                result = f'executed {command}'
             except Exception as e:
-                print('Failed to post result', e)
+                result = f'execute error: {e}'
+    else:
+        result = f'unknown command: {command}'
+    return {'id': cid, 'status': status, 'result': result}
+
+SYNC_MAX_RESULTS = 100   # the server applies at most this many results per sync
+
+def sync_once(results, wait=True):
+    """One round trip to /sync: deliver results, long-poll (if `wait`) for commands.
+    Returns (commands, seconds to sleep before the next sync), or None on error."""
+    try:
+        body = {'results': results}
+        if not telemetry_sent['done']:
+            body['telemetry'] = {'agent': 'client_agent', 'safe': SAFE, 'pil': PIL_AVAILABLE}
+        if wait and LONG_POLL_WAIT > 0:
+            body['wait'] = LONG_POLL_WAIT
+        r = session.post(f"{SERVER}/sync/{CLIENT_ID}", json=body, timeout=10 + max(LONG_POLL_WAIT, 0))
+        r.raise_for_status()
+        data = r.json()
+        telemetry_sent['done'] = True
+        return data.get('commands', []), float(data.get('poll_interval', POLL))
     except Exception as e:
-        print('Poll error', e)
+        print('Sync error', e)
+    return None
 
 if __name__ == '__main__':
+    results = []
     while True:
-        poll_once()
-        time.sleep(POLL)
+        batch = results[:SYNC_MAX_RESULTS]
+        reply = sync_once(batch, wait=len(results) <= SYNC_MAX_RESULTS)
+        if reply is None:
+            time.sleep(POLL)   # keep the results and try again
+            continue
+        cmds, interval = reply
+        # Commands run in order here; their results go out with the next sync(s)
+        results = results[len(batch):] + [run_command(cmd) for cmd in cmds if cmd.get('id') is not None]
+        if len(results) <= SYNC_MAX_RESULTS:
+            time.sleep(interval)
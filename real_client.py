@@ -2,10 +2,9 @@
 """
 real_client.py
 Real client for lab PCs that:
- - polls server for commands (/poll-commands/<client_id>)
- - uploads screenshots to /upload/<client_id>
- - posts heartbeat to /heartbeatz/<client_id>
- - reports command results back via POST to /poll-commands/<client_id>
+ - syncs with the server via POST /sync/<client_id>: each call is the heartbeat,
+   carries finished command results and telemetry, and long-polls for new commands
+ - uploads screenshots to /upload/<client_id> (raw image body)
 
 Usage:
   SERVER=http://192.168.1.10:5000 CLIENT_ID=labpc1 python3 real_client.py
@@ -14,6 +13,7 @@ Usage:
 import os
 import time
 import json
+import base64
 import threading
 import io
 import platform
@@ -33,10 +33,20 @@ except Exception:
 # --- Configuration (can be overridden by env or config.json) ---
 SERVER = os.environ.get("SERVER", "http://127.0.0.1:5000")
 CLIENT_ID = os.environ.get("CLIENT_ID") or platform.node() or "client-unknown"
-POLL_INTERVAL = int(os.environ.get("POLL_INTERVAL", "5"))      # seconds
-HEARTBEAT_INTERVAL = int(os.environ.get("HEARTBEAT_INTERVAL", "15"))
+POLL_INTERVAL = int(os.environ.get("POLL_INTERVAL", "5"))      # seconds; used when the server doesn't say
+TELEMETRY_INTERVAL = int(os.environ.get("TELEMETRY_INTERVAL", "300"))  # seconds between telemetry reports
+LONG_POLL_WAIT = int(os.environ.get("LONG_POLL_WAIT", "25"))  # seconds the server may hold a poll; 0 disables
 ENABLE_REMOTE_POWER = os.environ.get("ENABLE_REMOTE_POWER", "false").lower() in ("1","true","yes")
 AUTH_TOKEN = os.environ.get("CLIENT_AUTH_TOKEN")  # optional header auth token
+# Screenshot encoding: smaller lossy images cost less CPU and upload bandwidth
+CAPTURE_FORMAT = os.environ.get("CAPTURE_FORMAT", "webp").lower()  # webp, jpeg or png
+CAPTURE_QUALITY = int(os.environ.get("CAPTURE_QUALITY", "70"))     # webp/jpeg quality 1-100
+CAPTURE_MAX_DIM = int(os.environ.get("CAPTURE_MAX_DIM", "1920"))   # longest side in px; 0 = full resolution
+CAPTURE_MONITOR = int(os.environ.get("CAPTURE_MONITOR", "0"))      # mss monitor: 0 = all screens, 1 = primary, ...
+# Skip re-uploading a screen that hasn't changed (perceptual hash within PHASH_THRESHOLD bits),
+# but still send a full image at least every SCREENSHOT_REFRESH seconds
+PHASH_THRESHOLD = int(os.environ.get("PHASH_THRESHOLD", "0"))
+SCREENSHOT_REFRESH = int(os.environ.get("SCREENSHOT_REFRESH", "120"))
 
 # Optional: try to load config.json in cwd
 cfg_path = os.path.join(os.getcwd(), "client_config.json")
@@ -47,8 +57,15 @@ if os.path.exists(cfg_path):
             SERVER = cfg.get("server", SERVER)
             CLIENT_ID = cfg.get("client_id", CLIENT_ID)
             POLL_INTERVAL = int(cfg.get("poll_interval", POLL_INTERVAL))
-            HEARTBEAT_INTERVAL = int(cfg.get("heartbeat_interval", HEARTBEAT_INTERVAL))
+            TELEMETRY_INTERVAL = int(cfg.get("telemetry_interval", TELEMETRY_INTERVAL))
+            LONG_POLL_WAIT = int(cfg.get("long_poll_wait", LONG_POLL_WAIT))
             ENABLE_REMOTE_POWER = bool(cfg.get("enable_remote_power", ENABLE_REMOTE_POWER))
+            CAPTURE_FORMAT = str(cfg.get("capture_format", CAPTURE_FORMAT)).lower()
+            CAPTURE_QUALITY = int(cfg.get("capture_quality", CAPTURE_QUALITY))
+            CAPTURE_MAX_DIM = int(cfg.get("capture_max_dim", CAPTURE_MAX_DIM))
+            CAPTURE_MONITOR = int(cfg.get("capture_monitor", CAPTURE_MONITOR))
+            PHASH_THRESHOLD = int(cfg.get("phash_threshold", PHASH_THRESHOLD))
+            SCREENSHOT_REFRESH = int(cfg.get("screenshot_refresh", SCREENSHOT_REFRESH))
     except Exception as e:
         print("Warning: failed to read client_config.json:", e)
 
@@ -61,33 +78,109 @@ SESSION.headers.update({"User-Agent": f"RealClient/{CLIENT_ID}", **HEADERS})
 
 stop_event = threading.Event()
 
+# Finished command results waiting to go out with the next sync
+pending_results = []
+results_lock = threading.Lock()
+RESULT_WAIT = 10   # seconds a sync waits for just-started commands so their results ride along
+SYNC_MAX_RESULTS = 100   # the server applies at most this many results per sync
+
 
 # --- Screenshot capture ---
-def capture_screenshot() -> bytes:
-    """Return PNG bytes of the current screen."""
+MIME_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+
+def encode_image(im) -> tuple:
+    """Downscale to CAPTURE_MAX_DIM and encode as CAPTURE_FORMAT. Returns (bytes, format)."""
+    from PIL import features
+    if CAPTURE_MAX_DIM > 0 and max(im.size) > CAPTURE_MAX_DIM:
+        # reducing_gap lets Pillow shrink by an integer factor first, which is much cheaper
+        im.thumbnail((CAPTURE_MAX_DIM, CAPTURE_MAX_DIM), reducing_gap=2.0)
+    fmt = CAPTURE_FORMAT if CAPTURE_FORMAT in MIME_TYPES else "webp"
+    if fmt == "webp" and not features.check("webp"):
+        fmt = "jpeg"
+    buf = io.BytesIO()
+    if fmt == "png":
+        im.save(buf, format="PNG")
+    elif fmt == "webp":
+        im.save(buf, format="WEBP", quality=CAPTURE_QUALITY, method=4)
+    else:
+        im.save(buf, format="JPEG", quality=CAPTURE_QUALITY)
+    return buf.getvalue(), fmt
+
+
+def image_phash(im) -> str:
+    """256-bit difference hash: compares neighbouring cells of a 17x16 grayscale thumbnail."""
+    from PIL import Image
+    small = im.resize((17, 16), Image.BOX, reducing_gap=3.0).convert("L")
+    px = list(small.getdata())
+    bits = 0
+    for y in range(16):
+        row = px[y * 17:(y + 1) * 17]
+        for x in range(16):
+            bits = (bits << 1) | (row[x] > row[x + 1])
+    return f"{bits:064x}"
+
+
+def phash_distance(a: str, b: str) -> int:
+    return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+
+def grab_screen():
+    """Return the current screen as a PIL image."""
+    if USE_MSS:
+        from PIL import Image
+        with mss.mss() as s:
+            index = CAPTURE_MONITOR if 0 <= CAPTURE_MONITOR < len(s.monitors) else 0
+            img = s.grab(s.monitors[index])
+            # Decode mss's raw BGRA buffer directly instead of going through
+            # img.rgb, which builds a second full-frame copy in Python
+            return Image.frombuffer("RGB", img.size, img.bgra, "raw", "BGRX", 0, 1)
+    # Pillow ImageGrab (Windows/macOS) or pyscreenshot on Linux if available
+    return ImageGrab.grab()
+
+
+# Sent when capture fails: a tiny PNG binary (1x1)
+FALLBACK_PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mP8Xw8AAn8B9o7sQwAAAABJRU5ErkJggg=="
+)
+
+last_upload = {"phash": None, "time": 0.0}  # perceptual hash and time of our last full upload
+
+
+def send_screenshot() -> str:
+    """Capture the screen and upload it, or just acknowledge it when it hasn't
+    changed since the last upload. Returns the result string for the server."""
+    phash = None
     try:
-        if USE_MSS:
-            with mss.mss() as s:
-                monitor = s.monitors[0]  # full desktop
-                img = s.grab(monitor)
-                # convert to PNG bytes via PIL
-                from PIL import Image
-                im = Image.frombytes("RGB", img.size, img.rgb)
-                buf = io.BytesIO()
-                im.save(buf, format="PNG")
-                return buf.getvalue()
-        else:
-            # Pillow ImageGrab (Windows/macOS) or pyscreenshot on Linux if available
-            im = ImageGrab.grab()
-            buf = io.BytesIO()
-            im.save(buf, format="PNG")
-            return buf.getvalue()
+        im = grab_screen()
+        phash = image_phash(im)
     except Exception as e:
-        # As a fallback, return a tiny PNG binary (1x1)
         print("Screenshot failed:", e)
-        return base64.b64decode(
-            "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mP8Xw8AAn8B9o7sQwAAAABJRU5ErkJggg=="
-        )
+        data, fmt = FALLBACK_PNG, "png"
+    else:
+        fresh = time.time() - last_upload["time"] < SCREENSHOT_REFRESH
+        if fresh and last_upload["phash"] and phash_distance(phash, last_upload["phash"]) <= PHASH_THRESHOLD:
+            try:
+                r = SESSION.post(f"{SERVER.rstrip('/')}/screenshot-unchanged/{CLIENT_ID}",
+                                 json={"phash": phash}, timeout=8)
+                if r.ok:
+                    return "screenshot unchanged"
+            except Exception as e:
+                print("Unchanged ack failed, uploading instead:", e)
+        data, fmt = encode_image(im)
+
+    # Raw body instead of multipart: the server streams it straight to disk
+    try:
+        up = SESSION.post(f"{SERVER.rstrip('/')}/upload/{CLIENT_ID}", data=data,
+                          headers={"Content-Type": MIME_TYPES[fmt]},
+                          params={"phash": phash} if phash else None, timeout=20)
+    except Exception as e:
+        return f"upload exception: {e}"
+    if not up.ok:
+        return f"upload failed status={up.status_code}"
+    if phash:
+        last_upload.update(phash=phash, time=time.time())
+    return "screenshot uploaded"
 
 
 # --- Command handlers ---
@@ -99,16 +192,7 @@ def handle_command(cmd: dict):
 
     try:
         if command == "screenshot":
-            png = capture_screenshot()
-            files = {"screenshot": ("s.png", io.BytesIO(png), "image/png")}
-            try:
-                up = SESSION.post(f"{SERVER.rstrip('/')}/upload/{CLIENT_ID}", files=files, timeout=20)
-                if up.ok:
-                    result = "screenshot uploaded"
-                else:
-                    result = f"upload failed status={up.status_code}"
-            except Exception as e:
-                result = f"upload exception: {e}"
+            result = send_screenshot()
 
         elif command in ("restart", "shutdown"):
             if not ENABLE_REMOTE_POWER:
@@ -123,12 +207,11 @@ def handle_command(cmd: dict):
     except Exception as e:
         result = f"error executing command: {e}"
 
-    # Report back result
-    try:
-        SESSION.post(f"{SERVER.rstrip('/')}/poll-commands/{CLIENT_ID}",
-                     json={"id": cid, "status": "done", "result": result}, timeout=8)
-    except Exception as e:
-        print("Failed to report result:", e)
+    # Reported with the next sync
+    if cid is None:
+        return
+    with results_lock:
+        pending_results.append({"id": cid, "status": "done", "result": result})
 
 
 def perform_power_action(action: str) -> str:
@@ -159,54 +242,64 @@ def perform_power_action(action: str) -> str:
         return f"power action failed: {e}"
 
 
-# --- Polling loop ---
-def polling_loop():
+# --- Sync loop ---
+def telemetry() -> dict:
+    return {"platform": platform.platform(), "python": platform.python_version(),
+            "capture": {"format": CAPTURE_FORMAT, "quality": CAPTURE_QUALITY, "max_dim": CAPTURE_MAX_DIM},
+            "remote_power": ENABLE_REMOTE_POWER}
+
+
+def sync_loop():
     backoff = 1
+    last_telemetry = 0
+    running = []   # command handler threads from earlier syncs
     while not stop_event.is_set():
+        # Wait briefly for the commands we just started, so their results go
+        # out now instead of after the next (possibly long) poll
+        deadline = time.time() + RESULT_WAIT
+        for t in running:
+            t.join(max(0, deadline - time.time()))
+        running = [t for t in running if t.is_alive()]
+        with results_lock:
+            results = pending_results[:SYNC_MAX_RESULTS]
+            backlog = len(pending_results) > len(results)
+        body = {"results": results}
+        # Don't sit in a long poll while a result is still being produced or waiting to be sent
+        if LONG_POLL_WAIT > 0 and not running and not backlog:
+            body["wait"] = LONG_POLL_WAIT
+        if time.time() - last_telemetry >= TELEMETRY_INTERVAL:
+            body["telemetry"] = telemetry()
         try:
-            r = SESSION.get(f"{SERVER.rstrip('/')}/poll-commands/{CLIENT_ID}", timeout=12)
-            if r.status_code == 200:
-                data = r.json()
-                for cmd in data.get("commands", []):
-                    # handle each command in its own short thread to avoid blocking polling
-                    threading.Thread(target=handle_command, args=(cmd,), daemon=True).start()
-                backoff = 1
-            else:
-                print("Poll returned status", r.status_code)
-                time.sleep(backoff)
-                backoff = min(60, backoff * 2)
-                continue
+            r = SESSION.post(f"{SERVER.rstrip('/')}/sync/{CLIENT_ID}", json=body,
+                             timeout=12 + max(LONG_POLL_WAIT, 0))
+            if r.status_code != 200:
+                raise RuntimeError(f"status {r.status_code}")
+            data = r.json()
         except Exception as e:
-            print("Poll error:", e)
-            time.sleep(backoff)
+            print("Sync error:", e)
+            stop_event.wait(backoff)
             backoff = min(60, backoff * 2)
             continue
-
-        time.sleep(POLL_INTERVAL)
-
-
-# --- Heartbeat loop ---
-def heartbeat_loop():
-    last = 0
-    while not stop_event.is_set():
-        now = time.time()
-        try:
-            if now - last >= HEARTBEAT_INTERVAL:
-                SESSION.post(f"{SERVER.rstrip('/')}/heartbeatz/{CLIENT_ID}", timeout=6)
-                last = now
-        except Exception:
-            pass
-        time.sleep(1)
+        backoff = 1
+        if "telemetry" in body:
+            last_telemetry = time.time()
+        with results_lock:
+            del pending_results[:len(results)]   # handlers only ever append
+        for cmd in data.get("commands", []):
+            # handle each command in its own short thread so a slow one doesn't hold up the rest
+            t = threading.Thread(target=handle_command, args=(cmd,), daemon=True)
+            t.start()
+            running.append(t)
+        if not backlog:
+            stop_event.wait(float(data.get("poll_interval", POLL_INTERVAL)))
 
 
 # --- Main ---
 def main():
     print("Real client starting. SERVER=", SERVER, "CLIENT_ID=", CLIENT_ID,
           "ENABLE_REMOTE_POWER=", ENABLE_REMOTE_POWER)
-    poll_t = threading.Thread(target=polling_loop, daemon=True)
-    hb_t = threading.Thread(target=heartbeat_loop, daemon=True)
-    poll_t.start()
-    hb_t.start()
+    sync_t = threading.Thread(target=sync_loop, daemon=True)
+    sync_t.start()
     try:
         while True:
             time.sleep(1)
@@ -0,0 +1,215 @@
+"""
+serve.py
+
+Production entry point for server.py: a prefork server for Linux.
+
+The master process parses the configuration once, imports the app (unless
+--no-preload), creates/migrates the database schema, binds the listening
+socket and forks --workers processes that accept on it. Each worker runs a
+threaded WSGI server, so long polls and /events streams each hold a thread,
+not a process. Workers that die are restarted.
+
+Signals (send to the master):
+  HUP       graceful reload: start a fresh set of workers, then stop the old
+            ones once they finish their in-flight requests. Code changes are
+            only picked up with --no-preload (workers import server.py
+            themselves); with preload the master's copy is reused.
+  TERM/INT  graceful shutdown, waiting up to --graceful-timeout seconds
+
+Startup cost is logged: the master's app import and schema init, and for
+each worker the time from fork to accepting requests.
+
+Usage:
+  python serve.py --workers 4 --bind 0.0.0.0:5000
+
+Environment (flags win):
+  SERVER_BIND (default 0.0.0.0:5000), SERVER_WORKERS (default CPU count),
+  SERVER_PRELOAD (1/0), SERVER_GRACEFUL_TIMEOUT (default 30)
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def log(msg):
+    print(f"[{time.strftime('%H:%M:%S')}] [{os.getpid()}] {msg}", flush=True)
+
+
+def parse_config(argv=None):
+    p = argparse.ArgumentParser(description='Prefork production server for the lab management app')
+    p.add_argument('--bind', default=os.environ.get('SERVER_BIND', '0.0.0.0:5000'), help='host:port')
+    p.add_argument('--workers', type=int, default=int(os.environ.get('SERVER_WORKERS', os.cpu_count() or 2)))
+    p.add_argument('--no-preload', dest='preload', action='store_false',
+                   default=os.environ.get('SERVER_PRELOAD', '1') == '1',
+                   help='Import the app in each worker instead of once in the master')
+    p.add_argument('--graceful-timeout', type=float,
+                   default=float(os.environ.get('SERVER_GRACEFUL_TIMEOUT', '30')),
+                   help='Seconds a stopping worker gets to finish in-flight requests')
+    p.add_argument('--backlog', type=int, default=2048)
+    p.add_argument('--quiet', action='store_true', help='No per-request access log')
+    cfg = p.parse_args(argv)
+    host, _, port = cfg.bind.rpartition(':')
+    cfg.host, cfg.port = host or '0.0.0.0', int(port)
+    return cfg
+
+
+def load_app():
+    """Import server.py without its import-time startup; returns (module, ms)."""
+    os.environ['LAB_DEFER_STARTUP'] = '1'
+    if HERE not in sys.path:
+        sys.path.insert(0, HERE)
+    start = time.perf_counter()
+    import server
+    return server, (time.perf_counter() - start) * 1000
+
+
+# ----- Worker -----
+
+def run_worker(cfg, index, sock, forked_at, server=None):
+    for sig in (signal.SIGHUP, signal.SIGINT, signal.SIGCHLD):
+        signal.signal(sig, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)   # Ctrl-C reaches the whole group; the master coordinates
+    import_ms = 0.0
+    if server is None:
+        server, import_ms = load_app()
+    server.after_fork(index)
+    from werkzeug.serving import ThreadedWSGIServer
+    httpd = ThreadedWSGIServer(cfg.host, cfg.port, server.app, fd=sock.fileno())
+    httpd.daemon_threads = False   # keep track of request threads so stop can wait for them
+    if cfg.quiet:
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    stopping = threading.Event()
+    def stop(signum, frame):
+        if not stopping.is_set():
+            stopping.set()
+            # shutdown() waits for serve_forever to notice, so not from this (its) thread
+            threading.Thread(target=httpd.shutdown, daemon=True).start()
+    signal.signal(signal.SIGTERM, stop)
+
+    ready_ms = (time.perf_counter() - forked_at) * 1000
+    log(f"worker {index} ready in {ready_ms:.1f} ms" + (f" (app import {import_ms:.1f} ms)" if import_ms else ""))
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.socket.close()
+        # Let in-flight requests finish (long polls end within their wait; /events
+        # streams never do, so they're cut off at the deadline)
+        deadline = time.time() + cfg.graceful_timeout
+        for t in list(vars(httpd).get('_threads', ())):   # set by ThreadingMixIn on the first request
+            t.join(max(0.0, deadline - time.time()))
+        log(f"worker {index} stopped")
+        os._exit(0)
+
+
+# ----- Master -----
+
+class Master:
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.server = None
+        self.sock = None
+        self.workers = {}        # pid -> (index, generation)
+        self.generation = 0
+        self.reloading = False
+        self.stopping = False
+
+    def start(self):
+        t0 = time.perf_counter()
+        server, import_ms = load_app()
+        init_start = time.perf_counter()
+        server.init_db()        # once, here, rather than racing in every worker
+        init_ms = (time.perf_counter() - init_start) * 1000
+        server.close_db_pool()
+        if self.cfg.preload:
+            self.server = server
+        else:
+            # Workers import their own (possibly updated) copy
+            del sys.modules['server']
+        self.sock = socket.create_server((self.cfg.host, self.cfg.port), backlog=self.cfg.backlog)
+        self.sock.set_inheritable(True)
+        log(f"master: app import {import_ms:.1f} ms, schema init {init_ms:.1f} ms, "
+            f"listening on {self.cfg.host}:{self.cfg.port}, preload={'on' if self.cfg.preload else 'off'}")
+        for i in range(self.cfg.workers):
+            self.spawn(i)
+        log(f"master: {self.cfg.workers} workers forked, cold start {(time.perf_counter() - t0) * 1000:.1f} ms")
+
+    def spawn(self, index):
+        forked_at = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(self.cfg, index, self.sock, forked_at, self.server)
+            except BaseException as e:
+                log(f"worker {index} crashed: {e!r}")
+            finally:
+                os._exit(1)
+        self.workers[pid] = (index, self.generation)
+
+    def reload(self):
+        old = [pid for pid, (_, gen) in self.workers.items() if gen == self.generation]
+        self.generation += 1
+        log(f"master: reload, starting generation {self.generation}")
+        for i in range(self.cfg.workers):
+            self.spawn(i)
+        for pid in old:
+            self.kill(pid, signal.SIGTERM)
+
+    def kill(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            index, gen = self.workers.pop(pid, (None, None))
+            if index is not None and gen == self.generation and not self.stopping:
+                log(f"master: worker {index} (pid {pid}) exited with {status}, restarting")
+                time.sleep(0.5)   # don't spin if workers die on startup
+                self.spawn(index)
+
+    def run(self):
+        signal.signal(signal.SIGHUP, lambda *a: setattr(self, 'reloading', True))
+        signal.signal(signal.SIGTERM, lambda *a: setattr(self, 'stopping', True))
+        signal.signal(signal.SIGINT, lambda *a: setattr(self, 'stopping', True))
+        self.start()
+        while not self.stopping:
+            if self.reloading:
+                self.reloading = False
+                self.reload()
+            self.reap()
+            time.sleep(0.2)
+        log("master: shutting down")
+        for pid in list(self.workers):
+            self.kill(pid, signal.SIGTERM)
+        deadline = time.time() + self.cfg.graceful_timeout + 5
+        while self.workers and time.time() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in list(self.workers):
+            self.kill(pid, signal.SIGKILL)
+        self.sock.close()
+
+
+def main():
+    if not hasattr(os, 'fork'):
+        sys.exit('serve.py needs fork() (Linux/macOS); on Windows run server.py')
+    Master(parse_config()).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,77 +1,786 @@
-from flask import Flask, request, jsonify, render_template, redirect, url_for, flash, session
+from flask import Flask, Request, Response, request, jsonify, render_template, redirect, url_for, flash, session, send_from_directory, abort, g
 from flask_cors import CORS
-import time, os, sqlite3, random, string, smtplib
+import time, os, sqlite3, random, string, smtplib, queue, threading, json, fnmatch, hashlib, hmac, re, tempfile, bisect, heapq, mmap, struct, base64, gzip, multiprocessing
+from contextlib import contextmanager
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from werkzeug.security import generate_password_hash, check_password_hash
+from concurrent.futures import ProcessPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType, ServiceUnavailable
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows: the heartbeat file is only safe with a single process
+
+try:
+    from PIL import Image
+except Exception:
+    Image = None  # thumbnails disabled; dashboards fall back to the full image
 
 app = Flask(__name__)
 CORS(app)
 app.secret_key = "super-secret-key"
 
 commands = {}
-heartbeats = {}
 os.makedirs("static/screenshots", exist_ok=True)
 
+# serve.py sets this so importing the app (once, in the prefork master) has no
+# side effects: it initializes the schema itself and each worker starts its
+# background threads through after_fork(). Password hashing processes import
+# this file as __mp_main__ and must not start anything either.
+DEFER_STARTUP = os.environ.get("LAB_DEFER_STARTUP") == "1" or __name__ == "__mp_main__"
+
 DB = "users.db"
-CODE_STORE = {}
 CODE_EXPIRY = 600
 
-def init_db():
-    conn = sqlite3.connect(DB)
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT,
-            email TEXT UNIQUE,
-            password TEXT,
-            role TEXT DEFAULT 'Teacher',
-            approved INTEGER DEFAULT 0
-        )
-    ''')
-    # Commands table for server-client actions
+# ----- Metrics -----
+# In-process counters and histograms, rendered in Prometheus text format by
+# /metrics. Recording is a bisect plus a few integer adds under one lock, cheap
+# enough to leave on. With several worker processes each reports its own.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SQL_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1)
+
+_metrics_lock = threading.Lock()
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.series = {}   # label tuple -> [per-bucket counts..., +Inf count, sum]
+
+    def observe(self, labels, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with _metrics_lock:
+            row = self.series.get(labels)
+            if row is None:
+                row = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            row[i] += 1
+            row[-1] += value
+
+class Counter:
+    def __init__(self):
+        self.series = {}   # label tuple -> value
+
+    def inc(self, labels=(), amount=1):
+        with _metrics_lock:
+            self.series[labels] = self.series.get(labels, 0) + amount
+
+http_requests = Counter()                        # (route, method, status)
+http_latency = Histogram(LATENCY_BUCKETS)        # (route, method)
+sql_latency = Histogram(SQL_BUCKETS)             # (statement verb,)
+screenshot_bytes = Counter()
+screenshot_uploads = Counter()                   # (result,) stored / unchanged
+page_cache = Counter()                           # (page, result) hit / miss
+
+def _sql_verb(sql):
+    return sql.lstrip()[:6].rstrip().upper()
+
+class MetricsCursor(sqlite3.Cursor):
+    def execute(self, sql, *params):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, *params)
+        finally:
+            sql_latency.observe((_sql_verb(sql),), time.perf_counter() - start)
+
+    def executemany(self, sql, seq):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq)
+        finally:
+            sql_latency.observe((_sql_verb(sql),), time.perf_counter() - start)
+
+class MetricsConnection(sqlite3.Connection):
+    """Connection whose statements are timed into sql_latency."""
+    def cursor(self, factory=MetricsCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, *params):
+        return self.cursor().execute(sql, *params)
+
+    def executemany(self, sql, seq):
+        return self.cursor().executemany(sql, seq)
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def _record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        # Label by URL rule, not path, so per-client URLs don't explode cardinality
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        http_latency.observe((route, request.method), time.perf_counter() - started)
+        http_requests.inc((route, request.method, str(response.status_code)))
+    return response
+
+def _label_value(v):
+    return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values, extra=''):
+    parts = [f'{n}="{_label_value(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+def render_metrics(gauges):
+    """Prometheus text exposition of the recorded metrics plus `gauges`, a
+    list of (name, help, label names, {label tuple: value})."""
+    out = []
+    def header(name, help_text, kind):
+        out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} {kind}")
+    with _metrics_lock:
+        counters = [("lab_http_requests_total", "HTTP requests by route, method and status.",
+                     ("route", "method", "status"), dict(http_requests.series)),
+                    ("lab_screenshot_bytes_received_total", "Screenshot image bytes received.",
+                     (), dict(screenshot_bytes.series)),
+                    ("lab_screenshot_uploads_total", "Screenshot uploads, stored or acknowledged unchanged.",
+                     ("result",), dict(screenshot_uploads.series)),
+                    ("lab_page_cache_total", "Cached page renders served (hit) or rebuilt (miss).",
+                     ("page", "result"), dict(page_cache.series))]
+        histograms = [("lab_http_request_duration_seconds", "HTTP request latency by route and method.",
+                       ("route", "method"), http_latency),
+                      ("lab_sqlite_query_duration_seconds", "SQLite statement execution time by statement verb.",
+                       ("op",), sql_latency)]
+        histograms = [(n, h, l, hist.buckets, {k: list(v) for k, v in hist.series.items()})
+                      for n, h, l, hist in histograms]
+    for name, help_text, names, series in counters:
+        header(name, help_text, "counter")
+        for labels, value in sorted(series.items()):
+            out.append(f"{name}{_labels(names, labels)} {value}")
+    for name, help_text, names, buckets, series in histograms:
+        header(name, help_text, "histogram")
+        for labels, row in sorted(series.items()):
+            cumulative = 0
+            for le, count in zip(buckets + ('+Inf',), row[:-1]):
+                cumulative += count
+                bucket_labels = _labels(names, labels, 'le="%s"' % le)
+                out.append(f"{name}_bucket{bucket_labels} {cumulative}")
+            out.append(f"{name}_sum{_labels(names, labels)} {row[-1]:.6f}")
+            out.append(f"{name}_count{_labels(names, labels)} {cumulative}")
+    for name, help_text, names, series in gauges:
+        header(name, help_text, "gauge")
+        for labels, value in sorted(series.items()):
+            out.append(f"{name}{_labels(names, labels)} {value}")
+    return "\n".join(out) + "\n"
+
+# ----- Database connections -----
+# Connections are long-lived and shared through a small pool instead of being
+# opened per request. WAL lets the many /poll-commands readers run alongside a
+# writer, and the busy timeout makes writers wait instead of failing with
+# "database is locked".
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "8"))
+DB_BUSY_TIMEOUT = float(os.environ.get("DB_BUSY_TIMEOUT", "5"))       # seconds
+DB_CACHE_KB = int(os.environ.get("DB_CACHE_KB", "16384"))             # page cache per connection
+DB_MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+DB_SYNCHRONOUS = os.environ.get("DB_SYNCHRONOUS", "NORMAL")
+
+_db_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+def open_db():
+    conn = sqlite3.connect(DB, timeout=DB_BUSY_TIMEOUT, check_same_thread=False, factory=MetricsConnection)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_KB}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    conn.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT * 1000)}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+@contextmanager
+def get_db():
+    """Borrow a pooled connection; commits on success, rolls back on error.
+    DB_POOL_SIZE caps the idle connections kept open, a burst beyond it gets a
+    temporary connection that is closed afterwards."""
+    try:
+        conn = _db_pool.get_nowait()
+    except queue.Empty:
+        conn = open_db()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        try:
+            _db_pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+# ----- Command queue schema -----
+CMD_PENDING = 0
+CMD_DONE = 1
+CMD_FAILED = 2
+CMD_IN_FLIGHT = 3    # handed to an agent, owned by it until lease_expires
+CMD_STATUS = {CMD_PENDING: 'pending', CMD_DONE: 'done', CMD_FAILED: 'failed', CMD_IN_FLIGHT: 'in_flight'}
+# What an agent may report: it can only finish a command, pending and
+# in-flight belong to the lease machinery
+CMD_RESULT_CODES = {'done': CMD_DONE, 'ok': CMD_DONE, 'failed': CMD_FAILED, 'error': CMD_FAILED}
+
+COMMANDS_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS commands (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        client_id TEXT NOT NULL,
+        command TEXT NOT NULL,
+        args TEXT,
+        status INTEGER NOT NULL DEFAULT 0,
+        result TEXT,
+        created_at REAL,
+        updated_at REAL,
+        lease_expires REAL,
+        attempts INTEGER NOT NULL DEFAULT 0
+    )
+'''
+
+# Claim-on-read: a poll moves the commands it returns to in-flight for
+# COMMAND_LEASE seconds. If the agent hasn't posted a result by then the
+# command is handed out again, up to COMMAND_MAX_ATTEMPTS deliveries.
+COMMAND_LEASE = float(os.environ.get("COMMAND_LEASE", "60"))
+COMMAND_MAX_ATTEMPTS = int(os.environ.get("COMMAND_MAX_ATTEMPTS", "3"))
+
+def status_code(name):
+    """Map a status string reported by an agent to CMD_DONE or CMD_FAILED
+    (default done); None when it isn't a final status."""
+    if name is None:
+        return CMD_DONE
+    return CMD_RESULT_CODES.get(name.lower()) if isinstance(name, str) else None
+
+def _commands_has_text_status(c):
+    cols = {row[1]: row[2] for row in c.execute("PRAGMA table_info(commands)")}
+    return cols.get('status', '').upper() == 'TEXT'
+
+def _migrate_commands_table(c):
+    # Old layout stored status as free text ('pending', 'done', ...). Rebuild
+    # the table with integer codes, keeping ids so agents' in-flight acks match.
+    print('Migrating commands table to integer status codes')
+    c.execute("ALTER TABLE commands RENAME TO commands_text_status")
+    c.execute(COMMANDS_SCHEMA)
     c.execute('''
-        CREATE TABLE IF NOT EXISTS commands (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            client_id TEXT,
-            command TEXT,
-            args TEXT,
-            status TEXT DEFAULT 'pending',
-            result TEXT,
-            created_at REAL,
-            updated_at REAL
-        )
-    ''')
-    conn.commit()
-    conn.close()
-
-init_db()
+        INSERT INTO commands (id, client_id, command, args, status, result, created_at, updated_at)
+        SELECT id, COALESCE(client_id, ''), COALESCE(command, ''), args,
+               CASE lower(COALESCE(status, 'pending'))
+                   WHEN 'pending' THEN ? WHEN 'failed' THEN ? WHEN 'error' THEN ? ELSE ? END,
+               result, created_at, updated_at
+        FROM commands_text_status
+    ''', (CMD_PENDING, CMD_FAILED, CMD_FAILED, CMD_DONE))
+    c.execute("DROP TABLE commands_text_status")
+
+def _add_lease_columns(c):
+    cols = {row[1] for row in c.execute("PRAGMA table_info(commands)")}
+    if 'lease_expires' not in cols:
+        c.execute("ALTER TABLE commands ADD COLUMN lease_expires REAL")
+    if 'attempts' not in cols:
+        c.execute("ALTER TABLE commands ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+
+def init_db():
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT,
+                email TEXT UNIQUE,
+                password TEXT,
+                role TEXT DEFAULT 'Teacher',
+                approved INTEGER DEFAULT 0
+            )
+        ''')
+        # Commands table for server-client actions. Status is an integer code
+        # (see CMD_STATUS) and pending rows are served from a partial covering
+        # index, so a poll only touches the rows still queued for that client.
+        # Queries must spell the pending code as a literal for SQLite to pick
+        # the partial index, a bound parameter falls back to a table scan.
+        if _commands_has_text_status(c):
+            _migrate_commands_table(c)
+        c.execute(COMMANDS_SCHEMA)
+        _add_lease_columns(c)
+        c.execute('''
+            CREATE INDEX IF NOT EXISTS idx_commands_pending
+            ON commands (client_id, id, command, args, created_at, status)
+            WHERE status = 0
+        ''')
+        c.execute('''
+            CREATE INDEX IF NOT EXISTS idx_commands_in_flight
+            ON commands (client_id, lease_expires, command, status)
+            WHERE status = 3
+        ''')
+        # Finished rows by age, for the retention thread
+        c.execute(f'''
+            CREATE INDEX IF NOT EXISTS idx_commands_finished
+            ON commands (updated_at)
+            WHERE status IN ({CMD_DONE},{CMD_FAILED})
+        ''')
+        # Labs: named groups of client ids that commands can be broadcast to
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS labs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL UNIQUE,
+                created_at REAL
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS lab_members (
+                lab_id INTEGER NOT NULL REFERENCES labs(id) ON DELETE CASCADE,
+                client_id TEXT NOT NULL,
+                PRIMARY KEY (lab_id, client_id)
+            ) WITHOUT ROWID
+        ''')
+        # Per-client daily rollups of commands removed by the retention pass
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS command_daily_summary (
+                client_id TEXT NOT NULL,
+                day TEXT NOT NULL,
+                command TEXT NOT NULL,
+                done INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (client_id, day, command)
+            ) WITHOUT ROWID
+        ''')
+        # Perceptual hash of each client's latest uploaded screenshot
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS screenshot_phash (
+                client_id TEXT PRIMARY KEY,
+                phash TEXT NOT NULL,
+                updated_at REAL
+            ) WITHOUT ROWID
+        ''')
+        # Screenshot history: one row per upload, files are content-addressed
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS screenshots (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                client_id TEXT NOT NULL,
+                taken_at REAL NOT NULL,
+                hash TEXT NOT NULL,
+                format TEXT NOT NULL,
+                size INTEGER NOT NULL
+            )
+        ''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_screenshots_client ON screenshots (client_id, taken_at)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_screenshots_hash ON screenshots (hash)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_screenshots_taken ON screenshots (taken_at)")
+        # Password-reset codes for SQLiteCodeStore
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS verification_codes (
+                email TEXT PRIMARY KEY,
+                code TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0
+            ) WITHOUT ROWID
+        ''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_verification_codes_expiry ON verification_codes (expires_at)")
+        # Outgoing mail, drained by the outbox sender thread. Rows are deleted
+        # once sent; ones that exhaust their retries stay as status=1 (failed).
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS email_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                to_email TEXT NOT NULL,
+                subject TEXT NOT NULL,
+                html TEXT NOT NULL,
+                status INTEGER NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                created_at REAL NOT NULL,
+                last_error TEXT
+            )
+        ''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_email_outbox_due ON email_outbox (next_attempt_at, id) WHERE status=0")
+        # Dashboard events, tailed by every worker's event pump
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at REAL NOT NULL,
+                event TEXT NOT NULL,
+                data TEXT NOT NULL,
+                dedupe TEXT UNIQUE
+            )
+        ''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_events_created ON events (created_at)")
+        # Latest telemetry per client, whichever worker took the sync
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS client_telemetry (
+                client_id TEXT PRIMARY KEY,
+                received_at REAL NOT NULL,
+                data TEXT NOT NULL
+            ) WITHOUT ROWID
+        ''')
+        auto_vacuum = c.execute("PRAGMA auto_vacuum").fetchone()[0]
+    if auto_vacuum != 2:
+        # Incremental auto-vacuum lets the retention thread hand free pages
+        # back to the filesystem a few at a time. Switching an existing file
+        # needs one full VACUUM, outside any transaction.
+        print('Enabling incremental auto-vacuum on', DB)
+        with get_db() as conn:
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+
+if not DEFER_STARTUP:
+    init_db()
+
+# ----- Command history retention -----
+# Finished commands older than COMMAND_RETENTION_DAYS are moved out of the hot
+# table by a background thread: copied to COMMAND_ARCHIVE_DB (a separate
+# SQLite file, "" keeps no raw copy), optionally rolled up into
+# command_daily_summary, then deleted, followed by an incremental vacuum.
+# Each batch of RETENTION_BATCH ids is picked from idx_commands_finished
+# before the write lock is taken, so polls and result writes only ever wait
+# for the short archive-and-delete transaction.
+COMMAND_RETENTION_DAYS = float(os.environ.get("COMMAND_RETENTION_DAYS", "7"))
+COMMAND_ARCHIVE_DB = os.environ.get("COMMAND_ARCHIVE_DB", "commands_archive.db")
+COMMAND_DAILY_SUMMARY = os.environ.get("COMMAND_DAILY_SUMMARY", "1").lower() in ("1", "true", "yes")
+RETENTION_INTERVAL = float(os.environ.get("RETENTION_INTERVAL", "3600"))   # seconds; 0 disables the thread
+RETENTION_BATCH = int(os.environ.get("RETENTION_BATCH", "2000"))
+RETENTION_VACUUM_PAGES = int(os.environ.get("RETENTION_VACUUM_PAGES", "2000"))
+
+_retention_thread = None
+
+def _retention_db():
+    # A dedicated connection: the archive is ATTACHed, which pooled ones must not carry
+    conn = open_db()
+    if COMMAND_ARCHIVE_DB:
+        conn.execute("ATTACH DATABASE ? AS archive", (COMMAND_ARCHIVE_DB,))
+        conn.execute("PRAGMA archive.journal_mode=WAL")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS archive.commands (
+                id INTEGER PRIMARY KEY,
+                client_id TEXT NOT NULL,
+                command TEXT NOT NULL,
+                args TEXT,
+                status INTEGER NOT NULL,
+                result TEXT,
+                created_at REAL,
+                updated_at REAL,
+                attempts INTEGER,
+                archived_at REAL
+            )
+        ''')
+        conn.commit()
+    return conn
+
+def run_retention(cutoff=None):
+    """Archive and delete finished commands last updated before `cutoff`
+    (default: COMMAND_RETENTION_DAYS ago). Returns the number of rows moved."""
+    if cutoff is None:
+        cutoff = time.time() - COMMAND_RETENTION_DAYS * 86400
+    moved = 0
+    conn = _retention_db()
+    try:
+        while True:
+            ids = [r[0] for r in conn.execute(
+                f"SELECT id FROM commands WHERE status IN ({CMD_DONE},{CMD_FAILED}) AND updated_at<? "
+                f"ORDER BY updated_at LIMIT ?", (cutoff, RETENTION_BATCH))]
+            if not ids:
+                break
+            conn.execute("BEGIN IMMEDIATE")
+            # A late result may have touched a row since it was picked
+            marks = ','.join('?' * len(ids))
+            ids = [r[0] for r in conn.execute(
+                f"SELECT id FROM commands WHERE id IN ({marks}) AND status IN ({CMD_DONE},{CMD_FAILED}) AND updated_at<?",
+                (*ids, cutoff))]
+            marks = ','.join('?' * len(ids))
+            if COMMAND_ARCHIVE_DB:
+                # OR IGNORE: commits across attached WAL files aren't atomic as
+                # a set, so a batch may be replayed after a crash
+                conn.execute(f'''
+                    INSERT OR IGNORE INTO archive.commands
+                        (id, client_id, command, args, status, result, created_at, updated_at, attempts, archived_at)
+                    SELECT id, client_id, command, args, status, result, created_at, updated_at, attempts, ?
+                    FROM commands WHERE id IN ({marks})
+                ''', (time.time(), *ids))
+            if COMMAND_DAILY_SUMMARY:
+                conn.execute(f'''
+                    INSERT INTO command_daily_summary (client_id, day, command, done, failed)
+                    SELECT client_id, date(updated_at, 'unixepoch'), command,
+                           sum(status={CMD_DONE}), sum(status={CMD_FAILED})
+                    FROM commands WHERE id IN ({marks}) GROUP BY 1, 2, 3
+                    ON CONFLICT (client_id, day, command)
+                    DO UPDATE SET done = done + excluded.done, failed = failed + excluded.failed
+                ''', ids)
+            conn.execute(f"DELETE FROM commands WHERE id IN ({marks})", ids)
+            conn.commit()
+            moved += len(ids)
+        if moved:
+            conn.execute(f"PRAGMA incremental_vacuum({RETENTION_VACUUM_PAGES})").fetchall()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return moved
+
+def _retention_loop():
+    while True:
+        try:
+            moved = run_retention()
+            if moved:
+                print(f'Retention: archived {moved} commands older than {COMMAND_RETENTION_DAYS} days')
+            pruned = prune_screenshots(cutoff=time.time() - SCREENSHOT_HISTORY_DAYS * 86400)
+            if pruned:
+                print(f'Retention: removed {pruned} screenshots older than {SCREENSHOT_HISTORY_DAYS} days')
+        except Exception as e:
+            print('Retention pass failed:', e)
+        time.sleep(RETENTION_INTERVAL)
+
+def start_retention():
+    global _retention_thread
+    if RETENTION_INTERVAL > 0 and _retention_thread is None:
+        _retention_thread = threading.Thread(target=_retention_loop, daemon=True)
+        _retention_thread.start()
+
+if not DEFER_STARTUP:
+    start_retention()
 
 def password_valid(password):
-    import re
     pattern = r'^(?=.*[a-z])(?=.*[A-Z])(?=.*\d)(?=.*[!@#$%^&*]).{8,}$'
     return re.match(pattern, password)
 
+# ----- Password hashing -----
+# The KDF is deliberately slow, so it runs in a small process pool instead of
+# on the request thread, where a burst of logins would starve the
+# poll/heartbeat traffic sharing the worker. PASSWORD_HASH_QUEUE caps the
+# hashes waiting or running; beyond that a login waits up to
+# PASSWORD_HASH_WAIT seconds for a slot and then gets a 503.
+# PASSWORD_HASH_METHOD takes werkzeug's method syntax; stored hashes made with
+# other parameters are upgraded on the next successful login.
+PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", f"pbkdf2:sha256:{DEFAULT_PBKDF2_ITERATIONS}")
+PASSWORD_SALT_LENGTH = int(os.environ.get("PASSWORD_SALT_LENGTH", "16"))
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))  # 0 hashes inline
+PASSWORD_HASH_QUEUE = int(os.environ.get("PASSWORD_HASH_QUEUE", str(max(1, PASSWORD_HASH_WORKERS) * 8)))
+PASSWORD_HASH_WAIT = float(os.environ.get("PASSWORD_HASH_WAIT", "10"))
+
+_hash_pool = None
+_hash_pool_pid = None
+_hash_pool_lock = threading.Lock()
+_hash_slots = threading.BoundedSemaphore(PASSWORD_HASH_QUEUE)
+
+def _full_hash_method(method):
+    # werkzeug fills in defaults for a bare "pbkdf2" / "scrypt"; spell them out
+    # so the method can be compared with the prefix of a stored hash
+    name, *args = method.split(":")
+    if name == "pbkdf2":
+        return ":".join(["pbkdf2", args[0] if args else "sha256",
+                         args[1] if len(args) > 1 else str(DEFAULT_PBKDF2_ITERATIONS)])
+    if name == "scrypt":
+        return ":".join(["scrypt"] + (args + ["32768", "8", "1"][len(args):]))
+    return method
+
+PASSWORD_HASH_METHOD = _full_hash_method(PASSWORD_HASH_METHOD)
+
+def _hash_mp_context():
+    # Not fork: forking this multi-threaded server could copy a lock some
+    # other thread holds. The fork server starts clean and doesn't preload the app.
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context("forkserver")
+        ctx.set_forkserver_preload([])
+        return ctx
+    return multiprocessing.get_context("spawn")
+
+def _hash_executor():
+    global _hash_pool, _hash_pool_pid
+    with _hash_pool_lock:
+        # Created lazily, and again in a forked worker: a pool doesn't survive fork
+        if _hash_pool is None or _hash_pool_pid != os.getpid():
+            _hash_pool = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, mp_context=_hash_mp_context())
+            _hash_pool_pid = os.getpid()
+        return _hash_pool
+
+def _run_hash(fn, *args):
+    if PASSWORD_HASH_WORKERS <= 0:
+        return fn(*args)
+    if not _hash_slots.acquire(timeout=PASSWORD_HASH_WAIT):
+        raise ServiceUnavailable("Too many sign-ins in progress, try again in a moment.")
+    try:
+        return _hash_executor().submit(fn, *args).result()
+    finally:
+        _hash_slots.release()
+
+def hash_password(password):
+    return _run_hash(generate_password_hash, password, PASSWORD_HASH_METHOD, PASSWORD_SALT_LENGTH)
+
+def verify_password(stored_hash, password):
+    if "$" not in (stored_hash or ""):
+        return False   # not a werkzeug hash (legacy plaintext is handled by login)
+    try:
+        return _run_hash(check_password_hash, stored_hash, password)
+    except ServiceUnavailable:
+        raise
+    except Exception:
+        return False
+
+def password_needs_rehash(stored_hash):
+    return stored_hash.split("$", 1)[0] != PASSWORD_HASH_METHOD
+
+# ----- Email outbox -----
+# Routes never talk to SMTP: send_email() inserts into email_outbox and wakes
+# the sender thread, which drains due rows in batches over one SMTP connection
+# (kept open for SMTP_IDLE_CLOSE seconds between batches). A failed message is
+# retried with exponential backoff up to OUTBOX_MAX_ATTEMPTS times. Each batch
+# is claimed by pushing its next_attempt_at out by OUTBOX_CLAIM seconds, so
+# several worker processes can run senders without mailing anything twice.
+SMTP_SERVER = os.environ.get('SMTP_SERVER', 'smtp.gmail.com')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', 587))
+SMTP_USER = os.environ.get('SMTP_USER')
+SMTP_PASS = os.environ.get('SMTP_PASS')
+SMTP_FROM = os.environ.get('SMTP_FROM') or SMTP_USER or 'slmms@localhost'
+SMTP_STARTTLS = os.environ.get('SMTP_STARTTLS', '1') == '1'   # 0 for a local debug server
+SMTP_TIMEOUT = float(os.environ.get('SMTP_TIMEOUT', '20'))
+SMTP_IDLE_CLOSE = float(os.environ.get('SMTP_IDLE_CLOSE', '60'))
+OUTBOX_BATCH = int(os.environ.get('OUTBOX_BATCH', '50'))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '6'))
+OUTBOX_BACKOFF = float(os.environ.get('OUTBOX_BACKOFF', '30'))          # first retry delay, doubles each time
+OUTBOX_BACKOFF_MAX = float(os.environ.get('OUTBOX_BACKOFF_MAX', '3600'))
+OUTBOX_CLAIM = 300
+OUTBOX_POLL = float(os.environ.get('OUTBOX_POLL', '30'))   # 0 disables the sender thread
+OUTBOX_PENDING = 0
+OUTBOX_FAILED = 1
+
+_outbox_wake = threading.Event()
+_outbox_thread = None
+
+def smtp_configured():
+    # Credentials, or an explicit SMTP_SERVER (e.g. an unauthenticated local relay)
+    return bool(SMTP_USER and SMTP_PASS) or 'SMTP_SERVER' in os.environ
+
 def send_email(to_email, subject, html_content):
-    # Load SMTP config from environment variables for security
-    smtp_server = os.environ.get('SMTP_SERVER', 'smtp.gmail.com')
-    smtp_port = int(os.environ.get('SMTP_PORT', 587))
-    smtp_user = os.environ.get('SMTP_USER')
-    smtp_pass = os.environ.get('SMTP_PASS')
-    if not smtp_user or not smtp_pass:
-        # skip sending if not configured
+    """Queue an email for the outbox sender; returns immediately."""
+    if not smtp_configured():
         print('SMTP not configured; skipping email to', to_email)
-        return
-    msg = MIMEMultipart('alternative')
-    msg['From'] = smtp_user
-    msg['To'] = to_email
-    msg['Subject'] = subject
-    msg.attach(MIMEText(html_content, 'html'))
-    with smtplib.SMTP(smtp_server, smtp_port) as server:
-        server.starttls()
-        server.login(smtp_user, smtp_pass)
-        server.send_message(msg)
+        return None
+    now = time.time()
+    with get_db() as conn:
+        cur = conn.execute("INSERT INTO email_outbox (to_email, subject, html, next_attempt_at, created_at) "
+                           "VALUES (?,?,?,?,?)", (to_email, subject, html_content, now, now))
+    _outbox_wake.set()
+    return cur.lastrowid
+
+def _smtp_connect():
+    smtp = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=SMTP_TIMEOUT)
+    if SMTP_STARTTLS:
+        smtp.starttls()
+    if SMTP_USER and SMTP_PASS:
+        smtp.login(SMTP_USER, SMTP_PASS)
+    return smtp
+
+def _smtp_close(smtp):
+    try:
+        smtp.quit()
+    except Exception:
+        pass
+
+def _claim_outbox_batch():
+    due = (f"SELECT id, to_email, subject, html, attempts FROM email_outbox WHERE status={OUTBOX_PENDING} "
+           "AND next_attempt_at<=? ORDER BY next_attempt_at, id LIMIT ?")
+    now = time.time()
+    with get_db() as conn:
+        # Only take the write lock when something is due
+        if not conn.execute(due, (now, 1)).fetchone():
+            return []
+        conn.execute("BEGIN IMMEDIATE")
+        rows = conn.execute(due, (now, OUTBOX_BATCH)).fetchall()
+        conn.executemany("UPDATE email_outbox SET next_attempt_at=? WHERE id=?",
+                         [(now + OUTBOX_CLAIM, r[0]) for r in rows])
+    return rows
+
+def _send_outbox_batch(smtp, rows):
+    """Send claimed rows over `smtp` (reconnecting once if the server dropped
+    us). Returns the connection to keep using, or None."""
+    sent, retry = [], []
+    down = None   # set once the server is unreachable; the rest of the batch backs off too
+    for row_id, to_email, subject, html, attempts in rows:
+        if down is not None:
+            retry.append((row_id, attempts, down))
+            continue
+        msg = MIMEMultipart('alternative')
+        msg['From'] = SMTP_FROM
+        msg['To'] = to_email
+        msg['Subject'] = subject
+        msg.attach(MIMEText(html, 'html'))
+        try:
+            if smtp is not None:
+                try:
+                    smtp.send_message(msg)
+                    sent.append((row_id,))
+                    continue
+                except smtplib.SMTPServerDisconnected:
+                    _smtp_close(smtp)   # server closed the idle connection; open a new one
+                    smtp = None
+            smtp = _smtp_connect()
+            smtp.send_message(msg)
+            sent.append((row_id,))
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+            retry.append((row_id, attempts, repr(e)))   # this message only, keep the connection
+        except Exception as e:
+            retry.append((row_id, attempts, repr(e)))
+            down = repr(e)
+            if smtp is not None:
+                _smtp_close(smtp)
+            smtp = None
+    now = time.time()
+    with get_db() as conn:
+        conn.executemany("DELETE FROM email_outbox WHERE id=?", sent)
+        for row_id, attempts, error in retry:
+            attempts += 1
+            if attempts >= OUTBOX_MAX_ATTEMPTS:
+                conn.execute(f"UPDATE email_outbox SET status={OUTBOX_FAILED}, attempts=?, last_error=? WHERE id=?",
+                             (attempts, error, row_id))
+                print('Email', row_id, 'failed permanently:', error)
+            else:
+                delay = min(OUTBOX_BACKOFF * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX) * random.uniform(0.8, 1.2)
+                conn.execute("UPDATE email_outbox SET attempts=?, last_error=?, next_attempt_at=? WHERE id=?",
+                             (attempts, error, now + delay, row_id))
+    return smtp
+
+def drain_outbox():
+    """Send everything that is due; returns how many rows were attempted."""
+    smtp = None
+    attempted = 0
+    try:
+        while True:
+            rows = _claim_outbox_batch()
+            if not rows:
+                return attempted
+            attempted += len(rows)
+            smtp = _send_outbox_batch(smtp, rows)
+    finally:
+        if smtp is not None:
+            _smtp_close(smtp)
+
+def _outbox_loop():
+    smtp = None
+    idle_since = time.time()
+    while True:
+        try:
+            rows = _claim_outbox_batch()
+            if rows:
+                smtp = _send_outbox_batch(smtp, rows)
+                idle_since = time.time()
+                continue
+            with get_db() as conn:
+                next_due = conn.execute(f"SELECT min(next_attempt_at) FROM email_outbox "
+                                        f"WHERE status={OUTBOX_PENDING}").fetchone()[0]
+        except Exception as e:
+            print('Email outbox pass failed:', e)
+            next_due = None
+        wait = OUTBOX_POLL if next_due is None else min(OUTBOX_POLL, max(0.0, next_due - time.time()))
+        if smtp is not None:
+            if time.time() - idle_since >= SMTP_IDLE_CLOSE:
+                _smtp_close(smtp)
+                smtp = None
+            else:
+                wait = min(wait, SMTP_IDLE_CLOSE)
+        _outbox_wake.wait(wait)
+        _outbox_wake.clear()
+
+def start_outbox():
+    global _outbox_thread
+    if OUTBOX_POLL > 0 and _outbox_thread is None:
+        _outbox_thread = threading.Thread(target=_outbox_loop, daemon=True)
+        _outbox_thread.start()
+
+if not DEFER_STARTUP:
+    start_outbox()
 
 def send_verification_email(to_email, code):
     html_content = f"""
@@ -94,6 +803,893 @@ def send_rejection_email(to_email, reason):
     """
     send_email(to_email, "SLMMS Account Rejection", html_content)
 
+# ----- Verification codes -----
+# Password-reset codes live in CODE_STORE, which expires them after
+# CODE_EXPIRY seconds and invalidates a code after CODE_MAX_ATTEMPTS wrong
+# guesses. CODE_STORE_BACKEND picks the implementation: "sqlite" (default)
+# shares codes between worker processes, "memory" keeps them in this process
+# and sweeps expired entries from a background thread.
+CODE_MAX_ATTEMPTS = int(os.environ.get("CODE_MAX_ATTEMPTS", "5"))
+CODE_SWEEP_INTERVAL = 60
+
+CODE_OK = "ok"
+CODE_INVALID = "invalid"      # wrong code, attempts remain
+CODE_EXPIRED = "expired"      # no code, or it timed out
+CODE_LOCKED = "locked"        # too many wrong guesses; the code is gone
+
+def _code_matches(stored, code):
+    # As bytes: compare_digest rejects str holding non-ASCII characters
+    return hmac.compare_digest(stored.encode(), (code or "").encode())
+
+class MemoryCodeStore:
+    def __init__(self, ttl=CODE_EXPIRY, max_attempts=CODE_MAX_ATTEMPTS):
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self._codes = {}   # email -> [code, expires_at, attempts]
+        self._lock = threading.Lock()
+        self._sweeper = None
+
+    def put(self, email, code):
+        with self._lock:
+            self._codes[email] = [code, time.time() + self.ttl, 0]
+            if self._sweeper is None:
+                self._sweeper = threading.Thread(target=self._sweep_loop, daemon=True)
+                self._sweeper.start()
+
+    def check(self, email, code):
+        with self._lock:
+            entry = self._codes.get(email)
+            if entry is None or entry[1] < time.time():
+                self._codes.pop(email, None)
+                return CODE_EXPIRED
+            if _code_matches(entry[0], code):
+                return CODE_OK
+            entry[2] += 1
+            if entry[2] >= self.max_attempts:
+                del self._codes[email]
+                return CODE_LOCKED
+            return CODE_INVALID
+
+    def discard(self, email):
+        with self._lock:
+            self._codes.pop(email, None)
+
+    def sweep(self):
+        now = time.time()
+        with self._lock:
+            expired = [email for email, entry in self._codes.items() if entry[1] < now]
+            for email in expired:
+                del self._codes[email]
+        return len(expired)
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(CODE_SWEEP_INTERVAL)
+            self.sweep()
+
+class SQLiteCodeStore:
+    def __init__(self, ttl=CODE_EXPIRY, max_attempts=CODE_MAX_ATTEMPTS):
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+
+    def put(self, email, code):
+        now = time.time()
+        with get_db() as conn:
+            # Expired codes are dropped whenever a new one is issued
+            conn.execute("DELETE FROM verification_codes WHERE expires_at<?", (now,))
+            conn.execute("INSERT OR REPLACE INTO verification_codes (email, code, expires_at, attempts) "
+                         "VALUES (?,?,?,0)", (email, code, now + self.ttl))
+
+    def check(self, email, code):
+        with get_db() as conn:
+            # Write lock up front so concurrent guesses can't share an attempt
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT code, expires_at, attempts FROM verification_codes WHERE email=?",
+                               (email,)).fetchone()
+            if row is None or row[1] < time.time():
+                conn.execute("DELETE FROM verification_codes WHERE email=?", (email,))
+                return CODE_EXPIRED
+            if _code_matches(row[0], code):
+                return CODE_OK
+            if row[2] + 1 >= self.max_attempts:
+                conn.execute("DELETE FROM verification_codes WHERE email=?", (email,))
+                return CODE_LOCKED
+            conn.execute("UPDATE verification_codes SET attempts=attempts+1 WHERE email=?", (email,))
+            return CODE_INVALID
+
+    def discard(self, email):
+        with get_db() as conn:
+            conn.execute("DELETE FROM verification_codes WHERE email=?", (email,))
+
+    def sweep(self):
+        with get_db() as conn:
+            return conn.execute("DELETE FROM verification_codes WHERE expires_at<?", (time.time(),)).rowcount
+
+CODE_STORE_BACKENDS = {"sqlite": SQLiteCodeStore, "memory": MemoryCodeStore}
+CODE_STORE = CODE_STORE_BACKENDS[os.environ.get("CODE_STORE_BACKEND", "sqlite")]()
+
+# ----- Heartbeat registry -----
+# Last-seen times live in a memory-mapped file (HEARTBEAT_FILE) so every worker
+# process sees every heartbeat and a restart doesn't mark the lab offline.
+# Layout: a 64-byte header (magic, capacity, count) then fixed 128-byte slots
+# of [client_id utf-8, NUL padded][float64 last_seen]. Slots are append-only;
+# each process caches client_id -> slot, so a heartbeat from a known client is
+# a single aligned 8-byte store with no locking. Only adding a client takes
+# the file lock (flock), and the file doubles in size when it fills up.
+HEARTBEAT_FILE = os.environ.get("HEARTBEAT_FILE", "heartbeats.bin")
+HEARTBEAT_CAPACITY = int(os.environ.get("HEARTBEAT_CAPACITY", "4096"))
+
+class HeartbeatRegistry:
+    MAGIC = b"LABHB001"
+    HEADER = struct.Struct("<8sII")     # magic, capacity, count
+    VERSION = struct.Struct("<Q")       # fleet state version, in the header's spare bytes
+    VERSION_OFFSET = 16
+    HEADER_SIZE = 64
+    SLOT_SIZE = 128
+    ID_BYTES = 120
+    TS = struct.Struct("<d")
+
+    def __init__(self, path, capacity=HEARTBEAT_CAPACITY):
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+        self._lock = threading.Lock()
+        self._index = {}        # client_id -> slot, for slots [0, _seen)
+        self._seen = 0
+        self._overflow = {}     # ids too long for a slot stay process-local
+        with self._file_lock():
+            head = self._read_header()
+            if len(head) < self.HEADER.size or self.HEADER.unpack(head)[0] != self.MAGIC:
+                os.ftruncate(self._fd, self.HEADER_SIZE + capacity * self.SLOT_SIZE)
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                os.write(self._fd, self.HEADER.pack(self.MAGIC, capacity, 0))
+            self._map()
+
+    def _read_header(self):
+        # lseek+read rather than pread, which Windows lacks; only used before
+        # mapping, under the file lock
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        return os.read(self._fd, self.HEADER.size)
+
+    @contextmanager
+    def _file_lock(self):
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _map(self):
+        capacity = self.HEADER.unpack(self._read_header())[1]
+        # The file only grows, so a replaced mapping stays valid for anyone still using it
+        self._mm = mmap.mmap(self._fd, self.HEADER_SIZE + capacity * self.SLOT_SIZE)
+        self._capacity = capacity
+
+    def _refresh(self):
+        # Pick up slots (and growth) appended by other processes. Caller holds _lock.
+        _, capacity, count = self.HEADER.unpack_from(self._mm, 0)
+        if capacity != self._capacity:
+            self._map()
+        for i in range(self._seen, count):
+            off = self.HEADER_SIZE + i * self.SLOT_SIZE
+            raw = self._mm[off:off + self.ID_BYTES].rstrip(b"\0")
+            self._index[raw.decode("utf-8")] = i
+        self._seen = max(self._seen, count)
+
+    def _slot(self, client_id, create):
+        i = self._index.get(client_id)
+        if i is not None:
+            return i
+        with self._lock:
+            self._refresh()
+            i = self._index.get(client_id)
+            if i is not None or not create:
+                return i
+            with self._file_lock():
+                self._refresh()
+                i = self._index.get(client_id)
+                if i is not None:
+                    return i
+                _, capacity, count = self.HEADER.unpack_from(self._mm, 0)
+                if count >= capacity:
+                    capacity *= 2
+                    if fcntl is None:
+                        # Windows can't truncate a mapped file; resize() grows the
+                        # file and the mapping together (single process there)
+                        self._mm.resize(self.HEADER_SIZE + capacity * self.SLOT_SIZE)
+                        self.HEADER.pack_into(self._mm, 0, self.MAGIC, capacity, count)
+                        self._capacity = capacity
+                    else:
+                        os.ftruncate(self._fd, self.HEADER_SIZE + capacity * self.SLOT_SIZE)
+                        self.HEADER.pack_into(self._mm, 0, self.MAGIC, capacity, count)
+                        self._map()
+                off = self.HEADER_SIZE + count * self.SLOT_SIZE
+                self._mm[off:off + self.SLOT_SIZE] = client_id.encode("utf-8").ljust(self.SLOT_SIZE, b"\0")
+                # Bump count last so readers never see a half-written slot
+                self.HEADER.pack_into(self._mm, 0, self.MAGIC, capacity, count + 1)
+                self._index[client_id] = count
+                self._seen = count + 1
+                return count
+
+    def __setitem__(self, client_id, ts):
+        if len(client_id.encode("utf-8")) > self.ID_BYTES or "\0" in client_id:
+            self._overflow[client_id] = ts
+            return
+        i = self._slot(client_id, True)
+        self.TS.pack_into(self._mm, self.HEADER_SIZE + i * self.SLOT_SIZE + self.ID_BYTES, ts)
+
+    def get(self, client_id, default=None):
+        if client_id in self._overflow:
+            return self._overflow[client_id]
+        i = self._slot(client_id, False)
+        if i is None:
+            return default
+        ts = self.TS.unpack_from(self._mm, self.HEADER_SIZE + i * self.SLOT_SIZE + self.ID_BYTES)[0]
+        return ts if ts > 0 else default
+
+    def __getitem__(self, client_id):
+        ts = self.get(client_id)
+        if ts is None:
+            raise KeyError(client_id)
+        return ts
+
+    def __contains__(self, client_id):
+        return self.get(client_id) is not None
+
+    def items(self):
+        with self._lock:
+            self._refresh()
+            mm, slots = self._mm, list(self._index.items())
+        out = []
+        for client_id, i in slots:
+            ts = self.TS.unpack_from(mm, self.HEADER_SIZE + i * self.SLOT_SIZE + self.ID_BYTES)[0]
+            if ts > 0:
+                out.append((client_id, ts))
+        return out + list(self._overflow.items())
+
+    def keys(self):
+        return [client_id for client_id, _ in self.items()]
+
+    def values(self):
+        return [ts for _, ts in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.items())
+
+    def clear(self):
+        # Zero the timestamps but keep the slots: other processes cache them
+        with self._lock:
+            self._refresh()
+            for i in self._index.values():
+                self.TS.pack_into(self._mm, self.HEADER_SIZE + i * self.SLOT_SIZE + self.ID_BYTES, 0.0)
+            self._overflow.clear()
+
+    def version(self):
+        return self.VERSION.unpack_from(self._mm, self.VERSION_OFFSET)[0]
+
+    def bump_version(self):
+        with self._lock, self._file_lock():
+            version = self.version() + 1
+            self.VERSION.pack_into(self._mm, self.VERSION_OFFSET, version)
+            return version
+
+    def close(self):
+        self._mm.close()
+        os.close(self._fd)
+
+heartbeats = HeartbeatRegistry(HEARTBEAT_FILE)
+
+# Fleet state version: bumped (in the shared registry, so across workers)
+# whenever something a cached page shows changes -- users registering, being
+# approved or rejected, PCs changing status, screenshots arriving, labs
+# changing. See the page cache further down.
+def fleet_version():
+    return heartbeats.version()
+
+def bump_fleet_version():
+    return heartbeats.bump_version()
+
+# ----- Dashboard push events (Server-Sent Events) -----
+# Dashboards keep one /events stream open instead of polling. Events are
+# 'screenshot' on upload, 'command' when an agent posts a result, 'presence'
+# when a client changes Online/Idle/Offline status (see FleetStatus; demotions
+# are picked up by a sweeper thread) and 'removed' when a PC's account is
+# rejected. The worker that handled the request may not be the one holding a
+# dashboard's stream, so publishing appends to the events table and every
+# worker runs a pump that tails it (every EVENT_POLL_INTERVAL, or at once for
+# its own events) and hands new rows to its local streams. Rows older than
+# EVENT_RETENTION are pruned by the pumps.
+HEARTBEAT_TIMEOUT = float(os.environ.get("HEARTBEAT_TIMEOUT", "60"))   # seconds without heartbeat before Online -> Idle
+IDLE_TIMEOUT = float(os.environ.get("IDLE_TIMEOUT", "300"))            # ... before Idle -> Offline
+SSE_KEEPALIVE = 20               # seconds between keepalive comments on idle streams
+PRESENCE_SWEEP_INTERVAL = 5
+FLEET_SYNC_INTERVAL = 5          # seconds between merges of heartbeats taken by other workers
+EVENT_POLL_INTERVAL = 0.25       # seconds between checks for events published by other workers
+EVENT_RETENTION = 60             # seconds an event row is kept for the pumps
+
+_subscribers = set()             # one bounded queue.Queue per open /events stream
+_subscribers_lock = threading.Lock()
+_presence_thread = None
+_event_thread = None
+_event_wakeup = threading.Event()
+
+def publish_events(items):
+    """Append (event, data, dedupe) tuples to the events table. Rows sharing a
+    non-NULL dedupe key are stored once, so a change noticed by several
+    workers reaches each dashboard once."""
+    now = time.time()
+    with get_db() as conn:
+        conn.executemany("INSERT OR IGNORE INTO events (created_at, event, data, dedupe) VALUES (?,?,?,?)",
+                         [(now, event, json.dumps(data), dedupe) for event, data, dedupe in items])
+    _event_wakeup.set()
+
+def publish_event(event, data, dedupe=None):
+    publish_events([(event, data, dedupe)])
+
+def _deliver(rows):
+    msgs = []
+    for _, event, data in rows:
+        if event == 'removed':
+            fleet.forget(json.loads(data)['client_id'])
+            bump_fleet_version()
+        msgs.append(f"event: {event}\ndata: {data}\n\n")
+    with _subscribers_lock:
+        subs = list(_subscribers)
+    for q in subs:
+        for msg in msgs:
+            try:
+                q.put_nowait(msg)
+            except queue.Full:
+                break  # slow dashboard: drop events rather than block the pump
+
+def _event_pump():
+    with get_db() as conn:
+        last_id = conn.execute("SELECT coalesce(max(id), 0) FROM events").fetchone()[0]
+    pruned = time.time()
+    while True:
+        _event_wakeup.wait(EVENT_POLL_INTERVAL)
+        _event_wakeup.clear()
+        try:
+            with get_db() as conn:
+                rows = conn.execute("SELECT id, event, data FROM events WHERE id>? ORDER BY id", (last_id,)).fetchall()
+                if time.time() - pruned >= EVENT_RETENTION:
+                    pruned = time.time()
+                    conn.execute("DELETE FROM events WHERE created_at<?", (pruned - EVENT_RETENTION,))
+            if rows:
+                last_id = rows[-1][0]
+                _deliver(rows)
+        except Exception as e:
+            print('Event pump failed:', e)
+
+def start_event_pump():
+    global _event_thread
+    if _event_thread is None:
+        _event_thread = threading.Thread(target=_event_pump, daemon=True)
+        _event_thread.start()
+
+ONLINE, IDLE, OFFLINE = "Online", "Idle", "Offline"
+
+def status_for(last_seen, now):
+    if last_seen is None:
+        return OFFLINE
+    age = now - last_seen
+    return ONLINE if age < HEARTBEAT_TIMEOUT else IDLE if age < IDLE_TIMEOUT else OFFLINE
+
+class FleetStatus:
+    """Online/Idle/Offline for every known client plus running counts.
+    Heartbeats update a client in O(1); demotions come off a heap of
+    deadlines, so reading the counts never walks the fleet. Heartbeats taken
+    by other worker processes reach us through the shared registry: at a
+    client's deadline we re-read its last_seen, and every FLEET_SYNC_INTERVAL
+    the registry is merged in to catch clients coming back online."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = {}     # client_id -> [status, last_seen, deadline]
+        self._heap = []      # (deadline, client_id); stale when it no longer matches the state
+        self.counts = {ONLINE: 0, IDLE: 0, OFFLINE: 0}
+        self._synced = 0.0
+        self._users_seen = 0   # highest users.id merged in
+
+    def _schedule(self, client_id, entry):
+        if entry[0] == OFFLINE:
+            entry[2] = None
+            return
+        entry[2] = entry[1] + (HEARTBEAT_TIMEOUT if entry[0] == ONLINE else IDLE_TIMEOUT)
+        heapq.heappush(self._heap, (entry[2], client_id))
+
+    def _update(self, client_id, last_seen, now, changes):
+        entry = self._state.get(client_id)
+        if entry is None:
+            entry = self._state[client_id] = [OFFLINE, None, None]
+            self.counts[OFFLINE] += 1
+        if last_seen is not None and (entry[1] is None or last_seen > entry[1]):
+            entry[1] = last_seen
+        status = status_for(entry[1], now)
+        if status != entry[0]:
+            self.counts[entry[0]] -= 1
+            self.counts[status] += 1
+            entry[0] = status
+            self._schedule(client_id, entry)
+            changes.append((client_id, status, entry[1]))
+        return status
+
+    def _publish(self, changes):
+        if changes:
+            bump_fleet_version()
+            counts = self.snapshot(refresh=False)
+            publish_events([('presence', {'client_id': client_id, 'status': status,
+                                          'last_seen': last_seen, 'counts': counts},
+                             f'presence:{client_id}:{status}:{last_seen}')
+                            for client_id, status, last_seen in changes])
+
+    def heartbeat(self, client_id, ts):
+        changes = []
+        with self._lock:
+            self._update(client_id, ts, ts, changes)
+        self._publish(changes)
+
+    def statuses(self, client_ids):
+        """Status of each id, adding unknown ones (as their registry says)."""
+        now = time.time()
+        changes = []
+        with self._lock:
+            out = []
+            for client_id in client_ids:
+                entry = self._state.get(client_id)
+                out.append(entry[0] if entry else self._update(client_id, heartbeats.get(client_id), now, changes))
+        self._publish(changes)
+        return out
+
+    def entries(self):
+        """(client_id, status, last_seen) for every known client."""
+        with self._lock:
+            return [(client_id, e[0], e[1]) for client_id, e in self._state.items()]
+
+    def forget(self, client_id):
+        with self._lock:
+            entry = self._state.pop(client_id, None)
+            if entry:
+                self.counts[entry[0]] -= 1
+
+    def advance(self, now=None):
+        now = time.time() if now is None else now
+        changes = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, client_id = heapq.heappop(self._heap)
+                entry = self._state.get(client_id)
+                if entry is None or entry[2] != deadline:
+                    continue
+                shared = heartbeats.get(client_id)   # maybe refreshed by another worker
+                if shared is not None and shared > entry[1]:
+                    entry[1] = shared
+                status = status_for(entry[1], now)
+                if status != entry[0]:
+                    self.counts[entry[0]] -= 1
+                    self.counts[status] += 1
+                    entry[0] = status
+                    changes.append((client_id, status, entry[1]))
+                self._schedule(client_id, entry)
+        self._publish(changes)
+
+    def sync(self, force=False):
+        now = time.time()
+        if not force and now - self._synced < FLEET_SYNC_INTERVAL:
+            return
+        self._synced = now
+        items = heartbeats.items()
+        changes = []
+        with self._lock:
+            # PCs registered as users (since the last sync, by rowid) count as
+            # Offline until they report
+            with get_db() as conn:
+                for user_id, username in conn.execute(
+                        "SELECT id, username FROM users WHERE id>? AND username IS NOT NULL", (self._users_seen,)):
+                    self._users_seen = max(self._users_seen, user_id)
+                    self._update(username, None, now, changes)
+            for client_id, ts in items:
+                entry = self._state.get(client_id)
+                if entry is None or entry[1] is None or ts > entry[1]:
+                    self._update(client_id, ts, now, changes)
+        self._publish(changes)
+
+    def snapshot(self, refresh=True):
+        if refresh:
+            self.sync()
+            self.advance()
+        with self._lock:
+            counts = {k.lower(): v for k, v in self.counts.items()}
+            counts["total"] = len(self._state)
+        return counts
+
+fleet = FleetStatus()
+
+def _presence_sweeper():
+    while True:
+        time.sleep(PRESENCE_SWEEP_INTERVAL)
+        try:
+            fleet.sync()
+            fleet.advance()
+        except Exception as e:
+            print('Presence sweep failed:', e)
+
+def subscribe_events():
+    global _presence_thread
+    q = queue.Queue(maxsize=256)
+    with _subscribers_lock:
+        _subscribers.add(q)
+        if _presence_thread is None:
+            _presence_thread = threading.Thread(target=_presence_sweeper, daemon=True)
+            _presence_thread.start()
+        start_event_pump()
+    return q
+
+def unsubscribe_events(q):
+    with _subscribers_lock:
+        _subscribers.discard(q)
+
+if not DEFER_STARTUP:
+    start_event_pump()
+
+# ----- Screenshot store -----
+# Every upload is kept as static/screenshots/store/ab/cd/<sha256>.<ext>, so
+# identical frames (from one client or many) are stored once. The screenshots
+# table indexes (client_id, taken_at, hash) and is the source of truth for a
+# client's latest image, so the request path never stats the filesystem.
+# History is trimmed to SCREENSHOT_HISTORY_COUNT per client on upload and to
+# SCREENSHOT_HISTORY_DAYS by the retention thread (a client's latest image is
+# always kept). Agents may upload PNG, JPEG or WebP; the format is sniffed.
+#
+# Uploads are streamed in UPLOAD_CHUNK pieces into a temp file inside the
+# store (hashing on the way), capped at SCREENSHOT_MAX_BYTES, fsynced and then
+# renamed into place, so a half-written image is never served. Besides
+# multipart, /upload accepts the raw image as the request body. Multipart file
+# parts are written by werkzeug's parser straight into the store too (see
+# StoreUpload), not into its own spool file first.
+SCREENSHOT_DIR = os.path.join("static", "screenshots")
+SCREENSHOT_STORE = os.path.join(SCREENSHOT_DIR, "store")
+SCREENSHOT_EXT = {"png": "png", "jpeg": "jpg", "webp": "webp"}
+SCREENSHOT_MIME = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+SCREENSHOT_HISTORY_COUNT = int(os.environ.get("SCREENSHOT_HISTORY_COUNT", "50"))
+SCREENSHOT_HISTORY_DAYS = float(os.environ.get("SCREENSHOT_HISTORY_DAYS", "14"))
+SCREENSHOT_MAX_AGE = 365 * 86400   # stored files never change, cache them for a year
+SCREENSHOT_MAX_BYTES = int(os.environ.get("SCREENSHOT_MAX_BYTES", str(20 * 1024 * 1024)))
+UPLOAD_CHUNK = 64 * 1024
+RAW_UPLOAD_TYPES = {"application/octet-stream", "image/png", "image/jpeg", "image/webp"}
+# Hard cap on any request body (multipart overhead included) so werkzeug
+# never spools an oversized form to disk
+app.config["MAX_CONTENT_LENGTH"] = SCREENSHOT_MAX_BYTES + 1024 * 1024
+_STORED_NAME_RE = re.compile(r"([0-9a-f]{64})\.(png|jpg|webp)")
+
+_legacy_checked = set()  # clients whose pre-store static/screenshots/<id>.<ext> was looked for
+
+# latest_screenshot() answers from memory: uploads in this process update the
+# entry directly, and entries older than SCREENSHOT_INDEX_TTL are re-read from
+# SQLite so uploads handled by another worker process show up too.
+SCREENSHOT_INDEX_TTL = float(os.environ.get("SCREENSHOT_INDEX_TTL", "5"))
+screenshot_index = {}   # client_id -> (shot dict or None, loaded_at)
+SCREENSHOT_BATCH = 500  # ids per query in latest_screenshots
+
+def sniff_image_format(data):
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if data.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+def store_path(digest, fmt):
+    return os.path.join(SCREENSHOT_STORE, digest[:2], digest[2:4], f"{digest}.{SCREENSHOT_EXT[fmt]}")
+
+def stored_url(digest, fmt):
+    return url_for('screenshot_file', name=f"{digest}.{SCREENSHOT_EXT[fmt]}")
+
+def spool_upload(stream):
+    """Copy an upload stream in chunks into a fsynced temp file in the store.
+    Returns (tmp_path, sha256, format, size). Raises RequestEntityTooLarge past
+    SCREENSHOT_MAX_BYTES and UnsupportedMediaType if it isn't PNG/JPEG/WebP."""
+    if isinstance(stream, StoreUpload):
+        return stream.finish()   # already in the store
+    os.makedirs(SCREENSHOT_STORE, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp = tempfile.mkstemp(dir=SCREENSHOT_STORE, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while True:
+                chunk = stream.read(UPLOAD_CHUNK)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > SCREENSHOT_MAX_BYTES:
+                    raise RequestEntityTooLarge(f"screenshot larger than {SCREENSHOT_MAX_BYTES} bytes")
+                digest.update(chunk)
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        with open(tmp, "rb") as f:
+            fmt = sniff_image_format(f.read(12))
+        if fmt is None:
+            raise UnsupportedMediaType("expected PNG, JPEG or WebP")
+    except Exception:
+        os.remove(tmp)
+        raise
+    return tmp, digest.hexdigest(), fmt, size
+
+class StoreUpload:
+    """Container werkzeug's multipart parser writes a file part into: a temp
+    file in the store, hashed and size-capped as it is written, so
+    spool_upload has nothing left to copy. A part that is never published is
+    removed when werkzeug closes the request's files."""
+
+    def __init__(self):
+        os.makedirs(SCREENSHOT_STORE, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(dir=SCREENSHOT_STORE, suffix=".part")
+        self._file = os.fdopen(fd, "w+b")
+        self._digest = hashlib.sha256()
+        self._head = b""
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > SCREENSHOT_MAX_BYTES:
+            self.close()   # the parser drops us on error, so clean up now
+            raise RequestEntityTooLarge(f"screenshot larger than {SCREENSHOT_MAX_BYTES} bytes")
+        if len(self._head) < 12:
+            self._head += bytes(data[:12 - len(self._head)])
+        self._digest.update(data)
+        return self._file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)   # seek, read, ... for werkzeug's FileStorage
+
+    def finish(self):
+        """Same result as spool_upload: (tmp_path, sha256, format, size)."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        fmt = sniff_image_format(self._head)
+        if fmt is None:
+            self.close()
+            raise UnsupportedMediaType("expected PNG, JPEG or WebP")
+        return self.path, self._digest.hexdigest(), fmt, self.size
+
+    def close(self):
+        self._file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class LabRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.url_rule is not None and self.url_rule.endpoint == "upload_screenshot":
+            return StoreUpload()
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+app.request_class = LabRequest
+
+def _publish_file(tmp, path):
+    # rename is atomic within the store's filesystem; fsync the directory so
+    # the new entry survives a crash too
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(tmp, path)
+    if hasattr(os, "O_DIRECTORY"):
+        dir_fd = os.open(os.path.dirname(path), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+def save_screenshot(client_id, stream, taken_at=None):
+    """Store an uploaded image for a client and record it in the history index."""
+    tmp, digest, fmt, size = spool_upload(stream)
+    path = store_path(digest, fmt)
+    taken_at = time.time() if taken_at is None else taken_at
+    try:
+        with get_db() as conn:
+            # Publish under the write lock: prune_screenshots unlinks under it
+            # too, so the row and the file always appear together
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("INSERT INTO screenshots (client_id, taken_at, hash, format, size) VALUES (?,?,?,?,?)",
+                         (client_id, taken_at, digest, fmt, size))
+            if not os.path.exists(path):
+                _publish_file(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)  # identical frame already stored, or the insert failed
+    prune_screenshots(client_id=client_id)
+    shot = {"hash": digest, "format": fmt, "size": size, "taken_at": taken_at}
+    screenshot_index[client_id] = (shot, time.time())
+    return shot
+
+def latest_screenshots(client_ids):
+    """latest_screenshot() for a page of clients: {client_id: shot} for those
+    that have one. Ids not fresh in screenshot_index are looked up together,
+    one query per SCREENSHOT_BATCH ids; legacy files are not looked for here."""
+    now = time.time()
+    shots, missing = {}, []
+    for client_id in client_ids:
+        cached = screenshot_index.get(client_id)
+        if cached is not None and now - cached[1] < SCREENSHOT_INDEX_TTL:
+            if cached[0] is not None:
+                shots[client_id] = cached[0]
+        else:
+            missing.append(client_id)
+    with get_db() as conn:
+        for i in range(0, len(missing), SCREENSHOT_BATCH):
+            chunk = missing[i:i + SCREENSHOT_BATCH]
+            # Same row as latest_screenshot picks, one index seek per client
+            rows = conn.execute(
+                "SELECT client_id, hash, format, size, taken_at FROM screenshots WHERE id IN ("
+                "SELECT (SELECT id FROM screenshots WHERE client_id=c.column1 ORDER BY taken_at DESC, id DESC LIMIT 1) "
+                f"FROM (VALUES {','.join(['(?)'] * len(chunk))}) c)", chunk).fetchall()
+            for client_id, digest, fmt, size, taken_at in rows:
+                shots[client_id] = {"hash": digest, "format": fmt, "size": size, "taken_at": taken_at}
+    for client_id in missing:
+        if client_id in shots or client_id in _legacy_checked:
+            screenshot_index[client_id] = (shots.get(client_id), now)
+    return shots
+
+def prune_screenshots(client_id=None, cutoff=None):
+    """Drop history beyond SCREENSHOT_HISTORY_COUNT for one client, or older
+    than `cutoff` for all clients, deleting files no row references anymore."""
+    pruned = 0
+    while True:
+        # Rows are picked before taking the write lock, RETENTION_BATCH at a
+        # time by age for a cutoff, keeping each client's latest screenshot
+        with get_db() as conn:
+            if client_id is not None:
+                rows = conn.execute("SELECT id, hash, format FROM screenshots WHERE client_id=? "
+                                    "ORDER BY taken_at DESC, id DESC LIMIT -1 OFFSET ?",
+                                    (client_id, SCREENSHOT_HISTORY_COUNT)).fetchall()
+            else:
+                rows = conn.execute("SELECT id, hash, format FROM screenshots s WHERE taken_at<? AND EXISTS ("
+                                    "SELECT 1 FROM screenshots n WHERE n.client_id=s.client_id "
+                                    "AND (n.taken_at>s.taken_at OR (n.taken_at=s.taken_at AND n.id>s.id))) "
+                                    "ORDER BY taken_at LIMIT ?", (cutoff, RETENTION_BATCH)).fetchall()
+        if not rows:
+            return pruned
+        with get_db() as conn:
+            # Files are unlinked while holding the write lock, so an upload of the
+            # same hash either sees our deletion or has already added its row
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("DELETE FROM screenshots WHERE id=?", [(r[0],) for r in rows])
+            for digest, fmt in {(r[1], r[2]) for r in rows}:
+                if not conn.execute("SELECT 1 FROM screenshots WHERE hash=? LIMIT 1", (digest,)).fetchone():
+                    for path in [store_path(digest, fmt)] + [os.path.join(THUMB_DIR, thumb_name(digest, size)) for size in THUMB_SIZES]:
+                        try:
+                            os.remove(path)
+                        except OSError:
+                            pass
+        pruned += len(rows)
+        if client_id is not None or len(rows) < RETENTION_BATCH:
+            return pruned
+
+def _import_legacy_screenshot(client_id):
+    # Screenshots saved before the store existed live at static/screenshots/<id>.<ext>
+    _legacy_checked.add(client_id)
+    for ext in SCREENSHOT_EXT.values():
+        path = os.path.join(SCREENSHOT_DIR, f"{client_id}.{ext}")
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                info = save_screenshot(client_id, f, taken_at=os.path.getmtime(path))
+            os.remove(path)
+            return info
+    return None
+
+def latest_screenshot(client_id):
+    """Return {hash, format, size, taken_at} of the client's newest screenshot, or None."""
+    cached = screenshot_index.get(client_id)
+    if cached is not None and time.time() - cached[1] < SCREENSHOT_INDEX_TTL:
+        return cached[0]
+    with get_db() as conn:
+        row = conn.execute("SELECT hash, format, size, taken_at FROM screenshots WHERE client_id=? "
+                           "ORDER BY taken_at DESC, id DESC LIMIT 1", (client_id,)).fetchone()
+    if row is None:
+        shot = None if client_id in _legacy_checked else _import_legacy_screenshot(client_id)
+    else:
+        shot = {"hash": row[0], "format": row[1], "size": row[2], "taken_at": row[3]}
+    screenshot_index[client_id] = (shot, time.time())
+    return shot
+
+def latest_screenshots(client_ids):
+    """latest_screenshot() for a page of clients: {client_id: shot} for those
+    that have one. Ids not fresh in screenshot_index are looked up together,
+    one query per SCREENSHOT_BATCH ids; legacy files are not looked for here."""
+    now = time.time()
+    shots, missing = {}, []
+    for client_id in client_ids:
+        cached = screenshot_index.get(client_id)
+        if cached is not None and now - cached[1] < SCREENSHOT_INDEX_TTL:
+            if cached[0] is not None:
+                shots[client_id] = cached[0]
+        else:
+            missing.append(client_id)
+    with get_db() as conn:
+        for i in range(0, len(missing), SCREENSHOT_BATCH):
+            chunk = missing[i:i + SCREENSHOT_BATCH]
+            # Same row as latest_screenshot picks, one index seek per client
+            rows = conn.execute(
+                "SELECT client_id, hash, format, size, taken_at FROM screenshots WHERE id IN ("
+                "SELECT (SELECT id FROM screenshots WHERE client_id=c.column1 ORDER BY taken_at DESC, id DESC LIMIT 1) "
+                f"FROM (VALUES {','.join(['(?)'] * len(chunk))}) c)", chunk).fetchall()
+            for client_id, digest, fmt, size, taken_at in rows:
+                shots[client_id] = {"hash": digest, "format": fmt, "size": size, "taken_at": taken_at}
+    for client_id in missing:
+        if client_id in shots or client_id in _legacy_checked:
+            screenshot_index[client_id] = (shots.get(client_id), now)
+    return shots
+
+# Agents send a perceptual hash (hex difference hash) with each upload. When a
+# later capture is within SCREENSHOT_PHASH_THRESHOLD bits of it they post a
+# tiny /screenshot-unchanged ack instead of the image.
+SCREENSHOT_PHASH_THRESHOLD = int(os.environ.get("SCREENSHOT_PHASH_THRESHOLD", "0"))
+_PHASH_RE = re.compile(r"[0-9a-f]{1,64}")
+
+def phash_distance(a, b):
+    return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+# ----- Screenshot thumbnails -----
+# Uploads are downscaled once into THUMB_SIZES and cached on disk under their
+# content hash, so the files never change and are served with a one-year
+# immutable Cache-Control. A client's thumbnail URL is built from its latest
+# screenshot's hash alone, without checking the disk: /thumbs generates a
+# thumbnail that isn't there yet (cold cache, resize failed at upload) from
+# its source on the first request. Thumbnails are deleted along with their
+# source file by prune_screenshots.
+THUMB_DIR = os.path.join("static", "thumbs")
+THUMB_SIZES = {"thumb": (240, 160), "preview": (960, 640)}   # 2x the dashboard's 120x80 grid image
+THUMB_QUALITY = int(os.environ.get("THUMB_QUALITY", "80"))
+THUMB_MAX_AGE = 365 * 86400
+os.makedirs(THUMB_DIR, exist_ok=True)
+
+_THUMB_NAME_RE = re.compile(r"([0-9a-f]{64})-([a-z]+)\.jpg")
+
+def thumb_name(digest, size):
+    return f"{digest}-{size}.jpg"
+
+def make_thumbnails(source, digest):
+    """Write every THUMB_SIZES variant of the image file `source` (content
+    hash `digest`) that isn't cached yet."""
+    if Image is None:
+        return
+    missing = [size for size in THUMB_SIZES if not os.path.exists(os.path.join(THUMB_DIR, thumb_name(digest, size)))]
+    if not missing:
+        return
+    im = Image.open(source)
+    largest = max(THUMB_SIZES.values())
+    im.draft("RGB", largest)  # JPEG sources decode at reduced scale
+    im = im.convert("RGB")
+    im.thumbnail(largest)
+    # Largest first so each smaller size is resampled from an already reduced image
+    for size in sorted(missing, key=lambda n: THUMB_SIZES[n], reverse=True):
+        variant = im.copy()
+        variant.thumbnail(THUMB_SIZES[size])
+        path = os.path.join(THUMB_DIR, thumb_name(digest, size))
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        variant.save(tmp, format="JPEG", quality=THUMB_QUALITY, optimize=True)
+        os.replace(tmp, path)
+
+def thumbnail_url(client_id, shot, size="thumb"):
+    """URL of the thumbnail of `shot`, the client's latest screenshot (None
+    gives the /thumbnail redirect, which looks it up)."""
+    if shot is None:
+        return url_for('thumbnail', client_id=client_id, size=size)
+    if Image is None:
+        return stored_url(shot["hash"], shot["format"])
+    return url_for('thumbnail_file', name=thumb_name(shot["hash"], size))
+
+def screenshot_payload(client_id, shot):
+    # Shared by /screenshot/<client_id> and the SSE 'screenshot' event
+    return {"client_id": client_id, "exists": True, "mtime": int(shot["taken_at"]),
+            "url": stored_url(shot["hash"], shot["format"]), "hash": shot["hash"],
+            "format": shot["format"], "content_type": SCREENSHOT_MIME[shot["format"]], "size": shot["size"],
+            "thumb_url": thumbnail_url(client_id, shot), "preview_url": thumbnail_url(client_id, shot, 'preview')}
+
 # -------- Routes --------
 
 @app.route("/")
@@ -105,40 +1701,40 @@ def login():
     if request.method == "POST":
         email = request.form.get("email")
         password = request.form.get("password")
-        conn = sqlite3.connect(DB)
-        c = conn.cursor()
-        c.execute("SELECT * FROM users WHERE email=?", (email,))
-        user = c.fetchone()
-        conn.close()
+        with get_db() as conn:
+            user = conn.execute("SELECT * FROM users WHERE email=?", (email,)).fetchone()
+        # Hash with the connection back in the pool: waiting for a hashing
+        # slot can take seconds, and pollers need the connections meanwhile
         if user:
             # user schema: id, username, email, password, role, approved
             stored_hash = user[3]
             role = user[4]
             approved = user[5]
-            # Support legacy plaintext passwords: if stored value isn't a werkzeug hash,
-            # allow direct match and re-hash the password for future logins.
-            valid = False
-            try:
-                valid = check_password_hash(stored_hash, password)
-            except Exception:
-                valid = False
-            if not valid:
+            new_hash = None
+            valid = verify_password(stored_hash, password)
+            if valid and password_needs_rehash(stored_hash):
+                # hashed with old KDF parameters: upgrade while we have the password
+                new_hash = hash_password(password)
+            elif not valid:
                 # fallback: stored_hash may actually be plaintext password from old DB
                 if stored_hash == password:
                     # migrate: re-hash and update DB
                     try:
-                        new_hash = generate_password_hash(password)
-                        conn2 = sqlite3.connect(DB)
-                        c2 = conn2.cursor()
-                        c2.execute("UPDATE users SET password=? WHERE email=?", (new_hash, email))
-                        conn2.commit()
-                        conn2.close()
+                        new_hash = hash_password(password)
                         valid = True
+                    except ServiceUnavailable:
+                        raise
                     except Exception as e:
                         print('Failed to migrate plaintext password for', email, e)
                 else:
                     flash("Invalid credentials","error")
                     return render_template("login.html")
+            if new_hash:
+                with get_db() as conn:
+                    # unless the password was changed while we were hashing
+                    conn.execute("UPDATE users SET password=? WHERE email=? AND password=?",
+                                 (new_hash, email, stored_hash))
+        if user:
             if role == "Admin" or approved == 1:
                 session['user_email'] = email
                 session['role'] = role
@@ -163,18 +1759,16 @@ def register():
         if not password_valid(password):
             flash("Password must include upper, lower, number, special char & min 8 chars","error")
             return redirect(url_for("register"))
-        conn = sqlite3.connect(DB)
-        c = conn.cursor()
-        c.execute("SELECT * FROM users WHERE email=?", (email,))
-        if c.fetchone():
+        with get_db() as conn:
+            exists = conn.execute("SELECT 1 FROM users WHERE email=?", (email,)).fetchone()
+        if exists:
             flash("Email already registered","error")
-            conn.close()
             return redirect(url_for("register"))
-        pw_hash = generate_password_hash(password)
-        c.execute("INSERT INTO users (username,email,password,role,approved) VALUES (?,?,?,?,?)",
-                  (username,email,pw_hash,"Teacher",0))
-        conn.commit()
-        conn.close()
+        pw_hash = hash_password(password)
+        with get_db() as conn:
+            conn.execute("INSERT INTO users (username,email,password,role,approved) VALUES (?,?,?,?,?)",
+                         (username,email,pw_hash,"Teacher",0))
+        bump_fleet_version()
         flash("Account created! Contact admin to approve.","info")
         return redirect(url_for("login"))
     return render_template("register.html")
@@ -183,19 +1777,14 @@ def register():
 def forgot_password():
     if request.method=="POST":
         email = request.form.get("email")
-        conn = sqlite3.connect(DB)
-        c = conn.cursor()
-        c.execute("SELECT * FROM users WHERE email=?", (email,))
-        user = c.fetchone()
-        conn.close()
+        with get_db() as conn:
+            user = conn.execute("SELECT * FROM users WHERE email=?", (email,)).fetchone()
         if user:
             code = ''.join(random.choices(string.digits,k=6))
-            CODE_STORE[email] = {"code": code, "time": time.time()}
+            CODE_STORE.put(email, code)
             send_verification_email(email, code)
             # If SMTP isn't configured, show the code in UI for development convenience.
-            smtp_user = os.environ.get('SMTP_USER')
-            smtp_pass = os.environ.get('SMTP_PASS')
-            if not smtp_user or not smtp_pass:
+            if not smtp_configured():
                 flash(f"Verification code (dev): {code}", "info")
             flash("Verification code sent","info")
             return redirect(url_for("reset_password", email=email))
@@ -208,25 +1797,115 @@ def reset_password(email):
     if request.method=="POST":
         code = request.form.get('code')
         password = request.form.get("password")
-        entry = CODE_STORE.get(email)
-        if not entry or entry.get('code') != code or (time.time() - entry.get('time',0))>CODE_EXPIRY:
+        result = CODE_STORE.check(email, code)
+        if result == CODE_INVALID:
+            flash('Invalid code','error')
+            return redirect(url_for('reset_password', email=email))
+        if result == CODE_LOCKED:
+            flash('Too many wrong codes. Request a new one','error')
+            return redirect(url_for('forgot_password'))
+        if result != CODE_OK:
             flash('Invalid or expired code','error')
             return redirect(url_for('forgot_password'))
         if not password_valid(password):
             flash("Password invalid","error")
             return redirect(url_for("reset_password",email=email))
-        conn = sqlite3.connect(DB)
-        c = conn.cursor()
-        pw_hash = generate_password_hash(password)
-        c.execute("UPDATE users SET password=? WHERE email=?",(pw_hash,email))
-        conn.commit()
-        conn.close()
-        CODE_STORE.pop(email,None)
+        pw_hash = hash_password(password)
+        with get_db() as conn:
+            conn.execute("UPDATE users SET password=? WHERE email=?",(pw_hash,email))
+        CODE_STORE.discard(email)
         flash("Password updated","success")
         return redirect(url_for("login"))
     return render_template("reset_password.html", email=email)
 
 # ----- Command queue endpoints -----
+# Long polling: GET /poll-commands/<client_id>?wait=N holds the request until a
+# command is enqueued for that client or N seconds pass. enqueue_command wakes
+# waiters in this process directly; commands enqueued by another worker
+# process are picked up by re-checking the queue every LONG_POLL_RECHECK
+# seconds. Each waiting agent holds a server thread, so run a threaded server.
+LONG_POLL_MAX_WAIT = float(os.environ.get("LONG_POLL_MAX_WAIT", "30"))   # seconds
+LONG_POLL_RECHECK = float(os.environ.get("LONG_POLL_RECHECK", "5"))
+
+_poll_events = {}   # client_id -> threading.Event set on the next enqueue
+_poll_events_lock = threading.Lock()
+
+def _poll_event(client_id):
+    with _poll_events_lock:
+        ev = _poll_events.get(client_id)
+        if ev is None:
+            ev = _poll_events[client_id] = threading.Event()
+        return ev
+
+def notify_client(client_id):
+    # Called after the INSERT is committed. A waiter fetches its event before
+    # querying, so it either sees the new row or gets woken by this set().
+    with _poll_events_lock:
+        ev = _poll_events.pop(client_id, None)
+    if ev:
+        ev.set()
+
+def enqueue_commands(client_ids, command, args=''):
+    """Queue one command for many clients in a single transaction.
+    Returns {client_id: 'queued' | 'duplicate'}; a screenshot is not queued
+    for a client that already has one pending or in flight."""
+    now = time.time()
+    outcomes = {}
+    rows = []
+    with get_db() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        for client_id in client_ids:
+            if client_id in outcomes:
+                continue
+            if command == 'screenshot' and conn.execute(
+                    f"SELECT id FROM commands WHERE client_id=? AND command=? AND status={CMD_PENDING} "
+                    f"UNION ALL SELECT id FROM commands WHERE client_id=? AND command=? AND status={CMD_IN_FLIGHT} LIMIT 1",
+                    (client_id, command, client_id, command)).fetchone():
+                outcomes[client_id] = 'duplicate'
+                continue
+            outcomes[client_id] = 'queued'
+            rows.append((client_id, command, str(args), now, now))
+        conn.executemany('INSERT INTO commands (client_id,command,args,created_at,updated_at) VALUES (?,?,?,?,?)', rows)
+    for row in rows:
+        notify_client(row[0])
+    return outcomes
+
+def claim_commands(client_id):
+    """Lease the client's pending and lease-expired commands to it and return them."""
+    now = time.time()
+    with get_db() as conn:
+        # Cheap index-only reads first so an empty poll never takes the write lock
+        ids = [r[0] for r in conn.execute(
+            f"SELECT id FROM commands WHERE client_id=? AND status={CMD_PENDING} ORDER BY id", (client_id,))]
+        expired = conn.execute(
+            f"SELECT 1 FROM commands WHERE client_id=? AND status={CMD_IN_FLIGHT} AND lease_expires<? LIMIT 1",
+            (client_id, now)).fetchone()
+        if not ids and not expired:
+            return []
+        conn.execute("BEGIN IMMEDIATE")
+        if expired:
+            conn.execute(f"UPDATE commands SET status={CMD_FAILED}, result=?, updated_at=? "
+                         f"WHERE client_id=? AND status={CMD_IN_FLIGHT} AND lease_expires<? AND attempts>=?",
+                         (f"no result after {COMMAND_MAX_ATTEMPTS} deliveries", now, client_id, now, COMMAND_MAX_ATTEMPTS))
+            ids += [r[0] for r in conn.execute(
+                f"SELECT id FROM commands WHERE client_id=? AND status={CMD_IN_FLIGHT} AND lease_expires<?", (client_id, now))]
+        lease = now + COMMAND_LEASE
+        claimed = []
+        for cmd_id in sorted(ids):
+            # re-check the state: a concurrent poll may have claimed it first
+            cur = conn.execute(f"UPDATE commands SET status={CMD_IN_FLIGHT}, lease_expires=?, attempts=attempts+1, updated_at=? "
+                               f"WHERE id=? AND (status={CMD_PENDING} OR (status={CMD_IN_FLIGHT} AND lease_expires<?))",
+                               (lease, now, cmd_id, now))
+            if cur.rowcount:
+                claimed.append(cmd_id)
+        if not claimed:
+            return []
+        marks = ','.join('?' * len(claimed))
+        rows = conn.execute(f"SELECT id, command, args, created_at, attempts FROM commands WHERE id IN ({marks}) ORDER BY id",
+                            claimed).fetchall()
+    return [{'id':r[0],'command':r[1],'args':r[2],'status':CMD_STATUS[CMD_IN_FLIGHT],'created_at':r[3],
+             'attempt':r[4],'lease_expires':lease} for r in rows]
+
 @app.route('/enqueue-command', methods=['POST'])
 def enqueue_command():
     # expected json: {client_id, command, args}
@@ -236,105 +1915,339 @@ def enqueue_command():
     args = data.get('args', '')
     if not client_id or not command:
         return jsonify({'error':'client_id and command required'}), 400
+    outcomes = enqueue_commands([client_id], command, args)
+    if outcomes[client_id] == 'duplicate':
+        return jsonify({'ok': False, 'message': 'screenshot already pending'}), 409
+    return jsonify({'ok':True})
+
+@app.route('/broadcast-command', methods=['POST'])
+def broadcast_command():
+    # expected json: {command, args, and one of: lab, pattern, client_ids, online: true}
+    if 'user_email' not in session:
+        return jsonify({"error":"login required"}), 401
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error':'expected a JSON object'}), 400
+    command = data.get('command')
+    args = data.get('args', '')
+    if not command or not isinstance(command, str):
+        return jsonify({'error':'command required'}), 400
+    for key in ('lab', 'pattern'):
+        if data.get(key) and not isinstance(data[key], str):
+            return jsonify({'error':f'{key} must be a string'}), 400
+    if data.get('lab'):
+        with get_db() as conn:
+            if not conn.execute("SELECT 1 FROM labs WHERE name=?", (data['lab'],)).fetchone():
+                return jsonify({'error':f"unknown lab {data['lab']}"}), 404
+            targets = lab_clients(conn, data['lab'])
+    elif data.get('pattern'):
+        targets = fnmatch.filter(known_clients(), data['pattern'])
+    elif data.get('client_ids'):
+        if not is_client_id_list(data['client_ids']):
+            return jsonify({'error':'client_ids must be a list of strings'}), 400
+        targets = data['client_ids']
+    elif data.get('online'):
+        targets = online_clients()
+    else:
+        return jsonify({'error':'one of lab, pattern, client_ids or online required'}), 400
+    outcomes = enqueue_commands(targets, command, args)
+    queued = sum(1 for o in outcomes.values() if o == 'queued')
+    return jsonify({'ok':True, 'queued':queued, 'results':outcomes})
+
+# ----- Labs (client groups) -----
+def is_client_id_list(value):
+    return isinstance(value, list) and all(isinstance(v, str) for v in value)
+
+def lab_clients(conn, name):
+    rows = conn.execute("SELECT m.client_id FROM lab_members m JOIN labs l ON l.id = m.lab_id "
+                        "WHERE l.name=? ORDER BY m.client_id", (name,)).fetchall()
+    return [r[0] for r in rows]
+
+def online_clients():
     now = time.time()
-    # For safety, prevent duplicate pending 'screenshot' commands for the same client
-    if command == 'screenshot':
-        conn_check = sqlite3.connect(DB)
-        c_check = conn_check.cursor()
-        c_check.execute("SELECT id FROM commands WHERE client_id=? AND command=? AND status='pending'", (client_id, command))
-        if c_check.fetchone():
-            conn_check.close()
-            return jsonify({'ok': False, 'message': 'screenshot already pending'}), 409
-        conn_check.close()
-    conn = sqlite3.connect(DB)
-    c = conn.cursor()
-    c.execute('INSERT INTO commands (client_id,command,args,created_at,updated_at) VALUES (?,?,?,?,?)',
-              (client_id, command, str(args), now, now))
-    conn.commit()
-    conn.close()
+    return sorted(cid for cid, ts in list(heartbeats.items()) if now - ts < HEARTBEAT_TIMEOUT)
+
+def known_clients():
+    # Every client id we know of: dashboard PCs (usernames), lab members and heartbeats
+    with get_db() as conn:
+        ids = {r[0] for r in conn.execute("SELECT username FROM users WHERE username IS NOT NULL")}
+        ids.update(r[0] for r in conn.execute("SELECT client_id FROM lab_members"))
+    ids.update(heartbeats.keys())
+    return sorted(ids)
+
+@app.route('/labs', methods=['GET', 'POST'])
+def labs():
+    if request.method == 'POST':
+        # expected json: {name, clients: [client_id, ...]}; replaces the lab's members
+        if 'user_email' not in session:
+            return jsonify({"error":"login required"}), 401
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({'error':'expected a JSON object'}), 400
+        name = data.get('name')
+        name = name.strip() if isinstance(name, str) else ''
+        clients = data.get('clients', [])
+        if not name or not is_client_id_list(clients):
+            return jsonify({'error':'name and clients (list of strings) required'}), 400
+        with get_db() as conn:
+            conn.execute("INSERT OR IGNORE INTO labs (name, created_at) VALUES (?,?)", (name, time.time()))
+            lab_id = conn.execute("SELECT id FROM labs WHERE name=?", (name,)).fetchone()[0]
+            conn.execute("DELETE FROM lab_members WHERE lab_id=?", (lab_id,))
+            conn.executemany("INSERT OR IGNORE INTO lab_members (lab_id, client_id) VALUES (?,?)",
+                             [(lab_id, cid) for cid in clients])
+        bump_fleet_version()
+        return jsonify({'ok':True, 'name':name, 'clients':len(set(clients))})
+    with get_db() as conn:
+        names = [r[0] for r in conn.execute("SELECT name FROM labs ORDER BY name")]
+        result = {name: lab_clients(conn, name) for name in names}
+    return jsonify({'labs':result})
+
+@app.route('/labs/<name>', methods=['DELETE'])
+def delete_lab(name):
+    if 'user_email' not in session:
+        return jsonify({"error":"login required"}), 401
+    with get_db() as conn:
+        lab = conn.execute("SELECT id FROM labs WHERE name=?", (name,)).fetchone()
+        if not lab:
+            return jsonify({'error':f'unknown lab {name}'}), 404
+        conn.execute("DELETE FROM lab_members WHERE lab_id=?", (lab[0],))
+        conn.execute("DELETE FROM labs WHERE id=?", (lab[0],))
+    bump_fleet_version()
     return jsonify({'ok':True})
 
 @app.route('/poll-commands/<client_id>', methods=['GET','POST'])
 def poll_commands(client_id):
     # Clients call to get pending commands. If POST with result, will update status.
     if request.method=='POST':
-        data = request.get_json() or {}
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({'error':'expected a JSON object'}), 400
         cmd_id = data.get('id')
         status = data.get('status')
         result = data.get('result')
         if not cmd_id:
             return jsonify({'error':'id required'}), 400
-        conn = sqlite3.connect(DB)
-        c = conn.cursor()
-        c.execute('UPDATE commands SET status=?, result=?, updated_at=? WHERE id=?', (status or 'done', str(result), time.time(), cmd_id))
-        conn.commit()
-        conn.close()
+        code = status_code(status)
+        if code is None:
+            return jsonify({'error':'status must be done or failed'}), 400
+        with get_db() as conn:
+            cur = conn.execute('UPDATE commands SET status=?, result=?, updated_at=?, lease_expires=NULL '
+                               'WHERE id=? AND client_id=?', (code, str(result), time.time(), cmd_id, client_id))
+            row = conn.execute('SELECT command FROM commands WHERE id=?', (cmd_id,)).fetchone() if cur.rowcount else None
+        if row is None:
+            return jsonify({'error':f'no command {cmd_id} for {client_id}'}), 404
+        publish_event('command', {'id': cmd_id, 'client_id': client_id, 'command': row[0],
+                                  'status': CMD_STATUS[code], 'result': str(result)[:200]})
         return jsonify({'ok':True})
-    # GET: return pending commands
-    conn = sqlite3.connect(DB)
-    c = conn.cursor()
-    c.execute("SELECT id, command, args, status, created_at FROM commands WHERE client_id=? AND status='pending'", (client_id,))
-    rows = c.fetchall()
-    conn.close()
-    items = [{'id':r[0],'command':r[1],'args':r[2],'status':r[3],'created_at':r[4]} for r in rows]
-    return jsonify({'commands':items})
+    # GET: claim pending commands, optionally waiting up to ?wait=N seconds for one
+    try:
+        wait = max(0.0, min(float(request.args.get('wait', 0)), LONG_POLL_MAX_WAIT))
+    except ValueError:
+        return jsonify({'error':'wait must be a number of seconds'}), 400
+    return jsonify({'commands':wait_for_commands(client_id, wait)})
+
+def wait_for_commands(client_id, wait):
+    """Claim the client's commands, waiting up to `wait` seconds for one to arrive."""
+    deadline = time.time() + wait
+    while True:
+        event = _poll_event(client_id) if wait else None
+        items = claim_commands(client_id)
+        remaining = deadline - time.time()
+        if items or remaining <= 0:
+            return items
+        event.wait(min(remaining, LONG_POLL_RECHECK))
+
+# ----- Agent sync -----
+# One round trip per agent cycle instead of a heartbeat, a poll and a POST per
+# result. POST /sync/<client_id> with
+#   {"results": [{"id", "status", "result"}, ...], "telemetry": {...}, "wait": N}
+# (every key optional) records the heartbeat, stores the results in a single
+# transaction, then claims new commands, long-polling up to N seconds like
+# /poll-commands. The reply is
+#   {"commands": [...], "acked": [ids stored], "poll_interval": seconds}
+# where poll_interval is how long the agent should sleep before its next sync:
+# 0 after commands or a held long poll, SYNC_INTERVAL otherwise. Keep
+# SYNC_INTERVAL well under HEARTBEAT_TIMEOUT, since syncs are the heartbeats.
+SYNC_INTERVAL = float(os.environ.get("SYNC_INTERVAL", "10"))
+SYNC_MAX_RESULTS = 100        # results accepted per sync; the rest are left for the next one
+TELEMETRY_MAX_BYTES = 4096    # larger telemetry payloads are dropped
+
+def record_results(client_id, results):
+    """Store a batch of command results reported by client_id; returns the acked ids.
+    Results for commands that belong to another client are ignored. Raises
+    ValueError, storing nothing, when a result's status isn't final."""
+    now = time.time()
+    rows = []
+    for item in results[:SYNC_MAX_RESULTS]:
+        if not isinstance(item, dict) or item.get('id') is None:
+            continue
+        try:
+            cmd_id = int(item['id'])
+        except (TypeError, ValueError):
+            continue
+        code = status_code(item.get('status'))
+        if code is None:
+            raise ValueError(f"status of command {cmd_id} must be done or failed")
+        rows.append((cmd_id, code, str(item.get('result'))))
+    if not rows:
+        return []
+    acked = []
+    with get_db() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        for cmd_id, code, result in rows:
+            cur = conn.execute('UPDATE commands SET status=?, result=?, updated_at=?, lease_expires=NULL '
+                               'WHERE id=? AND client_id=?', (code, result, now, cmd_id, client_id))
+            if cur.rowcount:
+                acked.append(cmd_id)
+        marks = ','.join('?' * len(acked))
+        names = dict(conn.execute(f'SELECT id, command FROM commands WHERE id IN ({marks})', acked)) if acked else {}
+    for cmd_id, code, result in rows:
+        if cmd_id in names:
+            publish_event('command', {'id': cmd_id, 'client_id': client_id, 'command': names[cmd_id],
+                                      'status': CMD_STATUS[code], 'result': result[:200]})
+    return acked
+
+@app.route('/sync/<client_id>', methods=['POST'])
+def agent_sync(client_id):
+    data = request.get_json(silent=True)
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        return jsonify({'error':'expected a JSON object'}), 400
+    results = data.get('results')
+    telemetry = data.get('telemetry')
+    if not isinstance(results, (list, type(None))) or not isinstance(telemetry, (dict, type(None))):
+        return jsonify({'error':'results must be a list and telemetry an object'}), 400
+    results = results or []
+    try:
+        wait = max(0.0, min(float(data.get('wait') or 0), LONG_POLL_MAX_WAIT))
+    except (TypeError, ValueError):
+        return jsonify({'error':'wait must be a number of seconds'}), 400
+    record_heartbeat(client_id)
+    if telemetry and len(json.dumps(telemetry)) <= TELEMETRY_MAX_BYTES:
+        with get_db() as conn:
+            conn.execute("INSERT OR REPLACE INTO client_telemetry (client_id, received_at, data) VALUES (?,?,?)",
+                         (client_id, time.time(), json.dumps(telemetry)))
+    try:
+        acked = record_results(client_id, results)
+    except ValueError as e:
+        return jsonify({'error':str(e)}), 400
+    started = time.time()
+    items = wait_for_commands(client_id, wait)
+    held = wait and time.time() - started >= wait / 2
+    if held:
+        record_heartbeat(client_id)   # we were connected the whole time
+    return jsonify({'commands':items, 'acked':acked,
+                    'poll_interval': 0 if items or held else SYNC_INTERVAL})
+
+# ----- Rendered page cache -----
+# The dashboard and pending-approvals pages only change with the fleet state
+# version, so each is rendered once per version (per variant, e.g. admin or
+# not) and the bytes are kept with a gzipped copy and an ETag. A page is
+# rebuilt on the first request after the version moves. The version is read
+# before rendering, so a change that lands mid-render invalidates the result.
+PAGE_GZIP_LEVEL = 6
+
+_pages = {}          # (page, variant) -> (version, html bytes, gzipped bytes, etag)
+_pages_lock = threading.Lock()
+
+def cached_page(page, variant, render):
+    """Serve `page` from the cache, calling render() -> str on a miss."""
+    version = fleet_version()
+    entry = _pages.get((page, variant))
+    if entry is None or entry[0] != version:
+        page_cache.inc((page, "miss"))
+        body = render().encode("utf-8")
+        entry = (version, body, gzip.compress(body, PAGE_GZIP_LEVEL), hashlib.sha1(body).hexdigest())
+        with _pages_lock:
+            current = _pages.get((page, variant))
+            if current is None or current[0] <= version:
+                _pages[(page, variant)] = entry
+    else:
+        page_cache.inc((page, "hit"))
+    _, body, gzipped, etag = entry
+    resp = Response(mimetype="text/html")
+    if request.accept_encodings.quality("gzip") > 0:
+        resp.set_data(gzipped)
+        resp.headers["Content-Encoding"] = "gzip"
+        resp.set_etag(etag + "-gz")
+    else:
+        resp.set_data(body)
+        resp.set_etag(etag)
+    resp.headers["Vary"] = "Accept-Encoding, Cookie"
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp.make_conditional(request)
+
+DASHBOARD_PENDING_LIMIT = 10   # pending users listed inline on the dashboard
 
 @app.route("/dashboard")
 def dashboard():
     if 'user_email' not in session:
         return redirect(url_for("login"))
+    fleet.sync()
+    fleet.advance()   # may bump the version, so before the cache lookup
+    is_admin = session.get('role') == "Admin"
+    return cached_page("dashboard", is_admin, lambda: render_dashboard(is_admin))
 
-    conn = sqlite3.connect(DB)
-    c = conn.cursor()
-    # Pending approvals for admins
-    if session.get('role') == "Admin":
-        c.execute("SELECT id, username, email FROM users WHERE approved=0")
-        pending_users = c.fetchall()
-    else:
-        pending_users = []
-
-    # Simulated PC statuses
-    pcs = []
-    c.execute("SELECT id, username FROM users")
-    users = c.fetchall()
-    for u in users:
-        status = random.choice(["Online","Idle","Offline"])
-        pcs.append({"id":u[1], "status":status})
-
-    pcs_total = len(pcs)
-    pcs_online = sum(1 for p in pcs if p['status']=="Online")
-    pcs_idle = sum(1 for p in pcs if p['status']=="Idle")
-    pcs_offline = sum(1 for p in pcs if p['status']=="Offline")
-
-    conn.close()
-    now_ts = int(time.time())
-    return render_template("dashboard.html", pending_users=pending_users,
-                           pcs=pcs, pcs_total=pcs_total, pcs_online=pcs_online,
+def render_dashboard(is_admin):
+    # The page is the same size whatever the fleet size: the PC grid is filled
+    # from /fleet by the browser, and only the first few pending users are inlined.
+    with get_db() as conn:
+        c = conn.cursor()
+        # Pending approvals for admins
+        if is_admin:
+            c.execute("SELECT id, username, email FROM users WHERE approved=0 ORDER BY id LIMIT ?",
+                      (DASHBOARD_PENDING_LIMIT,))
+            pending_users = c.fetchall()
+            pending_count = c.execute("SELECT COUNT(*) FROM users WHERE approved=0").fetchone()[0]
+        else:
+            pending_users, pending_count = [], 0
+        lab_names = [r[0] for r in c.execute("SELECT name FROM labs ORDER BY name")]
+
+    counts = fleet.snapshot(refresh=False)
+    pcs_total, pcs_online = counts["total"], counts["online"]
+    pcs_idle, pcs_offline = counts["idle"], counts["offline"]
+    return render_template("dashboard.html", pending_users=pending_users, pending_count=pending_count,
+                           pcs_total=pcs_total, pcs_online=pcs_online,
                            pcs_idle=pcs_idle, pcs_offline=pcs_offline,
-                           heartbeats=heartbeats, now=now_ts)
+                           labs=lab_names, fleet_page_size=FLEET_PAGE_SIZE)
+
+@app.route("/pending-approvals")
+def pending_approvals():
+    if 'user_email' not in session:
+        return redirect(url_for("login"))
+    if session.get('role') != "Admin":
+        return redirect(url_for("dashboard"))
+    return cached_page("pending_approvals", True, render_pending_approvals)
+
+def render_pending_approvals():
+    with get_db() as conn:
+        pending_users = conn.execute("SELECT id, username, email FROM users WHERE approved=0 ORDER BY id").fetchall()
+    return render_template("pending_approvals.html", pending_users=pending_users)
 
 @app.route("/approve-user/<int:user_id>", methods=["POST"])
 def approve_user(user_id):
-    conn = sqlite3.connect(DB)
-    c = conn.cursor()
-    c.execute("UPDATE users SET approved=1 WHERE id=?",(user_id,))
-    c.execute("SELECT email FROM users WHERE id=?",(user_id,))
-    email = c.fetchone()[0]
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("UPDATE users SET approved=1 WHERE id=?",(user_id,))
+        c.execute("SELECT email FROM users WHERE id=?",(user_id,))
+        email = c.fetchone()[0]
+    bump_fleet_version()
     flash("User approved","success")
     return jsonify({"ok":True})
 
 @app.route("/reject-user/<int:user_id>", methods=["POST"])
 def reject_user(user_id):
     reason = request.form.get("reason")
-    conn = sqlite3.connect(DB)
-    c = conn.cursor()
-    c.execute("SELECT email FROM users WHERE id=?",(user_id,))
-    email = c.fetchone()[0]
-    c.execute("DELETE FROM users WHERE id=?",(user_id,))
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("SELECT email, username FROM users WHERE id=?",(user_id,))
+        email, username = c.fetchone()
+        c.execute("DELETE FROM users WHERE id=?",(user_id,))
+    if username and username not in heartbeats:
+        fleet.forget(username)
+        publish_event('removed', {'client_id': username})   # the other workers' pumps forget it too
+    bump_fleet_version()
     send_rejection_email(email, reason)
     flash("User rejected and email sent","error")
     return jsonify({"ok":True})
@@ -346,36 +2259,311 @@ def logout():
 
 @app.route("/heartbeatz/<client_id>", methods=["POST"])
 def heartbeat(client_id):
-    heartbeats[client_id] = time.time()
+    record_heartbeat(client_id)
     return jsonify({client_id:"alive"})
 
+def record_heartbeat(client_id):
+    now = time.time()
+    heartbeats[client_id] = now
+    fleet.heartbeat(client_id, now)   # publishes a presence event if the status changed
+
 @app.route("/status/<client_id>")
 def status(client_id):
-    if client_id not in heartbeats:
+    last_seen = heartbeats.get(client_id)
+    if last_seen is None:
         return jsonify({"status":"Unknown"})
-    last_seen = time.time() - heartbeats[client_id]
-    return jsonify({"status":"Online" if last_seen<60 else "Offline"})
+    reply = {"status": status_for(last_seen, time.time())}
+    with get_db() as conn:
+        row = conn.execute("SELECT received_at, data FROM client_telemetry WHERE client_id=?", (client_id,)).fetchone()
+    if row:
+        reply["telemetry_at"], reply["telemetry"] = row[0], json.loads(row[1])
+    return jsonify(reply)
+
+@app.route("/fleet/status")
+def fleet_status():
+    # Running counters, no per-client work
+    counts = fleet.snapshot()
+    counts.update(online_within=HEARTBEAT_TIMEOUT, idle_within=IDLE_TIMEOUT, as_of=time.time())
+    resp = jsonify(counts)
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+# Paged fleet listing for the dashboard, which renders only the rows on screen
+# and fetches pages as they scroll into view:
+#   GET /fleet?status=online,idle&lab=<name>&sort=-last_seen&limit=100&after=<cursor>
+# Paging is keyset-based: `next` is an opaque cursor holding the sort key of
+# the last row returned, so PCs appearing or changing status between requests
+# don't shift or repeat later pages. Sort keys end with the client id, which
+# keeps them unique.
+STATUS_RANK = {ONLINE: 0, IDLE: 1, OFFLINE: 2}
+FLEET_SORTS = {
+    'id': lambda client_id, status, last_seen: (client_id,),
+    'status': lambda client_id, status, last_seen: (STATUS_RANK[status], client_id),
+    'last_seen': lambda client_id, status, last_seen: (last_seen or 0.0, client_id),
+}
+FLEET_PAGE_SIZE = 100
+FLEET_PAGE_MAX = 500
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor; raises ValueError on anything malformed."""
+    key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    if not isinstance(key, list):
+        raise ValueError('cursor is not a sort key')
+    return tuple(key)
+
+@app.route("/fleet")
+def fleet_list():
+    if 'user_email' not in session:
+        return jsonify({"error":"login required"}), 401
+    sort = request.args.get('sort', 'id')
+    descending = sort.startswith('-')
+    sort_key = FLEET_SORTS.get(sort.lstrip('-'))
+    if sort_key is None:
+        return jsonify({'error':'sort must be one of ' + ', '.join(sorted(FLEET_SORTS)) + ' (prefix - for descending)'}), 400
+    wanted = {s.strip().capitalize() for s in request.args.get('status', '').split(',') if s.strip()}
+    if wanted - set(STATUS_RANK):
+        return jsonify({'error':'status must be online, idle and/or offline'}), 400
+    try:
+        limit = max(1, min(int(request.args.get('limit', FLEET_PAGE_SIZE)), FLEET_PAGE_MAX))
+        after = decode_cursor(request.args['after']) if request.args.get('after') else None
+    except ValueError:
+        return jsonify({'error':'bad limit or cursor'}), 400
+
+    fleet.sync()
+    fleet.advance()
+    lab = request.args.get('lab')
+    if lab:
+        with get_db() as conn:
+            if not conn.execute("SELECT 1 FROM labs WHERE name=?", (lab,)).fetchone():
+                return jsonify({'error':f'unknown lab {lab}'}), 404
+            members = lab_clients(conn, lab)
+        fleet.statuses(members)   # lab members that never reported count as Offline
+        members = set(members)
+        rows = [r for r in fleet.entries() if r[0] in members]
+    else:
+        rows = fleet.entries()
+    if wanted:
+        rows = [r for r in rows if r[1] in wanted]
+
+    rows = sorted(((sort_key(*r), r) for r in rows), key=lambda kr: kr[0])
+    keys = [kr[0] for kr in rows]
+    try:
+        if descending:
+            end = bisect.bisect_left(keys, after) if after else len(rows)
+            page = rows[max(0, end - limit):end][::-1]
+            more = end - limit > 0
+        else:
+            start = bisect.bisect_right(keys, after) if after else 0
+            page = rows[start:start + limit]
+            more = start + limit < len(rows)
+    except TypeError:   # a cursor from a different sort
+        return jsonify({'error':'cursor does not match sort'}), 400
+    shots = latest_screenshots([r[0] for _, r in page])
+    items = [{'id': client_id, 'status': status, 'last_seen': last_seen,
+              'thumb_url': thumbnail_url(client_id, shots.get(client_id))}
+             for _, (client_id, status, last_seen) in page]
+    resp = jsonify({'items': items, 'total': len(rows), 'sort': sort,
+                    'next': encode_cursor(page[-1][0]) if page and more else None})
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")   # when set, scrapers must send "Authorization: Bearer <token>"
+
+@app.route("/metrics")
+def metrics():
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return Response("unauthorized\n", status=401, mimetype="text/plain")
+    with get_db() as conn:
+        # Two queries so each one reads only its partial index
+        queued = {(r[0], "pending"): r[1] for r in conn.execute(
+            f"SELECT client_id, count(*) FROM commands WHERE status={CMD_PENDING} GROUP BY client_id")}
+        queued.update({(r[0], "in_flight"): r[1] for r in conn.execute(
+            f"SELECT client_id, count(*) FROM commands WHERE status={CMD_IN_FLIGHT} GROUP BY client_id")})
+        outbox = {("pending",): 0, ("failed",): 0}
+        outbox.update({("failed" if r[0] == OUTBOX_FAILED else "pending",): r[1] for r in conn.execute(
+            "SELECT status, count(*) FROM email_outbox GROUP BY status")})
+    with _subscribers_lock:
+        subscribers = len(_subscribers)
+    gauges = [
+        ("lab_commands_queued", "Commands waiting for (pending) or leased to (in_flight) each client.",
+         ("client_id", "status"), queued),
+        ("lab_heartbeat_clients", "Clients with a recorded heartbeat (shared across workers and restarts).", (), {(): len(heartbeats)}),
+        ("lab_fleet_clients", "Known clients by Online/Idle/Offline status.",
+         ("status",), {(k,): v for k, v in fleet.snapshot().items() if k != "total"}),
+        ("lab_sse_subscribers", "Open dashboard /events streams.", (), {(): subscribers}),
+        ("lab_email_outbox", "Queued outgoing emails: pending (incl. retrying) or failed.", ("status",), outbox),
+        ("lab_db_pool_idle", "Idle pooled SQLite connections.", (), {(): _db_pool.qsize()}),
+    ]
+    return Response(render_metrics(gauges), mimetype="text/plain; version=0.0.4")
+
+@app.route("/events")
+def events():
+    if 'user_email' not in session:
+        return jsonify({"error":"login required"}), 401
+    q = subscribe_events()
+
+    def stream():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    yield q.get(timeout=SSE_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+        finally:
+            unsubscribe_events(q)
+
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.route("/upload/<client_id>", methods=["POST"])
 def upload_screenshot(client_id):
-    if "screenshot" not in request.files:
-        return jsonify({"msg":"No screenshot file"}), 400
-    screenshot = request.files["screenshot"]
-    path = f"static/screenshots/{client_id}.png"
-    screenshot.save(path)
-    return jsonify({"msg":"Screenshot uploaded"})
+    # Either multipart (field "screenshot") or the raw image as the body
+    if request.content_length and request.content_length > app.config["MAX_CONTENT_LENGTH"]:
+        return jsonify({"msg":f"Screenshot larger than {SCREENSHOT_MAX_BYTES} bytes"}), 413
+    try:
+        if request.mimetype in RAW_UPLOAD_TYPES:
+            stream = request.stream
+        elif "screenshot" in request.files:
+            stream = request.files["screenshot"].stream
+        else:
+            return jsonify({"msg":"No screenshot file"}), 400
+        shot = save_screenshot(client_id, stream)
+    except RequestEntityTooLarge:
+        return jsonify({"msg":f"Screenshot larger than {SCREENSHOT_MAX_BYTES} bytes"}), 413
+    except UnsupportedMediaType:
+        return jsonify({"msg":"Unsupported image format (expected PNG, JPEG or WebP)"}), 415
+    phash = (request.args.get("phash") or request.form.get("phash") or "").lower()
+    with get_db() as conn:
+        if _PHASH_RE.fullmatch(phash):
+            conn.execute("INSERT OR REPLACE INTO screenshot_phash (client_id, phash, updated_at) VALUES (?,?,?)",
+                         (client_id, phash, time.time()))
+        else:
+            conn.execute("DELETE FROM screenshot_phash WHERE client_id=?", (client_id,))
+    try:
+        make_thumbnails(store_path(shot["hash"], shot["format"]), shot["hash"])
+    except Exception as e:
+        print('Thumbnail generation failed for', client_id, e)
+    screenshot_bytes.inc(amount=shot["size"])
+    screenshot_uploads.inc(("stored",))
+    bump_fleet_version()
+    publish_event('screenshot', screenshot_payload(client_id, shot))
+    return jsonify({"msg":"Screenshot uploaded", "format": shot["format"], "bytes": shot["size"], "hash": shot["hash"]})
+
+@app.route("/screenshot-unchanged/<client_id>", methods=["POST"])
+def screenshot_unchanged(client_id):
+    # expected json: {phash}. 200 when it matches the stored screenshot closely
+    # enough; 409 tells the agent to upload the full image instead.
+    data = request.get_json(silent=True)
+    phash = data.get("phash") if isinstance(data, dict) else None
+    phash = phash.lower() if isinstance(phash, str) else ""
+    if not _PHASH_RE.fullmatch(phash):
+        return jsonify({"error":"phash (hex) required"}), 400
+    with get_db() as conn:
+        row = conn.execute("SELECT phash FROM screenshot_phash WHERE client_id=?", (client_id,)).fetchone()
+    shot = latest_screenshot(client_id)
+    if row is None or shot is None:
+        return jsonify({"unchanged": False, "reason": "no stored screenshot"}), 409
+    distance = phash_distance(phash, row[0])
+    if distance > SCREENSHOT_PHASH_THRESHOLD:
+        return jsonify({"unchanged": False, "distance": distance}), 409
+    with get_db() as conn:
+        conn.execute("UPDATE screenshot_phash SET updated_at=? WHERE client_id=?", (time.time(), client_id))
+    screenshot_uploads.inc(("unchanged",))
+    publish_event('screenshot', dict(screenshot_payload(client_id, shot), unchanged=True))
+    return jsonify({"unchanged": True, "distance": distance})
 
 
 @app.route('/screenshot/<client_id>', methods=['GET'])
 def screenshot_info(client_id):
-    # Provide info about a screenshot: exists, mtime and a url with cache-busting mtime
-    path = os.path.join('static', 'screenshots', f"{client_id}.png")
-    exists = os.path.exists(path)
-    mtime = int(os.path.getmtime(path)) if exists else 0
-    url = url_for('static', filename=f'screenshots/{client_id}.png')
-    if exists:
-        url = f"{url}?t={mtime}"
-    return jsonify({"exists": exists, "mtime": mtime, "url": url})
+    # Provide info about the latest screenshot; the url is content-addressed
+    # Clients poll this, so it carries a strong ETag over the payload and
+    # answers a matching If-None-Match with an empty 304
+    shot = latest_screenshot(client_id)
+    payload = {"exists": False, "mtime": 0, "url": None} if shot is None else screenshot_payload(client_id, shot)
+    resp = jsonify(payload)
+    resp.set_etag(hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest())
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp.make_conditional(request)
+
+@app.route('/screenshots/<client_id>/history', methods=['GET'])
+def screenshot_history(client_id):
+    limit = min(request.args.get('limit', 20, type=int) or 20, SCREENSHOT_HISTORY_COUNT)
+    with get_db() as conn:
+        rows = conn.execute("SELECT hash, format, size, taken_at FROM screenshots WHERE client_id=? "
+                            "ORDER BY taken_at DESC, id DESC LIMIT ?", (client_id, limit)).fetchall()
+    return jsonify({"client_id": client_id, "screenshots": [
+        {"hash": r[0], "format": r[1], "size": r[2], "taken_at": r[3], "url": stored_url(r[0], r[1])} for r in rows]})
+
+@app.route('/screenshots/<name>')
+def screenshot_file(name):
+    m = _STORED_NAME_RE.fullmatch(name)
+    if not m:
+        abort(404)
+    digest = m.group(1)
+    folder = os.path.abspath(os.path.join(SCREENSHOT_STORE, digest[:2], digest[2:4]))
+    resp = send_from_directory(folder, name, max_age=SCREENSHOT_MAX_AGE, etag=digest)
+    resp.headers['Cache-Control'] = f'public, max-age={SCREENSHOT_MAX_AGE}, immutable'
+    return resp
+
+@app.route('/thumbnail/<client_id>/<size>')
+def thumbnail(client_id, size):
+    # Resolve a client's current thumbnail and redirect to its content-addressed URL
+    if size not in THUMB_SIZES:
+        abort(404)
+    shot = latest_screenshot(client_id)
+    if shot is None:
+        abort(404)
+    return redirect(thumbnail_url(client_id, shot, size))
+
+@app.route('/thumbs/<name>')
+def thumbnail_file(name):
+    # The name is "<hash>-<size>.jpg", which makes a fine strong ETag
+    m = _THUMB_NAME_RE.fullmatch(name)
+    if not m or m.group(2) not in THUMB_SIZES:
+        abort(404)
+    if not os.path.exists(os.path.join(THUMB_DIR, name)):
+        # Not made yet: generate every size from the stored source
+        digest = m.group(1)
+        with get_db() as conn:
+            row = conn.execute("SELECT format FROM screenshots WHERE hash=? LIMIT 1", (digest,)).fetchone()
+        if row is None or Image is None:
+            abort(404)
+        try:
+            make_thumbnails(store_path(digest, row[0]), digest)
+        except OSError:   # the source was pruned meanwhile
+            abort(404)
+    resp = send_from_directory(os.path.abspath(THUMB_DIR), name, max_age=THUMB_MAX_AGE,
+                               etag=os.path.splitext(name)[0])
+    resp.headers['Cache-Control'] = f'public, max-age={THUMB_MAX_AGE}, immutable'
+    return resp
+
+# ----- Process lifecycle (used by serve.py) -----
+
+def close_db_pool():
+    """Close the idle pooled connections. The prefork master calls this before
+    forking: a SQLite connection must never be used on both sides of a fork."""
+    while True:
+        try:
+            _db_pool.get_nowait().close()
+        except queue.Empty:
+            return
+
+def after_fork(worker_index=0):
+    """Per-worker startup after the master forked us."""
+    global heartbeats
+    close_db_pool()
+    # flock locks belong to the open file, which is shared with the master
+    # after fork, so each worker opens the registry itself
+    heartbeats.close()
+    heartbeats = HeartbeatRegistry(HEARTBEAT_FILE)
+    start_outbox()          # every worker: rows are claimed, and enqueues wake the local sender
+    start_event_pump()      # every worker: it feeds this worker's /events streams
+    if worker_index == 0:
+        start_retention()   # one retention pass per interval is enough
 
 if __name__=="__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -2,23 +2,38 @@
 simulate_many_clients.py
 
 Creates test users in the local `users.db` (if missing) and runs N simulated clients
-on the same machine. Each client polls the server for commands and handles:
+on the same machine. Each client syncs with the server (POST /sync/<client_id>:
+heartbeat, command results and new commands in one request) and handles:
  - screenshot: uploads a small placeholder PNG
  - restart/shutdown: replies with simulated result
 
+Two modes:
+ - thread (default): one OS thread and one requests.Session per client
+ - async: every client is a coroutine on a single event loop sharing one
+   connection-limited HTTP client, which scales to thousands of clients
+
 Usage:
   python simulate_many_clients.py --num 5 --base sim
+  python simulate_many_clients.py --mode async --num 5000 --connections 200 \
+      --ramp-up 60 --ramp-profile linear --shot-size 1280x720,1920x1080
+  python simulate_many_clients.py --mode async --num 500 --protocol legacy   # separate heartbeat/poll/result calls
 
 Environment:
   SERVER (default http://127.0.0.1:5000)
 """
 import argparse
+import asyncio
+import collections
+import json
+import random
+import ssl
 import threading
 import time
 import io
 import base64
 import sqlite3
 import os
+from urllib.parse import urlsplit
 import requests
 
 try:
@@ -40,11 +55,11 @@ def ensure_users(clients, db_path='users.db'):
         return
     conn = sqlite3.connect(db_path)
     c = conn.cursor()
+    pw = generate_password_hash('SimPass123!')  # hashing is slow; share it across thousands of users
     for cl in clients:
         c.execute('SELECT id FROM users WHERE username=?', (cl,))
         if not c.fetchone():
             email = f"{cl}@example.com"
-            pw = generate_password_hash('SimPass123!')
             try:
                 c.execute('INSERT INTO users (username,email,password,role,approved) VALUES (?,?,?,?,?)',
                           (cl, email, pw, 'Teacher', 1))
@@ -78,32 +93,25 @@ def generate_screenshot_bytes(client_id):
         return base64.b64decode(PLACEHOLDER_PNG_B64)
 
 
-def heartbeat_loop(server, client_id, interval=15, session=None, stop_event=None):
-    if session is None:
-        session = requests.Session()
-    while not (stop_event and stop_event.is_set()):
-        try:
-            session.post(f"{server}/heartbeatz/{client_id}", timeout=8)
-        except Exception as e:
-            print(f"[{client_id}] Heartbeat failed: {e}")
-        time.sleep(interval)
+SYNC_MAX_RESULTS = 100   # the server applies at most this many results per sync
 
 
-def client_thread_loop(server, client_id, poll_interval=5, heartbeat_interval=15, stop_event=None):
+def client_thread_loop(server, client_id, poll_interval=5, stop_event=None):
     session = requests.Session()
     session.headers.update({'User-Agent': f'Simulator/{client_id}'})
     png_bytes = generate_screenshot_bytes(client_id)
-    # Start heartbeat in this thread's context if configured
-    hb_last = 0
+    results = []   # delivered with the next sync
     while not (stop_event and stop_event.is_set()):
+        interval = poll_interval
         try:
-            # poll for commands
-            r = session.get(f"{server}/poll-commands/{client_id}", timeout=10)
+            batch = results[:SYNC_MAX_RESULTS]
+            r = session.post(f"{server}/sync/{client_id}", json={'results': batch}, timeout=10)
             if r.status_code != 200:
                 # server might be down
                 time.sleep(poll_interval)
                 continue
             data = r.json()
+            results = results[len(batch):]
             for cmd in data.get('commands', []):
                 cid = cmd.get('id')
                 command = cmd.get('command')
@@ -129,23 +137,336 @@ def client_thread_loop(server, client_id, poll_interval=5, heartbeat_interval=15
                     result = f'simulated {command} successfully'
                 else:
                     result = f'unknown command {command}'
-                # report back
-                try:
-                    session.post(f"{server}/poll-commands/{client_id}", json={'id':cid,'status':'done','result':result}, timeout=8)
-                except Exception as e:
-                    print(f"[{client_id}] Failed to report result: {e}")
+                results.append({'id': cid, 'status': 'done', 'result': result})
+            interval = 0 if len(results) > SYNC_MAX_RESULTS else float(data.get('poll_interval', poll_interval))
         except Exception as e:
-            print(f"[{client_id}] Poll error: {e}")
+            print(f"[{client_id}] Sync error: {e}")
+        time.sleep(interval)
+
+
+# ----- asyncio mode -----
+
+class SimResponse:
+    def __init__(self, status, headers, body):
+        self.status_code = status
+        self.headers = headers
+        self.content = body
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self):
+        return json.loads(self.content or b'null')
+
+
+class AsyncHTTPClient:
+    """Minimal HTTP/1.1 client on asyncio streams, shared by every simulated
+    agent. At most `limit` connections are open at once; idle ones are kept
+    alive and reused unless the server closes them."""
+
+    def __init__(self, base_url, limit=100, timeout=15):
+        u = urlsplit(base_url)
+        self.host = u.hostname
+        self.port = u.port or (443 if u.scheme == 'https' else 80)
+        self.ssl = ssl.create_default_context() if u.scheme == 'https' else None
+        self.host_header = u.netloc
+        self.timeout = timeout
+        self._slots = asyncio.Semaphore(limit)
+        self._idle = []
+
+    async def request(self, method, path, body=b'', json_body=None, headers=None, timeout=None):
+        if json_body is not None:
+            body = json.dumps(json_body).encode()
+            headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host_header}",
+                 f"Content-Length: {len(body)}", "Connection: keep-alive"]
+        lines += [f"{k}: {v}" for k, v in (headers or {}).items()]
+        raw = ("\r\n".join(lines) + "\r\n\r\n").encode() + body
+        async with self._slots:
+            return await asyncio.wait_for(self._send(raw, method), timeout or self.timeout)
+
+    async def _send(self, raw, method):
+        # A reused connection may have been closed by the server while idle;
+        # retry once on a fresh one if it fails before any response arrives
+        for attempt in range(2):
+            reused = bool(self._idle)
+            reader, writer = self._idle.pop() if reused else \
+                await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+            try:
+                writer.write(raw)
+                await writer.drain()
+                status_line = await reader.readline()
+                if not status_line:
+                    raise ConnectionResetError('connection closed')
+            except (ConnectionError, OSError):
+                writer.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+            except BaseException:   # timed out or cancelled by wait_for
+                writer.close()
+                raise
+            try:
+                resp, keep_alive = await self._read_response(reader, status_line, method)
+            except BaseException:
+                writer.close()
+                raise
+            if keep_alive:
+                self._idle.append((reader, writer))
+            else:
+                writer.close()
+            return resp
+
+    async def _read_response(self, reader, status_line, method):
+        version, status = status_line.split(None, 2)[:2]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            k, _, v = line.decode('latin-1').partition(':')
+            headers[k.strip().lower()] = v.strip()
+        status = int(status)
+        keep_alive = headers.get('connection', '').lower() != 'close' and version == b'HTTP/1.1'
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            body = b''
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            body = await reader.read()
+            keep_alive = False
+        return SimResponse(status, headers, body), keep_alive
+
+    def close(self):
+        for _, writer in self._idle:
+            writer.close()
+        self._idle.clear()
+
+
+class FleetStats:
+    """Request counts and latencies per endpoint for the async fleet."""
+
+    LATENCY_WINDOW = 5000   # latest samples per endpoint used for percentiles
 
-        # send heartbeat periodically (if configured)
+    def __init__(self):
+        self.started = time.time()
+        self.agents = 0
+        self.requests = {}
+        self.errors = {}
+        self.latencies = {}
+        self.bytes_uploaded = 0
+
+    def record(self, endpoint, seconds, ok=True):
+        self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+        window = self.latencies.get(endpoint)
+        if window is None:
+            window = self.latencies[endpoint] = collections.deque(maxlen=self.LATENCY_WINDOW)
+        window.append(seconds)
+        if not ok:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def summary(self):
+        total = sum(self.requests.values())
+        elapsed = max(time.time() - self.started, 1e-9)
+        parts = [f"agents={self.agents}", f"requests={total}", f"rps={total / elapsed:.1f}",
+                 f"errors={sum(self.errors.values())}", f"uploaded={self.bytes_uploaded / 1e6:.1f}MB"]
+        for endpoint, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            p50 = values[len(values) // 2]
+            p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+            parts.append(f"{endpoint} p50={p50 * 1000:.0f}ms p95={p95 * 1000:.0f}ms")
+        return " ".join(parts)
+
+
+def parse_shot_sizes(spec):
+    sizes = []
+    for part in spec.split(','):
+        w, _, h = part.strip().lower().partition('x')
+        sizes.append((int(w), int(h)))
+    return sizes
+
+
+def screenshot_variants(sizes, count=4):
+    """Pre-render `count` distinct PNGs per size so agents don't burn the
+    event loop encoding images. Random blocks keep the files about as hard
+    to compress as a real desktop."""
+    try:
+        from PIL import Image, ImageDraw
+    except Exception:
+        return {size: [base64.b64decode(PLACEHOLDER_PNG_B64)] for size in sizes}
+    variants = {}
+    for w, h in sizes:
+        images = []
+        for n in range(count):
+            rnd = random.Random(f"{w}x{h}-{n}")
+            img = Image.new('RGB', (w, h), color=(70, 130, 180))
+            d = ImageDraw.Draw(img)
+            for _ in range(60):
+                x, y = rnd.randrange(w), rnd.randrange(h)
+                d.rectangle([x, y, x + rnd.randrange(20, max(21, w // 4)), y + rnd.randrange(10, max(11, h // 6))],
+                            fill=tuple(rnd.randrange(256) for _ in range(3)))
+            d.text((10, 10), f"simulated screen {n} {w}x{h}", fill=(255, 255, 255))
+            buf = io.BytesIO()
+            img.save(buf, format='PNG')
+            images.append(buf.getvalue())
+        variants[(w, h)] = images
+    return variants
+
+
+def ramp_delay(index, total, profile, ramp_up, steps=10):
+    """Seconds after start at which agent `index` of `total` comes online."""
+    if ramp_up <= 0 or profile == 'instant':
+        return 0.0
+    if profile == 'step':
+        step = index * steps // max(total, 1)
+        return ramp_up * step / steps
+    return ramp_up * index / max(total, 1)   # linear
+
+
+def jittered(interval, jitter):
+    return max(0.0, interval * random.uniform(1 - jitter, 1 + jitter))
+
+
+async def timed(stats, endpoint, coro):
+    start = time.perf_counter()
+    try:
+        resp = await coro
+    except Exception:
+        stats.record(endpoint, time.perf_counter() - start, ok=False)
+        raise
+    stats.record(endpoint, time.perf_counter() - start, ok=resp.ok)
+    return resp
+
+
+async def async_heartbeat_loop(http, client_id, opts, stats, stop):
+    while not stop.is_set():
         try:
-            now = time.time()
-            if now - hb_last > heartbeat_interval:
-                session.post(f"{server}/heartbeatz/{client_id}", timeout=6)
-                hb_last = now
-        except Exception:
-            pass
-        time.sleep(poll_interval)
+            await timed(stats, 'heartbeat', http.request('POST', f"/heartbeatz/{client_id}"))
+        except Exception as e:
+            if opts.verbose:
+                print(f"[{client_id}] Heartbeat failed: {e!r}")
+        await asyncio.sleep(jittered(opts.heartbeat, opts.jitter))
+
+
+async def simulate_command(http, client_id, cmd, opts, stats, shots, ua):
+    command = cmd.get('command')
+    if opts.verbose:
+        print(f"[{client_id}] Got command {cmd.get('id')} {command} {cmd.get('args')}")
+    if command == 'screenshot':
+        png = random.choice(shots)
+        up = await timed(stats, 'upload', http.request(
+            'POST', f"/upload/{client_id}", body=png, headers=dict(ua, **{'Content-Type': 'image/png'})))
+        if up.ok:
+            stats.bytes_uploaded += len(png)
+        return 'screenshot uploaded (simulated)' if up.ok else f'upload failed {up.status_code}'
+    if command in ('restart', 'shutdown'):
+        await asyncio.sleep(2)
+        return f'simulated {command} successfully'
+    return f'unknown command {command}'
+
+
+async def async_client_loop(http, client_id, opts, stats, shots, stop):
+    # --protocol legacy: poll, then one POST per result (heartbeats run alongside)
+    ua = {'User-Agent': f'Simulator/{client_id}'}
+    poll_path = f"/poll-commands/{client_id}" + (f"?wait={opts.long_poll}" if opts.long_poll else "")
+    while not stop.is_set():
+        try:
+            r = await timed(stats, 'poll', http.request('GET', poll_path, headers=ua,
+                                                      timeout=opts.long_poll + 15))
+            commands = r.json().get('commands', []) if r.status_code == 200 else []
+            for cmd in commands:
+                result = await simulate_command(http, client_id, cmd, opts, stats, shots, ua)
+                await timed(stats, 'report', http.request(
+                    'POST', f"/poll-commands/{client_id}", headers=ua,
+                    json_body={'id': cmd.get('id'), 'status': 'done', 'result': result}))
+        except Exception as e:
+            if opts.verbose:
+                print(f"[{client_id}] Poll error: {e!r}")
+        await asyncio.sleep(jittered(opts.poll, opts.jitter))
+
+
+async def async_sync_loop(http, client_id, opts, stats, shots, stop):
+    # --protocol sync: one request per cycle, paced by the server's poll_interval
+    ua = {'User-Agent': f'Simulator/{client_id}'}
+    results = []
+    telemetry = {'agent': 'simulator', 'shot_bytes': len(shots[0])}
+    while not stop.is_set():
+        interval = opts.poll
+        try:
+            batch = results[:SYNC_MAX_RESULTS]
+            body = {'results': batch}
+            if opts.long_poll and len(results) <= SYNC_MAX_RESULTS:
+                body['wait'] = opts.long_poll
+            if telemetry:
+                body['telemetry'] = telemetry
+            r = await timed(stats, 'sync', http.request('POST', f"/sync/{client_id}", headers=ua, json_body=body,
+                                                      timeout=opts.long_poll + 15))
+            if r.status_code == 200:
+                data = r.json()
+                results, telemetry = results[len(batch):], None
+                for cmd in data.get('commands', []):
+                    result = await simulate_command(http, client_id, cmd, opts, stats, shots, ua)
+                    results.append({'id': cmd.get('id'), 'status': 'done', 'result': result})
+                interval = 0 if len(results) > SYNC_MAX_RESULTS else float(data.get('poll_interval', opts.poll))
+        except Exception as e:
+            if opts.verbose:
+                print(f"[{client_id}] Sync error: {e!r}")
+        if interval:
+            await asyncio.sleep(jittered(interval, opts.jitter))
+
+
+async def run_async_fleet(opts, clients):
+    """Run every client as a coroutine until `opts.duration` elapses (0 runs
+    until cancelled). Returns the FleetStats."""
+    http = AsyncHTTPClient(opts.server, limit=opts.connections)
+    stats = FleetStats()
+    stop = asyncio.Event()
+    variants = screenshot_variants(parse_shot_sizes(opts.shot_size))
+    sizes = list(variants)
+
+    async def agent(index, client_id):
+        await asyncio.sleep(ramp_delay(index, len(clients), opts.ramp_profile, opts.ramp_up, opts.ramp_steps))
+        # Spread the first request of a batch over one poll interval
+        await asyncio.sleep(random.uniform(0, opts.poll * opts.jitter))
+        stats.agents += 1
+        shots = variants[sizes[index % len(sizes)]]
+        if opts.protocol == 'sync':
+            await async_sync_loop(http, client_id, opts, stats, shots, stop)
+        else:
+            await asyncio.gather(async_heartbeat_loop(http, client_id, opts, stats, stop),
+                                 async_client_loop(http, client_id, opts, stats, shots, stop))
+
+    async def report():
+        while not stop.is_set():
+            await asyncio.sleep(opts.stats_interval)
+            print(stats.summary())
+
+    tasks = [asyncio.create_task(agent(i, cl)) for i, cl in enumerate(clients)]
+    reporter = asyncio.create_task(report())
+    try:
+        if opts.duration:
+            await asyncio.sleep(opts.duration)
+        else:
+            await asyncio.gather(*tasks)
+    finally:
+        stop.set()
+        for t in tasks + [reporter]:
+            t.cancel()
+        await asyncio.gather(*tasks, reporter, return_exceptions=True)
+        http.close()
+    return stats
 
 
 def main():
@@ -153,19 +474,46 @@ def main():
     p.add_argument('--num', type=int, default=5, help='Number of simulated clients')
     p.add_argument('--base', type=str, default='sim', help='Base name for client ids')
     p.add_argument('--server', type=str, default=os.environ.get('SERVER','http://127.0.0.1:5000'))
-    p.add_argument('--poll', type=int, default=5, help='Poll interval seconds')
-    p.add_argument('--heartbeat', type=int, default=15, help='Heartbeat interval seconds')
+    p.add_argument('--poll', type=int, default=5, help='Poll interval seconds (with sync, used when the server gives none)')
+    p.add_argument('--heartbeat', type=int, default=15, help='(async, legacy protocol) Heartbeat interval seconds')
+    p.add_argument('--protocol', choices=['sync', 'legacy'], default='sync',
+                   help='(async) sync: one /sync request per cycle; legacy: separate heartbeat, poll and result requests')
+    p.add_argument('--mode', choices=['thread', 'async'], default='thread',
+                   help='thread: one OS thread per client; async: one event loop for all clients')
+    p.add_argument('--connections', type=int, default=200, help='(async) Max concurrent HTTP connections')
+    p.add_argument('--jitter', type=float, default=0.2, help='(async) +/- fraction applied to poll/heartbeat intervals')
+    p.add_argument('--ramp-up', type=float, default=0, help='(async) Seconds over which clients come online')
+    p.add_argument('--ramp-profile', choices=['instant', 'linear', 'step'], default='linear')
+    p.add_argument('--ramp-steps', type=int, default=10, help='(async) Batches for the step profile')
+    p.add_argument('--shot-size', type=str, default='640x360',
+                   help='(async) Screenshot size(s) WxH, comma separated; clients are spread across them')
+    p.add_argument('--long-poll', type=int, default=0,
+                   help='(async) Long-poll wait seconds; each waiting poll holds one of --connections')
+    p.add_argument('--duration', type=float, default=0, help='(async) Stop after this many seconds (0 = until Ctrl-C)')
+    p.add_argument('--stats-interval', type=float, default=10, help='(async) Seconds between stats lines')
+    p.add_argument('--skip-users', action='store_true', help='Do not create users in users.db')
+    p.add_argument('--verbose', action='store_true', help='(async) Print per-client commands and errors')
     args = p.parse_args()
 
     clients = [f"{args.base}{i}" for i in range(1, args.num+1)]
-    ensure_users(clients)
+    if not args.skip_users:
+        ensure_users(clients)
+
+    if args.mode == 'async':
+        print(f'Starting {len(clients)} async clients over {args.connections} connections')
+        try:
+            stats = asyncio.run(run_async_fleet(args, clients))
+            print(stats.summary())
+        except KeyboardInterrupt:
+            print('Stopping simulators')
+        return
 
     threads = []
     stop_events = []
     for cl in clients:
         stop_ev = threading.Event()
         stop_events.append(stop_ev)
-        t = threading.Thread(target=client_thread_loop, args=(args.server, cl, args.poll, args.heartbeat, stop_ev), daemon=True)
+        t = threading.Thread(target=client_thread_loop, args=(args.server, cl, args.poll, stop_ev), daemon=True)
         t.start()
         threads.append(t)
     print('Started simulated clients:', clients)
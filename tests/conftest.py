@@ -0,0 +1,43 @@
+"""Shared fixtures for the server tests (run with `python -m pytest -q`).
+
+server.py works on paths relative to the working directory, so it is imported
+once per session from a temporary directory. Like serve.py and
+benchmark.load_server it is imported with LAB_DEFER_STARTUP=1, which keeps
+its background threads (outbox, event pump, retention) from starting; the
+schema is created here instead.
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="session")
+def server(tmp_path_factory):
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("server"))
+    os.environ["LAB_DEFER_STARTUP"] = "1"
+    sys.path.insert(0, ROOT)
+    import server
+    server.app.config["TESTING"] = True
+    server.init_db()
+    yield server
+    server.close_db_pool()
+    os.chdir(cwd)
+
+
+@pytest.fixture
+def client(server):
+    return server.app.test_client()
+
+
+@pytest.fixture
+def admin(server):
+    """A test client with a logged-in admin session."""
+    cl = server.app.test_client()
+    with cl.session_transaction() as s:
+        s["user_email"] = "admin@example.com"
+        s["role"] = "Admin"
+    return cl
@@ -0,0 +1,44 @@
+"""Password-reset verification codes: expiry and the wrong-guess limit."""
+import pytest
+
+
+@pytest.fixture(params=["sqlite", "memory"])
+def store(request, server):
+    return server.CODE_STORE_BACKENDS[request.param](ttl=60, max_attempts=3)
+
+
+def test_right_code_passes_until_discarded(server, store):
+    store.put("ok@example.com", "123456")
+    assert store.check("ok@example.com", "123456") == server.CODE_OK
+    assert store.check("ok@example.com", "123456") == server.CODE_OK
+    store.discard("ok@example.com")
+    assert store.check("ok@example.com", "123456") == server.CODE_EXPIRED
+
+
+def test_code_is_locked_after_max_wrong_guesses(server, store):
+    store.put("guess@example.com", "123456")
+    assert store.check("guess@example.com", "000000") == server.CODE_INVALID
+    assert store.check("guess@example.com", None) == server.CODE_INVALID
+    assert store.check("guess@example.com", "111111") == server.CODE_LOCKED
+    # the code is gone: even the right one no longer works
+    assert store.check("guess@example.com", "123456") == server.CODE_EXPIRED
+
+
+def test_expired_code_is_rejected(server, store):
+    store.ttl = -1
+    store.put("late@example.com", "123456")
+    assert store.check("late@example.com", "123456") == server.CODE_EXPIRED
+    assert store.sweep() == 0   # already removed by the check
+
+
+def test_non_ascii_code_counts_as_a_wrong_guess(server, store):
+    store.put("utf@example.com", "123456")
+    assert store.check("utf@example.com", "12345é") == server.CODE_INVALID
+    assert store.check("utf@example.com", "123456") == server.CODE_OK
+
+
+def test_reset_password_with_non_ascii_code(server, client):
+    server.CODE_STORE.put("reset@example.com", "123456")
+    r = client.post("/reset-password/reset@example.com", data={"code": "12345é", "password": "x"})
+    assert r.status_code == 302 and r.headers["Location"].endswith("/reset-password/reset@example.com")
+    server.CODE_STORE.discard("reset@example.com")
@@ -0,0 +1,66 @@
+"""Command queue: leases, redelivery and the results agents may report."""
+
+
+def expire_leases(server, client_id):
+    with server.get_db() as conn:
+        conn.execute(f"UPDATE commands SET lease_expires=0 WHERE client_id=? AND status={server.CMD_IN_FLIGHT}",
+                     (client_id,))
+
+
+def command_row(server, cmd_id):
+    with server.get_db() as conn:
+        return conn.execute("SELECT status, attempts, result FROM commands WHERE id=?", (cmd_id,)).fetchone()
+
+
+def test_claim_leases_command_until_it_expires(server):
+    server.enqueue_commands(["lease-pc"], "shutdown")
+    first = server.claim_commands("lease-pc")
+    assert [(c["command"], c["attempt"]) for c in first] == [("shutdown", 1)]
+    assert server.claim_commands("lease-pc") == []   # still leased to the agent
+
+    expire_leases(server, "lease-pc")
+    again = server.claim_commands("lease-pc")
+    assert [(c["id"], c["attempt"]) for c in again] == [(first[0]["id"], 2)]
+    assert command_row(server, first[0]["id"])[:2] == (server.CMD_IN_FLIGHT, 2)
+
+
+def test_command_fails_after_max_attempts(server):
+    server.enqueue_commands(["flaky-pc"], "restart")
+    for attempt in range(1, server.COMMAND_MAX_ATTEMPTS + 1):
+        claimed = server.claim_commands("flaky-pc")
+        assert [c["attempt"] for c in claimed] == [attempt]
+        expire_leases(server, "flaky-pc")
+    assert server.claim_commands("flaky-pc") == []
+    status, attempts, result = command_row(server, claimed[0]["id"])
+    assert (status, attempts) == (server.CMD_FAILED, server.COMMAND_MAX_ATTEMPTS)
+    assert f"{server.COMMAND_MAX_ATTEMPTS} deliveries" in result
+
+
+def test_result_ends_the_lease(server, client):
+    server.enqueue_commands(["done-pc"], "lock")
+    cmd_id = server.claim_commands("done-pc")[0]["id"]
+    r = client.post("/poll-commands/done-pc", json={"id": cmd_id, "status": "error", "result": "boom"})
+    assert r.status_code == 200
+    expire_leases(server, "done-pc")
+    assert server.claim_commands("done-pc") == []
+    assert command_row(server, cmd_id) == (server.CMD_FAILED, 1, "boom")
+
+
+def test_agent_cannot_report_non_final_status(server, client):
+    server.enqueue_commands(["stuck-pc"], "lock")
+    cmd_id = server.claim_commands("stuck-pc")[0]["id"]
+    for status in ("pending", "in_flight", "bogus", 3):
+        r = client.post("/poll-commands/stuck-pc", json={"id": cmd_id, "status": status})
+        assert r.status_code == 400
+        r = client.post("/sync/stuck-pc", json={"results": [{"id": cmd_id, "status": status}]})
+        assert r.status_code == 400
+    assert command_row(server, cmd_id)[0] == server.CMD_IN_FLIGHT
+
+
+def test_result_for_another_clients_command_is_rejected(server, client):
+    server.enqueue_commands(["owner-pc"], "lock")
+    cmd_id = server.claim_commands("owner-pc")[0]["id"]
+    r = client.post("/poll-commands/other-pc", json={"id": cmd_id, "status": "done"})
+    assert r.status_code == 404
+    assert command_row(server, cmd_id)[0] == server.CMD_IN_FLIGHT
+    assert client.post("/poll-commands/owner-pc", json=[cmd_id]).status_code == 400
@@ -0,0 +1,64 @@
+"""GET /fleet: filtered, sorted, cursor-paginated client list."""
+import io
+import time
+
+import pytest
+
+MEMBERS = [f"fleet-pc{i}" for i in range(7)]
+
+
+@pytest.fixture(scope="module")
+def lab(server):
+    now = time.time()
+    with server.get_db() as conn:
+        conn.execute("INSERT INTO labs (name, created_at) VALUES ('fleet-lab', ?)", (now,))
+        lab_id = conn.execute("SELECT id FROM labs WHERE name='fleet-lab'").fetchone()[0]
+        conn.executemany("INSERT INTO lab_members (lab_id, client_id) VALUES (?,?)", [(lab_id, c) for c in MEMBERS])
+    for i, client_id in enumerate(MEMBERS[:4]):   # pc0-3 report, the rest never did
+        server.heartbeats[client_id] = now - i
+        server.fleet.heartbeat(client_id, now - i)
+    server.save_screenshot("fleet-pc1", io.BytesIO(b"\x89PNG\r\n\x1a\n" + b"\0" * 32))
+    return "fleet-lab"
+
+
+def walk(admin, **params):
+    ids, after = [], None
+    while True:
+        query = dict(params, lab="fleet-lab", limit=3, **({"after": after} if after else {}))
+        page = admin.get("/fleet", query_string=query).get_json()
+        assert len(page["items"]) <= 3 and page["total"] == len(MEMBERS)
+        ids += [item["id"] for item in page["items"]]
+        after = page["next"]
+        if after is None:
+            return ids
+
+
+def test_cursor_pages_cover_every_client_once(lab, admin):
+    assert walk(admin) == sorted(MEMBERS)
+    assert walk(admin, sort="-id") == sorted(MEMBERS, reverse=True)
+    assert walk(admin, sort="last_seen") == MEMBERS[4:] + MEMBERS[3::-1]
+    assert walk(admin, sort="status")[:4] == MEMBERS[:4]
+
+
+def test_status_filter_and_total(lab, admin):
+    page = admin.get("/fleet", query_string={"lab": lab, "status": "offline"}).get_json()
+    assert [item["id"] for item in page["items"]] == MEMBERS[4:]
+    assert page["total"] == 3 and page["next"] is None
+
+
+def test_thumb_urls_come_from_latest_screenshots(server, lab, admin, monkeypatch):
+    monkeypatch.setattr(server, "SCREENSHOT_INDEX_TTL", 0)   # force the batched lookup
+    items = {item["id"]: item for item in admin.get("/fleet", query_string={"lab": lab}).get_json()["items"]}
+    digest = server.latest_screenshot("fleet-pc1")["hash"]
+    assert items["fleet-pc1"]["thumb_url"] == f"/thumbs/{digest}-thumb.jpg"
+    assert items["fleet-pc2"]["thumb_url"] == "/thumbnail/fleet-pc2/thumb"
+    assert server.latest_screenshots(MEMBERS) == {"fleet-pc1": server.latest_screenshot("fleet-pc1")}
+
+
+def test_bad_requests(lab, admin, client):
+    assert client.get("/fleet").status_code == 401
+    cursor = admin.get("/fleet", query_string={"lab": lab, "limit": 2}).get_json()["next"]
+    for query in ({"sort": "name"}, {"status": "asleep"}, {"limit": "x"}, {"after": "!!"},
+                  {"after": cursor, "sort": "last_seen"}):
+        assert admin.get("/fleet", query_string=dict(query, lab=lab)).status_code == 400, query
+    assert admin.get("/fleet", query_string={"lab": "no-such-lab"}).status_code == 404
@@ -0,0 +1,44 @@
+"""The mmap-backed heartbeat registry shared by worker processes."""
+import os
+
+import pytest
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork()")
+def test_registry_is_shared_across_fork(server, tmp_path):
+    path = str(tmp_path / "heartbeats.bin")
+    registry = server.HeartbeatRegistry(path, capacity=2)
+    registry["parent-pc"] = 100.0
+    pid = os.fork()
+    if pid == 0:
+        # Like serve.py's workers: the child opens the registry itself
+        code = 1
+        try:
+            child = server.HeartbeatRegistry(path)
+            if child.get("parent-pc") == 100.0:
+                for i in range(5):   # past the capacity, so the file grows
+                    child[f"child-pc{i}"] = 200.0 + i
+                child.bump_version()
+                code = 0
+        finally:
+            os._exit(code)
+    _, status = os.waitpid(pid, 0)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+    assert [registry.get(f"child-pc{i}") for i in range(5)] == [200.0 + i for i in range(5)]
+    assert registry.version() == 1
+    registry.close()
+
+
+def test_registry_survives_reopen(server, tmp_path):
+    path = str(tmp_path / "heartbeats.bin")
+    registry = server.HeartbeatRegistry(path, capacity=1)
+    registry["pc-a"] = 1.0
+    registry["pc-b"] = 2.0
+    long_id = "x" * (server.HeartbeatRegistry.ID_BYTES + 1)
+    registry[long_id] = 3.0   # too long for a slot, kept in this process only
+    registry.close()
+
+    reopened = server.HeartbeatRegistry(path)
+    assert (reopened.get("pc-a"), reopened.get("pc-b")) == (1.0, 2.0)
+    assert reopened.get(long_id) is None and reopened.get("pc-c") is None
+    reopened.close()
@@ -0,0 +1,36 @@
+"""Labs (client groups) and broadcast commands."""
+
+
+def test_broadcast_to_lab_queues_for_each_member(server, admin):
+    r = admin.post("/labs", json={"name": " lab-a ", "clients": ["lab-pc1", "lab-pc2", "lab-pc1"]})
+    assert r.get_json() == {"ok": True, "name": "lab-a", "clients": 2}
+    assert admin.get("/labs").get_json()["labs"]["lab-a"] == ["lab-pc1", "lab-pc2"]
+
+    r = admin.post("/broadcast-command", json={"command": "lock", "lab": "lab-a"})
+    assert r.get_json()["results"] == {"lab-pc1": "queued", "lab-pc2": "queued"}
+    assert admin.post("/broadcast-command", json={"command": "lock", "lab": "nope"}).status_code == 404
+    assert admin.delete("/labs/lab-a").status_code == 200
+    assert "lab-a" not in admin.get("/labs").get_json()["labs"]
+
+
+def test_broadcast_to_client_ids_skips_duplicate_screenshots(admin):
+    body = {"command": "screenshot", "client_ids": ["bc-pc1", "bc-pc2"]}
+    assert admin.post("/broadcast-command", json=body).get_json()["queued"] == 2
+    r = admin.post("/broadcast-command", json=body).get_json()
+    assert r["queued"] == 0 and set(r["results"].values()) == {"duplicate"}
+
+
+def test_group_commands_require_a_session(client):
+    assert client.post("/broadcast-command", json={"command": "lock", "online": True}).status_code == 401
+    assert client.post("/labs", json={"name": "x", "clients": []}).status_code == 401
+    assert client.delete("/labs/x").status_code == 401
+
+
+def test_malformed_bodies_are_rejected(admin):
+    for body in ([], "lock", 3, {"command": ["lock"], "online": True}, {"command": "lock", "lab": ["a"]},
+                 {"command": "lock", "pattern": 5}, {"command": "lock", "client_ids": "pc1"},
+                 {"command": "lock", "client_ids": [1, 2]}):
+        assert admin.post("/broadcast-command", json=body).status_code == 400, body
+    for body in ([], "lab", {"name": 5, "clients": []}, {"name": "lab-b", "clients": None},
+                 {"name": "lab-b", "clients": "pc1"}, {"name": "lab-b", "clients": [["pc1"]]}):
+        assert admin.post("/labs", json=body).status_code == 400, body
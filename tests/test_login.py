@@ -0,0 +1,53 @@
+"""Login: password verification and upgrading stored hashes."""
+import pytest
+from werkzeug.security import generate_password_hash
+
+PASSWORD = "Secret123!"
+
+
+def add_user(server, email, stored):
+    with server.get_db() as conn:
+        conn.execute("INSERT INTO users (username, email, password, role, approved) VALUES (?,?,?,'Teacher',1)",
+                     (email.split("@")[0], email, stored))
+
+
+def stored_hash(server, email):
+    with server.get_db() as conn:
+        return conn.execute("SELECT password FROM users WHERE email=?", (email,)).fetchone()[0]
+
+
+@pytest.fixture(params=[0, 1], ids=["inline", "pool"])
+def hash_workers(request, server, monkeypatch):
+    monkeypatch.setattr(server, "PASSWORD_HASH_WORKERS", request.param)
+    return request.param
+
+
+def test_login_rehashes_old_kdf_parameters(server, client, hash_workers):
+    email = f"old-kdf-{hash_workers}@example.com"
+    add_user(server, email, generate_password_hash(PASSWORD, "pbkdf2:sha256:1000"))
+    r = client.post("/login", data={"email": email, "password": PASSWORD})
+    assert r.status_code == 302
+    new = stored_hash(server, email)
+    assert new.startswith(server.PASSWORD_HASH_METHOD + "$")
+    assert server.verify_password(new, PASSWORD)
+
+
+def test_login_migrates_plaintext_password(server, client, monkeypatch):
+    monkeypatch.setattr(server, "PASSWORD_HASH_WORKERS", 0)
+    add_user(server, "plain@example.com", PASSWORD)
+    assert client.post("/login", data={"email": "plain@example.com", "password": PASSWORD}).status_code == 302
+    assert server.verify_password(stored_hash(server, "plain@example.com"), PASSWORD)
+
+
+def test_current_hash_is_left_alone(server, client, monkeypatch):
+    monkeypatch.setattr(server, "PASSWORD_HASH_WORKERS", 0)
+    current = server.hash_password(PASSWORD)
+    add_user(server, "current@example.com", current)
+    assert client.post("/login", data={"email": "current@example.com", "password": PASSWORD}).status_code == 302
+    assert stored_hash(server, "current@example.com") == current
+
+
+def test_password_rules(server):
+    assert server.password_valid(PASSWORD)
+    for weak in ("secret123!", "SECRET123!", "Secret!!!", "Secret123", "Se1!"):
+        assert not server.password_valid(weak), weak
@@ -0,0 +1,41 @@
+"""Schema migrations run by init_db."""
+import sqlite3
+
+
+def test_migrates_text_status_commands_table(server, tmp_path, monkeypatch):
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    # Layout from before integer status codes and leases
+    conn.execute('''
+        CREATE TABLE commands (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            client_id TEXT,
+            command TEXT,
+            args TEXT,
+            status TEXT DEFAULT 'pending',
+            result TEXT,
+            created_at REAL,
+            updated_at REAL
+        )
+    ''')
+    conn.executemany("INSERT INTO commands (id, client_id, command, args, status, result) VALUES (?,?,?,?,?,?)",
+                     [(7, "old-pc", "shutdown", "", "pending", None),
+                      (8, "old-pc", "lock", "", "done", "ok"),
+                      (9, "old-pc", "restart", "", "error", "boom")])
+    conn.commit()
+    conn.close()
+
+    server.close_db_pool()
+    monkeypatch.setattr(server, "DB", path)
+    try:
+        server.init_db()
+        with server.get_db() as conn:
+            rows = conn.execute("SELECT id, status, attempts FROM commands ORDER BY id").fetchall()
+            columns = {row[1]: row[2] for row in conn.execute("PRAGMA table_info(commands)")}
+            indexes = {row[1] for row in conn.execute("PRAGMA index_list(commands)")}
+        assert rows == [(7, server.CMD_PENDING, 0), (8, server.CMD_DONE, 0), (9, server.CMD_FAILED, 0)]
+        assert columns["status"] == "INTEGER" and "lease_expires" in columns
+        assert {"idx_commands_pending", "idx_commands_in_flight"} <= indexes
+        assert [(c["id"], c["command"]) for c in server.claim_commands("old-pc")] == [(7, "shutdown")]
+    finally:
+        server.close_db_pool()
@@ -0,0 +1,109 @@
+"""Email outbox: delivery, per-message retries and backoff while SMTP is down."""
+import smtplib
+import time
+
+import pytest
+
+
+class FakeSMTP:
+    def __init__(self, refuse=()):
+        self.sent = []
+        self.refuse = set(refuse)
+        self.closed = False
+
+    def send_message(self, msg):
+        if msg["To"] in self.refuse:
+            raise smtplib.SMTPRecipientsRefused({msg["To"]: (550, b"no such user")})
+        self.sent.append(msg["To"])
+
+    def quit(self):
+        self.closed = True
+
+
+@pytest.fixture
+def outbox(server, monkeypatch):
+    monkeypatch.setattr(server, "SMTP_USER", "user")
+    monkeypatch.setattr(server, "SMTP_PASS", "pass")
+    connections = []
+    def connect(**kw):
+        smtp = FakeSMTP(**kw)
+        connections.append(smtp)
+        return smtp
+    monkeypatch.setattr(server, "_smtp_connect", connect)
+    with server.get_db() as conn:
+        conn.execute("DELETE FROM email_outbox")
+    return connections
+
+
+def rows(server):
+    with server.get_db() as conn:
+        return conn.execute("SELECT to_email, status, attempts, next_attempt_at, last_error "
+                            "FROM email_outbox ORDER BY id").fetchall()
+
+
+def make_due(server):
+    with server.get_db() as conn:
+        conn.execute("UPDATE email_outbox SET next_attempt_at=0")
+
+
+def test_queued_mail_is_sent_over_one_connection(server, outbox):
+    for i in range(3):
+        server.send_email(f"user{i}@example.com", "Hello", "<p>hi</p>")
+    assert server.drain_outbox() == 3
+    assert len(outbox) == 1 and outbox[0].sent == [f"user{i}@example.com" for i in range(3)]
+    assert rows(server) == []
+
+
+def test_server_down_backs_off_whole_batch(server, outbox, monkeypatch):
+    attempts = []
+    def down():
+        attempts.append(1)
+        raise ConnectionRefusedError("refused")
+    monkeypatch.setattr(server, "_smtp_connect", down)
+    server.send_email("a@example.com", "Hi", "x")
+    server.send_email("b@example.com", "Hi", "x")
+    start = time.time()
+    assert server.drain_outbox() == 2
+    assert len(attempts) == 1   # no reconnect per message
+    for _, status, tries, next_at, error in rows(server):
+        assert (status, tries) == (server.OUTBOX_PENDING, 1) and "refused" in error
+        assert start + server.OUTBOX_BACKOFF * 0.8 <= next_at <= time.time() + server.OUTBOX_BACKOFF * 1.2
+    assert server.drain_outbox() == 0   # not due yet
+
+    make_due(server)
+    server.drain_outbox()
+    delays = [r[3] - time.time() for r in rows(server)]
+    assert all(server.OUTBOX_BACKOFF * 2 * 0.8 - 1 <= d <= server.OUTBOX_BACKOFF * 2 * 1.2 for d in delays)
+
+
+def test_message_fails_permanently_after_max_attempts(server, outbox, monkeypatch):
+    monkeypatch.setattr(server, "_smtp_connect", lambda: FakeSMTP(refuse={"gone@example.com"}))
+    server.send_email("gone@example.com", "Hi", "x")
+    for _ in range(server.OUTBOX_MAX_ATTEMPTS):
+        make_due(server)
+        server.drain_outbox()
+    [(_, status, tries, _, error)] = rows(server)
+    assert (status, tries) == (server.OUTBOX_FAILED, server.OUTBOX_MAX_ATTEMPTS)
+    assert "550" in error
+    make_due(server)
+    assert server.drain_outbox() == 0   # failed rows are left alone
+
+
+def test_refused_recipient_does_not_hold_up_the_rest(server, outbox, monkeypatch):
+    smtp = FakeSMTP(refuse={"bad@example.com"})
+    monkeypatch.setattr(server, "_smtp_connect", lambda: smtp)
+    for email in ("ok1@example.com", "bad@example.com", "ok2@example.com"):
+        server.send_email(email, "Hi", "x")
+    server.drain_outbox()
+    assert smtp.sent == ["ok1@example.com", "ok2@example.com"]
+    assert [(r[0], r[2]) for r in rows(server)] == [("bad@example.com", 1)]
+
+
+def test_dropped_idle_connection_is_reopened(server, outbox):
+    class Dropped(FakeSMTP):
+        def send_message(self, msg):
+            raise smtplib.SMTPServerDisconnected("idle")
+    server.send_email("again@example.com", "Hi", "x")
+    smtp = server._send_outbox_batch(Dropped(), server._claim_outbox_batch())
+    assert smtp is outbox[0] and smtp.sent == ["again@example.com"]
+    assert rows(server) == []
@@ -0,0 +1,41 @@
+"""Rendered page cache keyed by the fleet state version."""
+import gzip
+
+
+def test_page_is_rendered_once_per_version(server):
+    renders = []
+    def render():
+        renders.append(1)
+        return f"<p>render {len(renders)}</p>"
+
+    with server.app.test_request_context("/"):
+        first = server.cached_page("test-page", None, render)
+        again = server.cached_page("test-page", None, render)
+        assert len(renders) == 1 and first.get_data() == again.get_data() == b"<p>render 1</p>"
+        assert first.get_etag() == again.get_etag()
+
+        server.bump_fleet_version()
+        changed = server.cached_page("test-page", None, render)
+        assert len(renders) == 2 and changed.get_data() == b"<p>render 2</p>"
+        assert changed.get_etag() != first.get_etag()
+        server.cached_page("test-page", "other", render)   # variants are cached separately
+        assert len(renders) == 3
+
+
+def test_conditional_and_gzip_responses(server):
+    with server.app.test_request_context("/", headers={"Accept-Encoding": "gzip"}):
+        r = server.cached_page("gz-page", None, lambda: "<p>hello</p>" * 50)
+        assert r.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(r.get_data()) == b"<p>hello</p>" * 50
+        etag = r.get_etag()[0]
+    with server.app.test_request_context("/", headers={"Accept-Encoding": "gzip", "If-None-Match": f'"{etag}"'}):
+        assert server.cached_page("gz-page", None, lambda: "unused").status_code == 304
+
+
+def test_dashboard_changes_when_the_fleet_does(admin):
+    before = admin.get("/dashboard")
+    assert before.status_code == 200
+    assert admin.get("/dashboard", headers={"If-None-Match": before.headers["ETag"]}).status_code == 304
+    admin.post("/labs", json={"name": "cache-lab", "clients": []})   # bumps the version
+    after = admin.get("/dashboard", headers={"If-None-Match": before.headers["ETag"]})
+    assert after.status_code == 200 and b"cache-lab" in after.get_data()
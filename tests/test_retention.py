@@ -0,0 +1,53 @@
+"""Retention: archiving finished commands and pruning old screenshots."""
+import io
+import sqlite3
+
+DAY = 86400
+T0 = 1_000_000_000.0   # 2001-09-09, far older than any cutoff used elsewhere
+
+
+def add_commands(server, client_id, rows):
+    with server.get_db() as conn:
+        conn.executemany("INSERT INTO commands (client_id, command, status, result, created_at, updated_at) "
+                         "VALUES (?,?,?,?,?,?)", [(client_id, cmd, status, "r", ts, ts) for cmd, status, ts in rows])
+
+
+def test_retention_archives_and_summarizes_old_finished_commands(server, monkeypatch):
+    monkeypatch.setattr(server, "RETENTION_BATCH", 2)   # several batches
+    add_commands(server, "ret-pc", [("lock", server.CMD_DONE, T0), ("lock", server.CMD_DONE, T0 + 1),
+                                    ("lock", server.CMD_FAILED, T0 + 2), ("restart", server.CMD_DONE, T0 + DAY),
+                                    ("lock", server.CMD_PENDING, T0), ("lock", server.CMD_DONE, T0 + 10 * DAY)])
+    assert server.run_retention(cutoff=T0 + 5 * DAY) == 4
+
+    with server.get_db() as conn:
+        left = conn.execute("SELECT status, updated_at FROM commands WHERE client_id='ret-pc' ORDER BY id").fetchall()
+        summary = conn.execute("SELECT day, command, done, failed FROM command_daily_summary "
+                               "WHERE client_id='ret-pc' ORDER BY day, command").fetchall()
+    assert left == [(server.CMD_PENDING, T0), (server.CMD_DONE, T0 + 10 * DAY)]
+    assert summary == [("2001-09-09", "lock", 2, 1), ("2001-09-10", "restart", 1, 0)]
+    archived = sqlite3.connect(server.COMMAND_ARCHIVE_DB).execute(
+        "SELECT command, status FROM commands WHERE client_id='ret-pc' ORDER BY id").fetchall()
+    assert archived == [("lock", 1), ("lock", 1), ("lock", 2), ("restart", 1)]
+    assert server.run_retention(cutoff=T0 + 5 * DAY) == 0
+
+
+def test_retention_candidates_come_from_the_finished_index(server):
+    with server.get_db() as conn:
+        plan = conn.execute(f"EXPLAIN QUERY PLAN SELECT id FROM commands WHERE status IN "
+                            f"({server.CMD_DONE},{server.CMD_FAILED}) AND updated_at<? ORDER BY updated_at LIMIT ?",
+                            (T0, 10)).fetchall()
+    assert "idx_commands_finished" in plan[0][-1] and "SCAN" not in plan[0][-1]
+
+
+def test_prune_by_age_keeps_each_clients_latest_screenshot(server):
+    def shot(client_id, body, taken_at):
+        return server.save_screenshot(client_id, io.BytesIO(b"\x89PNG\r\n\x1a\n" + body), taken_at=taken_at)
+    shot("prune-a", b"a1", T0)
+    shot("prune-a", b"a2", T0 + 1)
+    shot("prune-a", b"a3", T0 + 2 * DAY)
+    shot("prune-b", b"b1", T0)   # old, but b's only screenshot
+    assert server.prune_screenshots(cutoff=T0 + DAY) == 2
+    with server.get_db() as conn:
+        kept = conn.execute("SELECT client_id, taken_at FROM screenshots WHERE client_id LIKE 'prune-_' "
+                            "ORDER BY client_id").fetchall()
+    assert kept == [("prune-a", T0 + 2 * DAY), ("prune-b", T0)]
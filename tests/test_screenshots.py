@@ -0,0 +1,100 @@
+"""Screenshot uploads, the content-addressed store and thumbnails."""
+import io
+import os
+
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def png(color, size=(64, 48)):
+    buf = io.BytesIO()
+    Image.new("RGB", size, color).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def upload(client, client_id, data, phash=None):
+    url = f"/upload/{client_id}" + (f"?phash={phash}" if phash else "")
+    return client.post(url, data=data, content_type="image/png")
+
+
+def test_unchanged_screenshot_matches_stored_phash(client):
+    assert upload(client, "same-pc", png("red"), phash="ff00").status_code == 200
+    r = client.post("/screenshot-unchanged/same-pc", json={"phash": "FF00"})
+    assert r.status_code == 200 and r.get_json()["unchanged"]
+    r = client.post("/screenshot-unchanged/same-pc", json={"phash": "ff01"})
+    assert r.status_code == 409 and not r.get_json()["unchanged"]
+    assert client.post("/screenshot-unchanged/never-pc", json={"phash": "ff00"}).status_code == 409
+
+
+def test_unchanged_rejects_malformed_bodies(client):
+    for body in ([], ["ff00"], "ff00", 7, {"phash": 255}, {"phash": "xyz"}, {}):
+        assert client.post("/screenshot-unchanged/same-pc", json=body).status_code == 400, body
+
+
+def test_thumbnail_url_is_content_addressed_and_made_on_demand(server, client, monkeypatch):
+    digest = upload(client, "thumb-pc", png("green", (800, 600))).get_json()["hash"]
+    info = client.get("/screenshot/thumb-pc").get_json()
+    assert info["thumb_url"] == f"/thumbs/{digest}-thumb.jpg"
+    assert info["preview_url"] == f"/thumbs/{digest}-preview.jpg"
+
+    # Building the URL never looks at the disk; a missing file is made on request
+    path = f"{server.THUMB_DIR}/{digest}-preview.jpg"
+    os.remove(path)
+    r = client.get(info["preview_url"])
+    assert r.status_code == 200 and r.mimetype == "image/jpeg"
+    assert Image.open(io.BytesIO(r.data)).size == (800, 600)   # not upscaled past the source
+    assert "immutable" in r.headers["Cache-Control"] and os.path.exists(path)
+
+    assert client.get("/thumbnail/thumb-pc/thumb").headers["Location"].endswith(info["thumb_url"])
+    assert client.get(f"/thumbs/{'0' * 64}-thumb.jpg").status_code == 404
+    assert client.get(f"/thumbs/{digest}-huge.jpg").status_code == 404
+
+
+def test_pruned_screenshot_takes_its_thumbnails_along(server, client, monkeypatch):
+    monkeypatch.setattr(server, "SCREENSHOT_HISTORY_COUNT", 1)
+    old = upload(client, "prune-pc", png("navy")).get_json()["hash"]
+    new = upload(client, "prune-pc", png("olive")).get_json()["hash"]
+    thumbs = os.listdir(server.THUMB_DIR)
+    assert f"{new}-thumb.jpg" in thumbs and f"{old}-thumb.jpg" not in thumbs
+
+
+def parts_left(server):
+    return [name for _, _, files in os.walk(server.SCREENSHOT_STORE) for name in files if name.endswith(".part")]
+
+
+def test_upload_stores_image_under_its_hash(server, client):
+    data = png("purple")
+    for body in (data, {"screenshot": (io.BytesIO(data), "shot.png")}):
+        if isinstance(body, dict):
+            r = client.post("/upload/store-pc", data=body, content_type="multipart/form-data")
+        else:
+            r = upload(client, "store-pc", body)
+        assert r.status_code == 200 and r.get_json()["format"] == "png"
+        with open(server.store_path(r.get_json()["hash"], "png"), "rb") as f:
+            assert f.read() == data
+    assert parts_left(server) == []
+
+
+def test_oversized_uploads_are_refused_and_cleaned_up(server, client, monkeypatch):
+    monkeypatch.setattr(server, "SCREENSHOT_MAX_BYTES", 1000)
+    data = png("white", (400, 400)) + b"\0" * 2000
+    assert upload(client, "big-pc", data).status_code == 413
+    r = client.post("/upload/big-pc", data={"screenshot": (io.BytesIO(data), "big.png")},
+                    content_type="multipart/form-data")
+    assert r.status_code == 413
+    r = client.post("/upload/big-pc", data=b"x", content_type="image/png",
+                    environ_overrides={"CONTENT_LENGTH": str(server.app.config["MAX_CONTENT_LENGTH"] + 1)})
+    assert r.status_code == 413
+    assert parts_left(server) == [] and client.get("/screenshot/big-pc").get_json()["exists"] is False
+
+
+def test_unsupported_uploads_are_refused_and_cleaned_up(server, client):
+    assert upload(client, "gif-pc", b"GIF89a" + b"\0" * 100).status_code == 415
+    r = client.post("/upload/gif-pc", data={"screenshot": (io.BytesIO(b"not an image"), "x.txt")},
+                    content_type="multipart/form-data")
+    assert r.status_code == 415
+    r = client.post("/upload/gif-pc", data={"other": (io.BytesIO(png("red")), "x.png")},
+                    content_type="multipart/form-data")
+    assert r.status_code == 400
+    assert parts_left(server) == [] and client.get("/screenshot/gif-pc").get_json()["exists"] is False
@@ -0,0 +1,53 @@
+"""POST /sync: heartbeat, results and command delivery in one round trip."""
+
+
+def sync(client, client_id, **body):
+    r = client.post(f"/sync/{client_id}", json=body)
+    assert r.status_code == 200, r.get_json()
+    return r.get_json()
+
+
+def test_sync_delivers_commands_and_acks_results(server, client):
+    server.enqueue_commands(["sync-pc"], "lock")
+    reply = sync(client, "sync-pc")
+    assert [c["command"] for c in reply["commands"]] == ["lock"]
+    assert reply["acked"] == [] and reply["poll_interval"] == 0
+    assert server.heartbeats.get("sync-pc") is not None
+
+    cmd_id = reply["commands"][0]["id"]
+    reply = sync(client, "sync-pc", results=[{"id": cmd_id, "status": "done", "result": "locked"}])
+    assert reply["acked"] == [cmd_id]
+    assert reply["commands"] == [] and reply["poll_interval"] == server.SYNC_INTERVAL
+    with server.get_db() as conn:
+        assert conn.execute("SELECT status, result FROM commands WHERE id=?", (cmd_id,)).fetchone() == \
+            (server.CMD_DONE, "locked")
+
+
+def test_sync_ignores_results_for_other_clients_and_malformed_items(server, client):
+    server.enqueue_commands(["sync-owner"], "restart")
+    cmd_id = sync(client, "sync-owner")["commands"][0]["id"]
+    reply = sync(client, "sync-thief", results=[{"id": cmd_id, "status": "done"}, {"status": "done"},
+                                                {"id": "x"}, "junk"])
+    assert reply["acked"] == []
+    assert sync(client, "sync-owner", results=[{"id": str(cmd_id)}])["acked"] == [cmd_id]
+
+
+def test_sync_caps_results_per_call(server, client):
+    for i in range(server.SYNC_MAX_RESULTS + 5):
+        server.enqueue_commands(["cap-pc"], f"cmd{i}")
+    ids = [c["id"] for c in sync(client, "cap-pc")["commands"]]
+    results = [{"id": cmd_id, "status": "done"} for cmd_id in ids]
+    assert sync(client, "cap-pc", results=results)["acked"] == ids[:server.SYNC_MAX_RESULTS]
+    assert sync(client, "cap-pc", results=results[server.SYNC_MAX_RESULTS:])["acked"] == ids[server.SYNC_MAX_RESULTS:]
+
+
+def test_sync_stores_telemetry(client):
+    sync(client, "telemetry-pc", telemetry={"cpu": 12})
+    status = client.get("/status/telemetry-pc").get_json()
+    assert status["status"] == "Online" and status["telemetry"] == {"cpu": 12}
+
+
+def test_sync_rejects_malformed_bodies(client):
+    for body in ([], [{"id": 1}], "results", 5, {"results": {}}, {"results": "x"}, {"telemetry": []},
+                 {"wait": "soon"}):
+        assert client.post("/sync/bad-pc", json=body).status_code == 400, body
@@ -16,23 +16,43 @@ try:
 except Exception:
     pass
 
-# Ensure commands table exists
+# Ensure commands table exists (same layout as server.init_db: integer status, 0 = pending, 3 = in flight)
 try:
     c.execute('''
         CREATE TABLE IF NOT EXISTS commands (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            client_id TEXT,
-            command TEXT,
+            client_id TEXT NOT NULL,
+            command TEXT NOT NULL,
             args TEXT,
-            status TEXT DEFAULT 'pending',
+            status INTEGER NOT NULL DEFAULT 0,
             result TEXT,
             created_at REAL,
-            updated_at REAL
+            updated_at REAL,
+            lease_expires REAL,
+            attempts INTEGER NOT NULL DEFAULT 0
         )
     ''')
 except Exception:
     pass
 
+# Its indexes need that layout. A table from before integer status codes and
+# leases is rebuilt by server.py's init_db on its next start, which creates
+# them too; any other failure here is a real error and is not swallowed.
+cols = {row[1]: row[2] for row in c.execute("PRAGMA table_info(commands)")}
+if cols.get('status', '').upper() == 'TEXT' or 'lease_expires' not in cols:
+    print("commands table has the old layout; start server.py once to migrate it")
+else:
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_commands_pending
+        ON commands (client_id, id, command, args, created_at, status)
+        WHERE status = 0
+    ''')
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_commands_in_flight
+        ON commands (client_id, lease_expires, command, status)
+        WHERE status = 3
+    ''')
+
 # Create an admin if none exists
 c.execute("SELECT * FROM users WHERE role='Admin'")
 if not c.fetchone():